@@ -0,0 +1,119 @@
+"""
+Benchmark de la compresión de las transferencias (compression.py).
+
+Comprime y descomprime cada fichero con cada códec, con los mismos bloques que usa el seeder, y
+calcula a partir de qué ancho de banda deja de compensar. Con la compresión, la descarga tarda
+lo que el más lento de comprimir, enviar los datos comprimidos y descomprimir; sin ella, lo que
+se tarda en enviar el fichero. Comprimir compensa mientras el enlace sea más lento que la
+compresión y la descompresión (el punto de equilibrio) y ahorra más cuanto mejor comprime.
+
+Sin ficheros, se generan un log, un CSV y datos aleatorios de 'size' MiB.
+
+Uso: python3 bench_compression.py [-s MiB] [fichero ...]
+"""
+import argparse
+import io
+import os
+import random
+import tempfile
+import time
+
+from compression import CODECS, StreamDecoder, send_stream
+
+# Enlaces con los que se compara el tiempo de la descarga, en Mbit/s
+LINKS = (10, 100, 1000)
+
+
+class MemorySocket:
+    """Socket falso que guarda lo que se envía."""
+
+    def __init__(self):
+        self.data = io.BytesIO()
+
+    def sendall(self, data):
+        self.data.write(data)
+
+
+def generate_samples(directory, size):
+    rng = random.Random(0)
+    levels = ("INFO", "INFO", "INFO", "WARN", "ERROR")
+    users = [f"user{i}" for i in range(50)]
+    samples = []
+
+    path = os.path.join(directory, "server.log")
+    with open(path, "w") as f:
+        t = 1700000000.0
+        while f.tell() < size:
+            t += rng.random()
+            f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(t))} {rng.choice(levels)} "
+                    f"{rng.choice(users)} PUBLISH /home/{rng.choice(users)}/file{rng.randrange(10000)}.txt "
+                    f"{rng.randrange(100000)}us\n")
+    samples.append(path)
+
+    path = os.path.join(directory, "scores.csv")
+    with open(path, "w") as f:
+        f.write("user,ip,port,bytes,millis,ok\n")
+        while f.tell() < size:
+            f.write(f"{rng.choice(users)},10.0.{rng.randrange(256)}.{rng.randrange(256)},"
+                    f"{rng.randrange(1024, 65536)},{rng.randrange(10 ** 9)},{rng.randrange(10 ** 5)},"
+                    f"{rng.randrange(2)}\n")
+    samples.append(path)
+
+    path = os.path.join(directory, "random.bin")
+    with open(path, "wb") as f:
+        f.write(os.urandom(size))
+    samples.append(path)
+    return samples
+
+
+def measure(path, codec):
+    """Retorna (tamaño comprimido, MB/s comprimiendo, MB/s descomprimiendo)."""
+    size = os.path.getsize(path)
+    sink = MemorySocket()
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        send_stream(sink, f, 0, size, codec)
+    compress_s = time.perf_counter() - start
+
+    compressed = sink.data.getvalue()
+    decoder = StreamDecoder(codec)
+    start = time.perf_counter()
+    restored = 0
+    for offset in range(0, len(compressed), 65536):
+        for chunk in decoder.feed(compressed[offset:offset + 65536]):
+            restored += len(chunk)
+    decompress_s = time.perf_counter() - start
+    assert restored == size, f"{path}: {codec} restored {restored} of {size} bytes"
+    return len(compressed), size / 1e6 / compress_s, size / 1e6 / decompress_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de la compresión de las transferencias")
+    parser.add_argument("-s", "--size", type=int, default=32, help="MiB de cada fichero generado")
+    parser.add_argument("files", nargs="*")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        files = args.files or generate_samples(directory, args.size * 1024 * 1024)
+        header = "".join(f"  {link:>6} Mbit/s" for link in LINKS)
+        print(f"{'fichero':<14} {'códec':<5} {'ratio':>6} {'comp MB/s':>10} {'desc MB/s':>10} "
+              f"{'equilibrio':>14}{header}")
+        for path in files:
+            size = os.path.getsize(path)
+            name = os.path.basename(path)[:14]
+            # Sin compresión, como referencia
+            times = "".join(f"  {size * 8 / 1e6 / link:>12.2f} s" for link in LINKS)
+            print(f"{name:<14} {'-':<5} {1:>6.3f} {'-':>10} {'-':>10} {'-':>14}{times}")
+            for codec in CODECS:
+                compressed, compress_mbs, decompress_mbs = measure(path, codec)
+                ratio = compressed / size if size else 1
+                # Punto de equilibrio: por debajo de este enlace (en Mbit/s) compensa comprimir
+                break_even = min(compress_mbs, decompress_mbs) * 8 if ratio < 1 else 0
+                cpu_s = size / 1e6 / min(compress_mbs, decompress_mbs)
+                times = "".join(f"  {max(cpu_s, compressed * 8 / 1e6 / link):>12.2f} s" for link in LINKS)
+                print(f"{'':<14} {codec:<5} {ratio:>6.3f} {compress_mbs:>10.1f} {decompress_mbs:>10.1f} "
+                      f"{break_even:>7.0f} Mbit/s{times}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Caché local de descargas direccionada por contenido.
+
+Cada fichero descargado cuyo hash de contenido se conoce (ver manifest.py) se guarda una vez en
+'directory'/objects con el hash como nombre. Antes de descargar, GET_FILE y GET_MULTIFILE miran
+si el contenido ya está en la caché (aunque se descargara con otro nombre, desde otra ruta o
+por otro usuario del cliente) y, si está, crean el fichero local con un reflink o una copia, sin
+pasar por la red. El tamaño total está acotado y se expulsan primero los contenidos usados hace
+más tiempo (LRU).
+
+El índice (tamaño, ruta de origen y último uso de cada contenido, y las estadísticas) es un json
+compartido por todos los clientes que usan el mismo directorio, así que se modifica siempre con
+un cerrojo de fichero.
+"""
+import fcntl
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+from manifest import build_manifest
+
+# ioctl de Linux que clona un fichero compartiendo sus bloques (reflink en btrfs, xfs...)
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst):
+    """Crea 'dst' con el contenido de 'src' con un reflink o, si no se puede, con una copia."""
+    with open(src, "rb") as fin, open(dst, "wb") as fout:
+        try:
+            fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            return "reflink"
+        except OSError:
+            shutil.copyfileobj(fin, fout, 1024 * 1024)
+            return "copy"
+
+
+class ContentCache:
+
+    def __init__(self, directory, max_bytes):
+        self._directory = directory
+        self._lock = threading.Lock()
+        # Tamaño máximo de la caché (0 la desactiva)
+        self.max_bytes = max_bytes
+
+    def _object_path(self, content_hash):
+        return os.path.join(self._directory, "objects", content_hash[:2], content_hash)
+
+    @contextmanager
+    def _index(self):
+        """Índice de la caché, bloqueado para este hilo y para los demás procesos; se guarda al salir."""
+        with self._lock:
+            os.makedirs(self._directory, exist_ok=True)
+            with open(os.path.join(self._directory, "index.lock"), "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                index_path = os.path.join(self._directory, "index.json")
+                try:
+                    with open(index_path) as f:
+                        index = json.load(f)
+                except (OSError, ValueError):
+                    index = {}
+                index.setdefault("entries", {})
+                index.setdefault("stats", {"hits": 0, "misses": 0, "hit_bytes": 0, "evictions": 0})
+                yield index
+                with open(index_path + ".tmp", "w") as f:
+                    json.dump(index, f)
+                os.replace(index_path + ".tmp", index_path)
+
+    def fetch(self, content_hash, local_path, size=None):
+        """
+        Si el contenido 'content_hash' (de 'size' bytes, si se conoce) está en la caché, crea
+        'local_path' a partir de él y retorna True. Se usa un reflink o, si no se puede, una copia,
+        pero nunca un enlace duro: una descarga posterior a 'local_path' escribiría en el objeto de
+        la caché. Antes de servirlo se comprueba que lo creado tiene el hash pedido; si no, el
+        objeto está corrupto y se expulsa.
+        """
+        if not self.max_bytes or not content_hash:
+            return False
+        with self._index() as index:
+            entry = index["entries"].get(content_hash)
+            object_path = self._object_path(content_hash)
+            if entry and ((size is not None and entry["size"] != size) or not os.path.isfile(object_path) or
+                          os.path.getsize(object_path) != entry["size"]):
+                # El objeto no corresponde al índice: se olvida
+                index["entries"].pop(content_hash)
+                entry = None
+            if entry is None:
+                index["stats"]["misses"] += 1
+                return False
+
+            temp_path = f"{local_path}.{os.getpid()}.cache"
+            try:
+                clone_file(object_path, temp_path)
+                if build_manifest(temp_path)["hash"] != content_hash:
+                    # El objeto se ha modificado (por ejemplo, a través de un enlace duro creado por
+                    # una versión anterior): se expulsa
+                    os.remove(temp_path)
+                    index["entries"].pop(content_hash)
+                    index["stats"]["evictions"] += 1
+                    index["stats"]["misses"] += 1
+                    try:
+                        os.remove(object_path)
+                    except OSError:
+                        pass
+                    return False
+                os.replace(temp_path, local_path)
+            except OSError:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                index["stats"]["misses"] += 1
+                return False
+            entry["last_used"] = time.time()
+            index["stats"]["hits"] += 1
+            index["stats"]["hit_bytes"] += entry["size"]
+            return True
+
+    def store(self, content_hash, path, source):
+        """
+        Guarda en la caché el fichero 'path', ya comprobado, con hash 'content_hash'. 'source'
+        indica de dónde se descargó. Después expulsa los contenidos menos usados hasta que la
+        caché vuelve a caber en max_bytes.
+        """
+        size = os.path.getsize(path)
+        if not self.max_bytes or not content_hash or size > self.max_bytes:
+            return
+        with self._index() as index:
+            object_path = self._object_path(content_hash)
+            if content_hash not in index["entries"] or not os.path.isfile(object_path):
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                # Nunca un enlace duro: el usuario puede modificar su fichero descargado
+                clone_file(path, object_path + ".tmp")
+                os.chmod(object_path + ".tmp", 0o444)
+                os.replace(object_path + ".tmp", object_path)
+            index["entries"][content_hash] = {"size": size, "source": source, "last_used": time.time()}
+            self._evict(index)
+
+    def _evict(self, index):
+        entries = index["entries"]
+        total = sum(entry["size"] for entry in entries.values())
+        for content_hash in sorted(entries, key=lambda h: entries[h]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            total -= entries.pop(content_hash)["size"]
+            index["stats"]["evictions"] += 1
+            try:
+                os.remove(self._object_path(content_hash))
+            except OSError:
+                pass
+
+    def resize(self, max_bytes):
+        """Cambia el tamaño máximo y expulsa lo que ya no cabe."""
+        self.max_bytes = max_bytes
+        with self._index() as index:
+            self._evict(index)
+
+    def stats(self):
+        """Estadísticas de la caché: aciertos, fallos, bytes servidos, expulsiones y ocupación."""
+        with self._index() as index:
+            stats = dict(index["stats"])
+            stats["entries"] = len(index["entries"])
+            stats["size"] = sum(entry["size"] for entry in index["entries"].values())
+        stats["max_bytes"] = self.max_bytes
+        return stats
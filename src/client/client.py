@@ -1,46 +1,195 @@
 import threading
 import argparse
+import fnmatch
 import socket
 import signal
 import os
 import io
+import hashlib
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import redirect_stdout
 from enum import Enum
 from zeep import Client
 
-from netools import recv_cstring
+from cache import ContentCache
+from compression import CODECS, open_transfer
+from events import EventListener
+from metrics import NO_TRANSFER, ProgressDisplay, TransferMetrics
+from manifest import HASH_PREFIX, ManifestCache, PartialFiles, content_hash, decode_pieces, piece_bounds
+from netools import CStringReader
+from ratelimit import UploadShaper
+from scheduler import TransferScheduler
 from server_svc import ServerThread
 
-def download_range(ip, port, remote_filepath, seeder_id, total_seeders):
-    """Descarga la porción asignada de un seeder y la guarda en un fichero temporal."""
+def user_hash(user):
+    """Hash FNV-1a (32 bits) del nombre de usuario, idéntico a user_hash() de claves.c."""
+    h = 2166136261
+    for byte in user.encode():
+        h = ((h ^ byte) * 16777619) & 0xFFFFFFFF
+    return h
+
+
+def scan_folder(folder):
+    """
+    Recorre 'folder' (recursivamente) y retorna {ruta absoluta: [mtime_ns, tamaño]} de los
+    ficheros que se pueden publicar, y el número de ficheros descartados (rutas de más de 255
+    caracteres o con espacios, que no se pueden publicar con PUBLISH).
+    """
+    found = {}
+    skipped = 0
+    pending = [os.path.abspath(folder)]
+    while pending:
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file():
+                    if len(entry.path) > 255 or " " in entry.path:
+                        skipped += 1
+                        continue
+                    st = entry.stat()
+                    found[entry.path] = [st.st_mtime_ns, st.st_size]
+    return found, skipped
+
+
+def download_range(ip, port, remote_filepath, seeder_id, total_seeders, codecs=(), transfer=NO_TRANSFER):
+    """
+    Descarga la porción 'seeder_id' (de 'total_seeders') del fichero de un seeder y la guarda en
+    un fichero temporal. Si se ofrecen 'codecs', el seeder puede enviarla comprimida. Retorna
+    (ok, bytes recibidos, milisegundos) para informar al servidor del directorio. La conexión se
+    contabiliza en 'transfer' (metrics.Transfer).
+    """
     temp_filename = f"{seeder_id}.temp"
+    received = 0
+    start = time.monotonic()
+    connection = transfer.connection(f"{ip}:{port}")
+
+    def done(ok):
+        connection.close(ok)
+        return ok, received, int((time.monotonic() - start) * 1000)
+
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect((ip, int(port)))
-        # Enviar comando GET_MULTIFILE
-        s.sendall("GET_MULTIFILE\0".encode())
-        s.sendall((remote_filepath + "\0").encode())
-        # Envío de parámetros: seeder id y total de seeders
-        s.sendall((str(seeder_id) + "\0").encode())
-        s.sendall((str(total_seeders) + "\0").encode())
-
-        # Esperamos confirmación del seeder (0 indica OK)
-        response = int.from_bytes(s.recv(1), byteorder='big')
+        # Enviar comando GET_MULTIFILE con el seeder id y el total de seeders, y esperar
+        # confirmación del seeder (0 indica OK)
+        response, s, reader = open_transfer(ip, port, "GET_MULTIFILE",
+                                            [remote_filepath, str(seeder_id), str(total_seeders)], codecs)
         if response != 0:
-            s.close()
-            return False
+            return done(False)
+        connection.connected()
 
         # Descargamos hasta que se cierre la conexión
         with open(temp_filename, "wb") as ftemp:
             while True:
-                chunk = s.recv(1024)
+                chunk = reader.recv(65536)
                 if not chunk:
                     break
                 ftemp.write(chunk)
+                received += len(chunk)
+                connection.received(len(chunk))
         s.close()
-        return True
+        return done(True)
     except Exception as e:
-        return False
+        return done(False)
+
+
+def fetch_manifest(ip, port, remote_filepath):
+    """
+    Pide a un seeder el manifiesto de un fichero. Retorna el manifiesto si es coherente (el hash
+    del contenido corresponde a las piezas) o None si el seeder no lo tiene o falla.
+    """
+    try:
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect((ip, int(port)))
+            s.sendall(("GET_MANIFEST\0" + remote_filepath + "\0").encode())
+            reader = CStringReader(s)
+            if reader.read_byte() != 0:
+                return None
+            manifest = {"hash": reader.read_cstring(), "size": int(reader.read_cstring()),
+                        "piece_size": int(reader.read_cstring())}
+            manifest["pieces"] = [reader.read_cstring() for _ in range(int(reader.read_cstring()))]
+        finally:
+            s.close()
+    except Exception:
+        return None
+
+    size, piece_size, pieces = manifest["size"], manifest["piece_size"], manifest["pieces"]
+    if piece_size <= 0 or len(pieces) != (size + piece_size - 1) // piece_size or \
+            content_hash(size, piece_size, pieces) != manifest["hash"]:
+        return None
+    return manifest
+
+
+def download_pieces(ip, port, remote_filepath, manifest, pieces, local_filepath, on_piece=None, codecs=(),
+                    transfer=NO_TRANSFER):
+    """
+    Descarga de un seeder las piezas 'pieces' del fichero descrito por 'manifest' y escribe en
+    su sitio de 'local_filepath' las que coinciden con su hash. Las piezas consecutivas se piden
+    en un solo GET_RANGE (comprimido si se ofrecen 'codecs') y se comprueban según llegan, ya
+    descomprimidas; tras escribir cada una se llama a on_piece(pieza). Retorna (piezas
+    correctas, bytes recibidos, milisegundos). Cada GET_RANGE se contabiliza en 'transfer'.
+    """
+    verified = set()
+    received = 0
+    start = time.monotonic()
+
+    # Tramos de piezas consecutivas: [primera, última]
+    runs = []
+    for piece in sorted(pieces):
+        if runs and runs[-1][1] == piece - 1:
+            runs[-1][1] = piece
+        else:
+            runs.append([piece, piece])
+
+    try:
+        with open(local_filepath, "r+b") as fout:
+            for first, last in runs:
+                offset = piece_bounds(manifest, first)[0]
+                end = sum(piece_bounds(manifest, last))
+                connection = transfer.connection(f"{ip}:{port}")
+                try:
+                    response, s, reader = open_transfer(ip, port, "GET_RANGE",
+                                                        [remote_filepath, str(offset), str(end - offset)], codecs)
+                except Exception:
+                    connection.close(False)
+                    raise
+                if response != 0:
+                    connection.close(False)
+                    break
+                connection.connected()
+                complete = False
+                try:
+                    for piece in range(first, last + 1):
+                        piece_offset, length = piece_bounds(manifest, piece)
+                        data = bytearray()
+                        while len(data) < length:
+                            chunk = reader.recv(min(65536, length - len(data)))
+                            if not chunk:
+                                break
+                            data.extend(chunk)
+                            connection.received(len(chunk))
+                        received += len(data)
+                        if len(data) < length:
+                            break
+                        # Una pieza que no coincide se descarta y se pide a otro seeder
+                        if hashlib.sha256(data).hexdigest() == manifest["pieces"][piece]:
+                            fout.seek(piece_offset)
+                            fout.write(data)
+                            fout.flush()
+                            verified.add(piece)
+                            if on_piece:
+                                on_piece(piece)
+                    else:
+                        complete = True
+                finally:
+                    s.close()
+                    connection.close(complete)
+    except Exception:
+        pass
+    return verified, received, int((time.monotonic() - start) * 1000)
 
 
 class client:
@@ -59,8 +208,50 @@ class client:
     _input_file = None
     _server = None
     _port = -1
+    # Servidores del directorio particionado: [(ip, puerto), ...]. Sin --shards hay uno solo,
+    # el indicado con -s y -p
+    _shards = []
     _listen_thread: ServerThread = None
     _current_user_connected = None
+    # Suscripción a los cambios del directorio (SUBSCRIBE), si la hay
+    _subscription: EventListener = None
+    # Segundos entre HEARTBEAT mientras hay un usuario conectado (0 para no enviarlos)
+    _heartbeat_interval = 10
+    # Máximo de seeders a los que GET_MULTIFILE se conecta a la vez (SET MAX_CONNECTIONS)
+    _max_connections = 4
+    # Directorio con el índice de las carpetas compartidas con SHARE (~/.ssdd o $SSDD_HOME)
+    _index_dir = os.environ.get("SSDD_HOME") or os.path.join(os.path.expanduser("~"), ".ssdd")
+    # Ficheros por petición de PUBLISH_BATCH / DELETE_BATCH
+    _batch_size = 1000
+    # Manifiestos (hash de cada pieza) de los ficheros publicados, guardados en _index_dir
+    _manifests = ManifestCache(os.path.join(_index_dir, "manifests"))
+    # Modo enjambre (SET SWARM): mientras se descarga un fichero, se anuncian al directorio las
+    # piezas ya comprobadas (como mucho cada _announce_interval segundos) y se sirven a los demás
+    _swarm = 1
+    _announce_interval = 0.5
+    _partials = PartialFiles()
+    # Códecs que se ofrecen a los seeders, por orden de preferencia (SET COMPRESSION; vacío para
+    # descargar sin compresión)
+    _compression = ()
+    # Límite de subida del ServerThread, en KiB/s (0 sin límite): en total, repartido a partes
+    # iguales entre las conexiones activas (SET UPLOAD_LIMIT), y por conexión (SET UPLOAD_CONN_LIMIT)
+    _upload_limit = 0
+    _upload_conn_limit = 0
+    _uploads = UploadShaper()
+    # Descargas de GET_BATCH a la vez, en total (SET BATCH_CONNECTIONS) y con cada seeder
+    # (SET BATCH_PEER_CONNECTIONS)
+    _batch_connections = 8
+    _batch_peer_connections = 2
+    # Caché de descargas por hash de contenido, compartida por todos los usuarios que usan el
+    # mismo _index_dir. Su tamaño máximo se cambia con SET CACHE_MB (0 la desactiva)
+    _cache_mb = 1024
+    _cache = ContentCache(os.path.join(_index_dir, "cache"), _cache_mb * 1024 * 1024)
+    # Métricas de las descargas (METRICS), que además se pueden escribir como líneas JSON en un
+    # fichero (SET METRICS_FILE), y progreso de las descargas activas en el terminal (SET PROGRESS)
+    _metrics = TransferMetrics()
+    _metrics_file = ""
+    _progress = 1
+    _progress_display = ProgressDisplay(_metrics)
     # El web service siempre se conecta al localhost
     try:
         _ws_client = Client(wsdl="http://127.0.0.1:8000/?wsdl")
@@ -83,14 +274,61 @@ class client:
                 pass
             return "00/00/0000 00:00:00"
 
+    @staticmethod
+    def _shard_of(user):
+        """Servidor del directorio al que pertenece el usuario (el mismo reparto que hace el servidor)."""
+        if len(client._shards) <= 1 or user is None:
+            return 0
+        return (user_hash(user) >> 16) % len(client._shards)
+
+    @staticmethod
+    def _open(user=None, shard=None):
+        """Abre una conexión con el servidor 'shard' o, si no se indica, con el del usuario."""
+        if shard is None:
+            shard = client._shard_of(user)
+        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sck.connect(client._shards[shard])
+        except Exception:
+            sck.close()
+            raise
+        return sck
+
+    @staticmethod
+    def _fan_out(request):
+        """
+        Ejecuta request(shard) contra todos los servidores del directorio en paralelo y retorna
+        sus resultados en orden. Si alguno falla, se propaga su excepción.
+        """
+        if len(client._shards) == 1:
+            return [request(0)]
+        with ThreadPoolExecutor(max_workers=len(client._shards)) as pool:
+            return list(pool.map(request, range(len(client._shards))))
+
+    @staticmethod
+    def _merge(results, empty=None):
+        """
+        Junta las respuestas (código, total, elementos) de una consulta enviada a todos los
+        servidores. 'empty' es el código con el que un servidor indica que no tiene resultados,
+        que no es un error. Cualquier otro error se devuelve tal cual, empezando por el del
+        servidor del usuario conectado, que es el único que ha podido comprobarlo.
+        """
+        home = client._shard_of(client._current_user_connected)
+        for response, total, items in [results[home]] + results:
+            if response not in (0, empty):
+                return response, total, items
+        if all(response != 0 for response, _, _ in results):
+            return empty, 0, []
+        items = [item for response, _, shard_items in results if response == 0 for item in shard_items]
+        return 0, len(items), items
+
     @staticmethod
     def register(user):
         if len(user) < 0 or len(user) > 255:
             print("Error: Invalid username length")
             return client.RC.USER_ERROR
 
-        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sck.connect((client._server, client._port))
+        sck = client._open(user)
 
         try:
             sck.sendall("REGISTER\0".encode())
@@ -124,8 +362,7 @@ class client:
             print("Error: Invalid username length")
             return client.RC.USER_ERROR
 
-        sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sck.connect((client._server, client._port))
+        sck = client._open(user)
 
         try:
             sck.sendall("UNREGISTER\0".encode())
@@ -165,50 +402,36 @@ class client:
             print("c> CONNECT FAIL, USER ALREADY CONNECTED")
             return client.RC.USER_ERROR
 
-        sck = None
         success = False
         try:
-            client._listen_thread = ServerThread()
+            client._listen_thread = ServerThread(heartbeat=client.heartbeat,
+                                                 heartbeat_interval=client._heartbeat_interval,
+                                                 manifests=client._manifests, partials=client._partials,
+                                                 shaper=client._uploads)
             client._listen_thread.start()
             port = client._listen_thread.get_port()
 
             # AHORA ya podemos enviar cosas al servidor
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((client._server, client._port))
-
-            sck.sendall("CONNECT\0".encode())
-            sck.sendall((client.get_wsdatetime() + "\0").encode())
-            username = user + "\0"
-            sck.sendall(username.encode())
-            listen_port = str(port) + "\0"
-            sck.sendall(listen_port.encode())
-
-            response = int.from_bytes(sck.recv(1), byteorder='big')
+            response = client._send_connect(user, port)
             if response == 0:
                 print("c> CONNECT OK")
                 success = True
                 client._current_user_connected = user
-                sck.close()
                 return client.RC.OK
             elif response == 1:
                 print("c> CONNECT FAIL, USER DOES NOT EXIST")
-                sck.close()
                 return client.RC.USER_ERROR
             elif response == 2:
                 print("c> USER ALREADY CONNECTED")
-                sck.close()
                 return client.RC.USER_ERROR
             elif response == 3:
                 print("c> CONNECT FAIL")
-                sck.close()
                 return client.RC.ERROR
             else:
                 print("c> UNKNOWN RESPONSE FROM SERVER: ", response)
         except Exception as e:
             print("c> CONNECT CLIENT ERROR - ", str(e))
         finally:
-            if sck:
-                sck.close()
             if not success and client._listen_thread:
                 client._listen_thread.kill()
                 client._listen_thread = None
@@ -216,6 +439,41 @@ class client:
 
         return client.RC.ERROR
 
+    @staticmethod
+    def _send_connect(user, port):
+        """Envía CONNECT con el puerto de escucha 'port' y retorna el código de respuesta."""
+        sck = client._open(user)
+        try:
+            sck.sendall("CONNECT\0".encode())
+            sck.sendall((client.get_wsdatetime() + "\0").encode())
+            sck.sendall((user + "\0").encode())
+            sck.sendall((str(port) + "\0").encode())
+            return int.from_bytes(sck.recv(1), byteorder='big')
+        finally:
+            sck.close()
+
+    @staticmethod
+    def heartbeat():
+        """
+        Renueva el lease del usuario conectado. Lo llama el hilo de escucha cada
+        _heartbeat_interval segundos. Si el lease ya había caducado (por ejemplo, porque el
+        cliente ha estado suspendido), vuelve a conectar al usuario con el mismo puerto.
+        """
+        user = client._current_user_connected
+        listen_thread = client._listen_thread
+        if user is None or listen_thread is None:
+            return
+        sck = client._open(user)
+        try:
+            sck.sendall("HEARTBEAT\0".encode())
+            sck.sendall((client.get_wsdatetime() + "\0").encode())
+            sck.sendall((user + "\0").encode())
+            response = int.from_bytes(sck.recv(1), byteorder='big')
+        finally:
+            sck.close()
+        if response == 2 and client._current_user_connected == user:
+            client._send_connect(user, listen_thread.get_port())
+
     @staticmethod
     def disconnect(user):
         if len(user) < 0 or len(user) > 255:
@@ -226,8 +484,7 @@ class client:
         try:
             # Ahora, tenemos primero que mandar el mensaje al servidor. En caso de
             # que el servidor no esté disponible, no podremos cerrar el socket de escucha
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((client._server, client._port))
+            sck = client._open(user)
             sck.sendall("DISCONNECT\0".encode())
             sck.sendall((client.get_wsdatetime() + "\0").encode())
             username = user + "\0"
@@ -299,11 +556,14 @@ class client:
             print("c> PUBLISH FAIL, USER NOT CONNECTED")
             return client.RC.USER_ERROR
 
+        # Hash del contenido, para que los demás clientes encuentren el fichero por su contenido y
+        # comprueben cada pieza al descargarlo
+        file_hash = client._content_hash(fileName)
+
         sck = None
         try:
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((client._server, client._port))
-            sck.sendall("PUBLISH\0".encode())
+            sck = client._open(client._current_user_connected)
+            sck.sendall("PUBLISH2\0".encode())
             sck.sendall((client.get_wsdatetime() + "\0").encode())
             username = client._current_user_connected + "\0"
             sck.sendall(username.encode())
@@ -314,8 +574,14 @@ class client:
             # Y ahora la descripción
             description = description + "\0"
             sck.sendall(description.encode())
-
-            response = int.from_bytes(sck.recv(1), byteorder='big')
+            # Y por último el hash del contenido
+            sck.sendall((file_hash + "\0").encode())
+
+            # Si el servidor cierra sin responder, el fichero no se ha publicado
+            data = sck.recv(1)
+            if not data:
+                raise ConnectionError("connection closed by server")
+            response = data[0]
             if response == 0:
                 print("c> PUBLISH OK")
                 sck.close()
@@ -375,8 +641,7 @@ class client:
 
         sck = None
         try:
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((client._server, client._port))
+            sck = client._open(client._current_user_connected)
             sck.sendall("DELETE\0".encode())
             sck.sendall((client.get_wsdatetime() + "\0").encode())
             username = client._current_user_connected + "\0"
@@ -418,48 +683,212 @@ class client:
         return client.RC.ERROR
 
     @staticmethod
-    def listusers():
+    def _send_batch(operation, entries):
+        """
+        Envía PUBLISH_BATCH2 o DELETE_BATCH con 'entries' (tuplas de campos) en peticiones de
+        _batch_size ficheros. Retorna (código de respuesta, lista con el resultado de cada
+        entrada); si una petición falla, se detiene y retorna su código.
+        """
+        results = []
+        for start in range(0, len(entries), client._batch_size):
+            chunk = entries[start:start + client._batch_size]
+            sck = client._open(client._current_user_connected)
+            try:
+                request = [operation, client.get_wsdatetime(), client._current_user_connected, str(len(chunk))]
+                request += [field for entry in chunk for field in entry]
+                sck.sendall("".join(field + "\0" for field in request).encode())
+                reader = CStringReader(sck)
+                response = reader.read_byte()
+                if response != 0:
+                    return response, results
+                results += [int(digit) for digit in reader.read_cstring()]
+            finally:
+                sck.close()
+        return 0, results
+
+    @staticmethod
+    def _index_path():
+        host, port = client._shards[0]
+        return os.path.join(client._index_dir, f"share-{host}_{port}-{client._current_user_connected}.json")
+
+    @staticmethod
+    def _content_hash(path):
+        """
+        Hash del contenido de 'path' (su manifiesto queda en caché para servirlo después), o "" si
+        no se puede calcular: el fichero se publica entonces sin hash.
+        """
+        try:
+            return client._manifests.get(path)["hash"]
+        except Exception:
+            return ""
+
+    @staticmethod
+    def share(folder):
+        """
+        Comparte todos los ficheros de 'folder'. En ~/.ssdd se guarda, por cada carpeta, el
+        mtime y el tamaño de los ficheros publicados, de modo que al volver a compartirla solo se
+        envían los ficheros nuevos (PUBLISH_BATCH2), los que han desaparecido (DELETE_BATCH) y los
+        que han cambiado de mtime o de tamaño (se borran y se vuelven a publicar).
+        """
         if client._current_user_connected is None:
-            print("c> LIST_USERS FAIL, USER NOT CONNECTED")
+            print("c> SHARE FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+        if not os.path.isdir(folder):
+            print("c> SHARE FAIL, FOLDER DOES NOT EXIST")
             return client.RC.USER_ERROR
 
-        sck = None
+        folder = os.path.abspath(folder)
         try:
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((client._server, client._port))
-            sck.sendall("LIST_USERS\0".encode())
-            sck.sendall((client.get_wsdatetime() + "\0").encode())
-            username = client._current_user_connected + "\0"
-            sck.sendall(username.encode())
+            index = {}
+            if os.path.exists(client._index_path()):
+                with open(client._index_path()) as f:
+                    index = json.load(f)
+
+            # Si el servidor tiene menos ficheros del usuario que los que dice el índice (por
+            # ejemplo, porque se ha reiniciado sin persistencia), el índice no vale y se vuelve
+            # a publicar todo
+            response, total, _ = client._fetch_list("LIST_CONTENT_PAGE", [client._current_user_connected], 1, (0, 1))
+            if response != 0 or total < sum(len(files) for files in index.values()):
+                index = {}
+
+            known = index.get(folder, {})
+            current, skipped = scan_folder(folder)
+            added = [path for path in current if path not in known]
+            modified = [path for path in current if path in known and current[path] != known[path]]
+            removed = [path for path in known if path not in current]
+
+            # Los modificados se borran y se vuelven a publicar con la nueva descripción del contenido
+            response, results = client._send_batch("DELETE_BATCH", [(path,) for path in removed + modified])
+            deleted = {path for path, result in zip(removed + modified, results) if result in (0, 3)}
+            published = set()
+            if response == 0:
+                to_publish = added + [path for path in modified if path in deleted]
+                description = "shared from " + os.path.basename(folder)
+                response, results = client._send_batch(
+                    "PUBLISH_BATCH2", [(path, description, client._content_hash(path)) for path in to_publish])
+                published = {path for path, result in zip(to_publish, results) if result in (0, 3)}
+
+            # El índice se actualiza con lo que el servidor ha aceptado, aunque haya fallado algo: un
+            # modificado que no se ha podido borrar conserva su mtime y su tamaño anteriores (se
+            # reintentará), y uno que se ha borrado pero no publicado sale del índice (será nuevo)
+            index[folder] = {path: stat for path, stat in current.items()
+                             if path in published or (path in known and path not in modified)}
+            index[folder].update({path: known[path] for path in removed + modified if path not in deleted})
+            os.makedirs(client._index_dir, exist_ok=True)
+            with open(client._index_path(), "w") as f:
+                json.dump(index, f)
 
-            response = int.from_bytes(sck.recv(1), byteorder='big')
             if response == 0:
-                # Éxito
-                print("c> LIST_USERS OK")
+                unchanged = len(current) - len(added) - len(modified)
+                print(f"c> SHARE OK, {len(published.intersection(added))} PUBLISHED, "
+                      f"{len(published.intersection(modified))} MODIFIED, {len(deleted.intersection(removed))} DELETED, "
+                      f"{unchanged} UNCHANGED, {skipped} SKIPPED")
+                return client.RC.OK
+            elif response == 1:
+                print("c> SHARE FAIL, USER DOES NOT EXIST")
+                return client.RC.USER_ERROR
+            elif response == 2:
+                print("c> SHARE FAIL, USER NOT CONNECTED")
+                return client.RC.USER_ERROR
+            else:
+                print("c> SHARE FAIL")
+                return client.RC.USER_ERROR
+        except Exception as e:
+            print("c> SHARE CLIENT ERROR -", str(e))
 
-                num_users_str = recv_cstring(sck)
-                try:
-                    num_users = int(num_users_str)
-                except ValueError:
-                    print("c> LIST_USERS CLIENT ERROR - invalid num_users: ", num_users_str)
-                    return client.RC.ERROR
+        return client.RC.ERROR
 
-                # Leemos los datos de cada usuario: name, ip, port (3 C-strings por usuario)
-                users = []
-                for _ in range(num_users):
-                    username = recv_cstring(sck)
-                    ip_str = recv_cstring(sck)
-                    port = recv_cstring(sck)
-                    users.append((username, ip_str, port))
+    @staticmethod
+    def _fetch_list(operation, args, fields, page=None, shard=None):
+        """
+        Envía una petición de listado (LIST_USERS o LIST_CONTENT, o sus variantes _PAGE si se
+        indica page=(offset, limit), o SEARCH) y lee la respuesta completa con un lector con buffer.
+        La petición va al servidor 'shard' o, si no se indica, al del usuario consultado.
+        Retorna (código de respuesta, total de elementos, lista de tuplas de 'fields' cadenas).
+        """
+        sck = client._open(args[0] if args else None, shard)
+        try:
+            request = [operation, client.get_wsdatetime(), client._current_user_connected] + list(args)
+            if page is not None:
+                request += [str(page[0]), str(page[1])]
+            sck.sendall("".join(field + "\0" for field in request).encode())
+
+            reader = CStringReader(sck)
+            response = reader.read_byte()
+            if response != 0:
+                return response, 0, []
+
+            total = None
+            if page is not None:
+                total = int(reader.read_cstring())
+            count_str = reader.read_cstring()
+            try:
+                count = int(count_str)
+            except ValueError:
+                raise ValueError("invalid number of elements: " + count_str)
+            items = [tuple(reader.read_cstring() for _ in range(fields)) for _ in range(count)]
+            return response, (count if total is None else total), items
+        finally:
+            sck.close()
 
-                max_user_len = max(len(u[0]) for u in users) if users else 0
-                max_ip_len = max(len(u[1]) for u in users) if users else 0
+    @staticmethod
+    def _fetch_pages(operation, args, fields, page_size, shard=None):
+        """
+        Generador que recorre un listado paginado y produce (código, total, elementos) por
+        cada página. Se detiene tras un error o cuando se han recibido todos los elementos.
+        """
+        offset = 0
+        while True:
+            response, total, items = client._fetch_list(operation, args, fields, (offset, page_size), shard)
+            yield response, total, items
+            offset += len(items)
+            if response != 0 or not items or offset >= total:
+                return
+
+    @staticmethod
+    def _print_users(users, first_index=0):
+        max_user_len = max(len(u[0]) for u in users) if users else 0
+        max_ip_len = max(len(u[1]) for u in users) if users else 0
 
-                for i, (username, ip_str, port) in enumerate(users):
-                    print(f"\tUSER{i}: {username.ljust(max_user_len)}\t{ip_str.ljust(max_ip_len)}\t{port}")
+        for i, (username, ip_str, port) in enumerate(users, first_index):
+            print(f"\tUSER{i}: {username.ljust(max_user_len)}\t{ip_str.ljust(max_ip_len)}\t{port}")
+
+    @staticmethod
+    def _print_files(files, first_index=0):
+        for i, (filename,) in enumerate(files, first_index):
+            print(f"\tFILE{i}: {filename}")
+
+    @staticmethod
+    def listusers(page_size=None):
+        if client._current_user_connected is None:
+            print("c> LIST_USERS FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+
+        try:
+            # Sin tamaño de página se pide la lista completa a todos los servidores a la vez; con
+            # él, se recorren los servidores uno a uno y se muestran sus páginas según llegan para
+            # no tener que mantener toda la lista en memoria
+            if page_size is None:
+                pages = [client._merge(client._fan_out(lambda shard: client._fetch_list("LIST_USERS", [], 3,
+                                                                                         shard=shard)))]
+            else:
+                pages = (page for shard in range(len(client._shards))
+                         for page in client._fetch_pages("LIST_USERS_PAGE", [], 3, page_size, shard))
+
+            shown = None
+            for response, _, users in pages:
+                if response != 0:
+                    break
+                if shown is None:
+                    # Éxito
+                    print("c> LIST_USERS OK")
+                    shown = 0
+                client._print_users(users, shown)
+                shown += len(users)
+            else:
                 return client.RC.OK
 
-            elif response == 1:
+            if response == 1:
                 print("c> LIST_USERS FAIL, USER DOES NOT EXIST")
                 return client.RC.USER_ERROR
 
@@ -478,14 +907,9 @@ class client:
         except Exception as e:
             print("c> LIST_USERS CLIENT ERROR -", str(e))
             return client.RC.ERROR
-        finally:
-            if sck:
-                sck.close()
-
-        return client.RC.ERROR
 
     @staticmethod
-    def listcontent(user):
+    def listcontent(user, page_size=None):
         if len(user) < 0 or len(user) > 255:
             print("Error: Invalid username length")
             return client.RC.USER_ERROR
@@ -494,44 +918,26 @@ class client:
             print("c> LIST_CONTENT FAIL, USER NOT CONNECTED")
             return client.RC.USER_ERROR
 
-        sck = None
         try:
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((client._server, client._port))
-            sck.sendall("LIST_CONTENT\0".encode())
-            sck.sendall((client.get_wsdatetime() + "\0").encode())
-            username = client._current_user_connected + "\0"
-            sck.sendall(username.encode())
-
-            # Enviamos el nombre de usuario del que queremos listar el contenido
-            username = user + "\0"
-            sck.sendall(username.encode())
-
-            response = int.from_bytes(sck.recv(1), byteorder='big')
-            if response == 0:
-                # Éxito
-                print("c> LIST_CONTENT OK")
-
-                num_files_str = recv_cstring(sck)
-                try:
-                    num_files = int(num_files_str)
-                except ValueError:
-                    print("c> LIST_CONTENT CLIENT ERROR - invalid num_files: ", num_files_str)
-                    return client.RC.ERROR
-
-                # Leemos los datos de cada fichero: name, description (2 C-strings por fichero)
-                files = []
-                for _ in range(num_files):
-                    filename = recv_cstring(sck)
-                    files.append(filename)
-
-                max_file_len = max(len(f[0]) for f in files) if files else 0
+            if page_size is None:
+                pages = [client._fetch_list("LIST_CONTENT", [user], 1)]
+            else:
+                pages = client._fetch_pages("LIST_CONTENT_PAGE", [user], 1, page_size)
 
-                for i, filename in enumerate(files):
-                    print(f"\tFILE{i}: {filename.ljust(max_file_len)}")
+            shown = None
+            for response, _, files in pages:
+                if response != 0:
+                    break
+                if shown is None:
+                    # Éxito
+                    print("c> LIST_CONTENT OK")
+                    shown = 0
+                client._print_files(files, shown)
+                shown += len(files)
+            else:
                 return client.RC.OK
 
-            elif response == 1:
+            if response == 1:
                 print("c> LIST_CONTENT FAIL, USER DOES NOT EXIST")
                 return client.RC.USER_ERROR
 
@@ -553,12 +959,129 @@ class client:
 
         except Exception as e:
             print("c> LIST_CONTENT CLIENT ERROR -", str(e))
-        finally:
-            if sck:
-                sck.close()
 
         return client.RC.ERROR
 
+    @staticmethod
+    def search(query, limit=20):
+        """
+        Busca en el índice de todos los servidores del directorio los ficheros cuya ruta o
+        descripción contiene 'query' o, si 'query' termina en "*", cuya ruta, nombre o descripción
+        empieza por lo anterior. Muestra como mucho 'limit' resultados, ordenados por usuario y ruta.
+        """
+        if client._current_user_connected is None:
+            print("c> SEARCH FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+
+        mode = "PREFIX" if query.endswith("*") else "SUBSTRING"
+        text = query[:-1] if mode == "PREFIX" else query
+        try:
+            # Cada servidor devuelve sus 'limit' primeros; de todos ellos se muestran los 'limit' primeros
+            results = client._fan_out(lambda shard: client._fetch_list("SEARCH", [text, mode], 3, (0, limit), shard))
+            response, _, items = client._merge(results)
+        except Exception as e:
+            print("c> SEARCH CLIENT ERROR -", str(e))
+            return client.RC.ERROR
+
+        if response == 0:
+            print("c> SEARCH OK")
+            items = sorted(items)[:limit]
+            for i, (user, path, description) in enumerate(items):
+                print(f"\tRESULT{i}: {user} {path} \"{description}\"")
+            total = sum(total for response, total, _ in results if response == 0)
+            if total > len(items):
+                print(f"\t({len(items)} of {total} results)")
+            return client.RC.OK
+
+        elif response == 1:
+            print("c> SEARCH FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+
+        elif response == 2:
+            print("c> SEARCH FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+
+        elif response == 3:
+            print("c> SEARCH FAIL, INVALID QUERY")
+            return client.RC.USER_ERROR
+
+        elif response == 4:
+            print("c> SEARCH FAIL")
+            return client.RC.USER_ERROR
+
+        else:
+            print("c> UNKNOWN RESPONSE FROM SERVER:", response)
+            return client.RC.ERROR
+
+    @staticmethod
+    def subscribe(user_pattern="*", path_pattern="*", callback=None):
+        """
+        Se suscribe en todos los servidores del directorio a los cambios (PUBLISH, DELETE, CONNECT y
+        DISCONNECT) de los usuarios que cumplen 'user_pattern' y, en PUBLISH y DELETE, de los
+        ficheros que cumplen 'path_pattern' (patrones de fnmatch). Cada evento (events.Event) se
+        pasa a 'callback' desde un hilo de escucha; por defecto se muestra. Sustituye a la
+        suscripción anterior, si la hay.
+        """
+        if client._current_user_connected is None:
+            print("c> SUBSCRIBE FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+
+        if client._subscription is not None:
+            client._subscription.close()
+            client._subscription = None
+        listener = EventListener(client._shards, ["SUBSCRIBE", client.get_wsdatetime(),
+                                                  client._current_user_connected, user_pattern, path_pattern],
+                                 callback or client._print_event)
+        try:
+            response = listener.start()
+        except Exception as e:
+            print("c> SUBSCRIBE CLIENT ERROR -", str(e))
+            return client.RC.ERROR
+
+        if response == 0:
+            client._subscription = listener
+            print("c> SUBSCRIBE OK")
+            return client.RC.OK
+
+        elif response == 1:
+            print("c> SUBSCRIBE FAIL, USER DOES NOT EXIST")
+            return client.RC.USER_ERROR
+
+        elif response == 2:
+            print("c> SUBSCRIBE FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+
+        elif response == 3:
+            print("c> SUBSCRIBE FAIL, TOO MANY SUBSCRIBERS")
+            return client.RC.ERROR
+
+        else:
+            print("c> UNKNOWN RESPONSE FROM SERVER:", response)
+            return client.RC.ERROR
+
+    @staticmethod
+    def unsubscribe():
+        if client._subscription is None:
+            print("c> UNSUBSCRIBE FAIL, NOT SUBSCRIBED")
+            return client.RC.USER_ERROR
+        client._subscription.close()
+        client._subscription = None
+        print("c> UNSUBSCRIBE OK")
+        return client.RC.OK
+
+    @staticmethod
+    def _print_event(event):
+        if event.type == "PUBLISH":
+            print(f"c> EVENT PUBLISH {event.user} {event.path} \"{event.info}\"")
+        elif event.type == "DELETE":
+            print(f"c> EVENT DELETE {event.user} {event.path}")
+        elif event.type == "CONNECT":
+            print(f"c> EVENT CONNECT {event.user} {event.info}")
+        elif event.type == "LOST":
+            print(f"c> EVENT LOST {event.info}")
+        else:
+            print(f"c> EVENT {event.type} {event.user}")
+
     @staticmethod
     def getfile(user, remote_FileName, local_FileName):
         if client._current_user_connected is None:
@@ -588,50 +1111,156 @@ class client:
             print(f"c> GET_FILE FAIL, USER {user} NOT FOUND")
             return client.RC.USER_ERROR
 
-        sck = None
         try:
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((ip, port))
-            sck.sendall("GET_FILE\0".encode())
-            sck.sendall(remote_FileName.encode() + b"\0")
+            with client._metrics.transfer("GET_FILE", remote_FileName) as transfer:
+                response, _ = client._fetch_file(ip, port, remote_FileName, local_FileName, transfer)
+                transfer.finish(response == 0)
+        except Exception as e:
+            print("c> GET_FILE CLIENT ERROR -", str(e))
+            return client.RC.ERROR
 
-            response = int.from_bytes(sck.recv(1), byteorder='big')
-            if response == 0:
-                # Ahora, recibimos el fichero
+        if response == 0:
+            print("c> GET_FILE OK")
+            return client.RC.OK
+        elif response == 1:
+            print("c> GET_FILE FAIL, FILE DOES NOT EXIST")
+            return client.RC.USER_ERROR
+        elif response == 2:
+            print("c> GET_FILE FAIL")
+            return client.RC.USER_ERROR
+        else:
+            print("c> UNKNOWN RESPONSE FROM SERVER:", response)
+        return client.RC.ERROR
+
+    @staticmethod
+    def _fetch_file(ip, port, remote_FileName, local_FileName, transfer=NO_TRANSFER):
+        """
+        Descarga un fichero entero del seeder ip:port (GET_FILE), o lo saca de la caché si ya
+        se descargó su contenido. Retorna (código de respuesta del seeder, bytes escritos).
+        """
+        # Con el manifiesto (si el otro cliente lo sirve) se sabe el hash del contenido: si ya
+        # está en la caché no hace falta descargarlo
+        manifest = fetch_manifest(ip, port, remote_FileName) if client._cache.max_bytes else None
+        if manifest is not None and client._cache.fetch(manifest["hash"], local_FileName, manifest["size"]):
+            return 0, manifest["size"]
+        if manifest is not None:
+            transfer.set_size(manifest["size"])
+
+        connection = transfer.connection(f"{ip}:{port}")
+        received = 0
+        complete = False
+        try:
+            response, sck, reader = open_transfer(ip, port, "GET_FILE", [remote_FileName], client._compression)
+            if response != 0:
+                return response, 0
+            connection.connected()
+            try:
+                # Ahora, recibimos el fichero (descomprimido, si el seeder lo ha comprimido)
                 with open(local_FileName, 'wb') as f:
                     while True:
-                        data = sck.recv(1)
+                        data = reader.recv(65536)
                         if not data:
                             break
                         f.write(data)
-                print("c> GET_FILE OK")
-                sck.close()
-                return client.RC.OK
-            elif response == 1:
-                print("c> GET_FILE FAIL, FILE DOES NOT EXIST")
+                        received += len(data)
+                        connection.received(len(data))
+                complete = True
+            finally:
                 sck.close()
+        finally:
+            connection.close(complete)
+        # Solo se guarda en la caché si lo recibido corresponde al manifiesto
+        if manifest is not None and client._manifests.get(local_FileName)["hash"] == manifest["hash"]:
+            client._cache.store(manifest["hash"], local_FileName, f"{ip}:{port}:{remote_FileName}")
+        return 0, received
+
+    @staticmethod
+    def getbatch(user, local_dir, patterns):
+        """
+        Descarga a 'local_dir' los ficheros de 'user' (o de todos los usuarios, con "*") cuyo
+        nombre coincide con alguno de 'patterns' (nombres o patrones de fnmatch contra
+        LIST_CONTENT). Las descargas se reparten en el planificador (scheduler.py) con como
+        mucho _batch_connections a la vez y _batch_peer_connections por seeder. Bajo
+        'local_dir' se conserva la estructura de carpetas de los ficheros (y, con "*", una
+        carpeta por usuario).
+        """
+        if client._current_user_connected is None:
+            print("c> GET_BATCH FAIL, USER NOT CONNECTED")
+            return client.RC.USER_ERROR
+
+        try:
+            response, _, users = client._merge(client._fan_out(
+                lambda shard: client._fetch_list("LIST_USERS", [], 3, shard=shard)))
+            if response != 0:
+                print("c> GET_BATCH FAIL, LIST_USERS ERROR")
+                return client.RC.ERROR
+            addresses = {name: (ip, port) for name, ip, port in users}
+            if user != "*" and user not in addresses:
+                print(f"c> GET_BATCH FAIL, USER {user} NOT FOUND")
                 return client.RC.USER_ERROR
-            elif response == 2:
-                print("c> GET_FILE FAIL")
-                sck.close()
+
+            matches = []
+            for source in (sorted(addresses) if user == "*" else [user]):
+                response, _, files = client._fetch_list("LIST_CONTENT", [source], 1)
+                if response != 0:
+                    if user != "*":
+                        print("c> GET_BATCH FAIL, LIST_CONTENT ERROR")
+                        return client.RC.ERROR
+                    continue
+                matches += [(source, name) for (name,) in files
+                            if any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)]
+            if not matches:
+                print("c> GET_BATCH FAIL, NO FILE MATCHES")
                 return client.RC.USER_ERROR
-            else:
-                print("c> UNKNOWN RESPONSE FROM SERVER:", response)
+
+            # Bajo local_dir se conserva la estructura a partir de la carpeta común de los ficheros;
+            # un nombre que saldría de local_dir se queda solo con su último componente
+            try:
+                base = os.path.commonpath([os.path.dirname(name) for _, name in matches])
+            except ValueError:
+                base = ""
+            jobs = []
+            for source, name in matches:
+                relative = os.path.relpath(name, base) if base else os.path.normpath(name).lstrip("/")
+                if relative.startswith(".."):
+                    relative = os.path.basename(name)
+                local = os.path.join(local_dir, source if user == "*" else "", relative)
+                os.makedirs(os.path.dirname(local) or ".", exist_ok=True)
+                ip, port = addresses[source]
+                jobs.append(((ip, port), client._batch_job, (ip, port, name, local)))
+
+            results, seconds = TransferScheduler(client._batch_connections, client._batch_peer_connections).run(jobs)
         except Exception as e:
-            print("c> GET_FILE CLIENT ERROR -", str(e))
+            print("c> GET_BATCH CLIENT ERROR -", str(e))
             return client.RC.ERROR
-        finally:
-            if sck:
-                sck.close()
 
-        return client.RC.ERROR
+        failed = [match for match, (ok, _) in zip(matches, results) if not ok]
+        total = sum(received for _, received in results)
+        if failed:
+            print(f"c> GET_BATCH FAIL, {len(failed)} OF {len(matches)} FILES FAILED")
+            for source, name in failed:
+                print(f"\tFAILED {source} {name}")
+        else:
+            print("c> GET_BATCH OK")
+        print(f"\t{len(matches)} files, {total} bytes in {seconds:.2f} s "
+              f"({total / max(seconds, 1e-6) / (1024 * 1024):.2f} MiB/s)")
+        return client.RC.ERROR if failed else client.RC.OK
+
+    @staticmethod
+    def _batch_job(ip, port, remote_FileName, local_FileName):
+        with client._metrics.transfer("GET_BATCH", remote_FileName) as transfer:
+            response, received = client._fetch_file(ip, port, remote_FileName, local_FileName, transfer)
+            transfer.finish(response == 0)
+        return response == 0, received
 
     @staticmethod
     def getmultifile(remote_FileName, local_FileName):
         """
         Esta función no está en el enunciado de la práctica. Se trata de recibir un fichero
-        desde varios usuarios al mismo tiempo y guardarlo en el directorio local, desplegando un
-        hilo por cada usuario.
+        desde varios usuarios al mismo tiempo y guardarlo en el directorio local. Solo se juntan
+        fragmentos de seeders que publicaron el mismo contenido (el mismo hash), y cada pieza se
+        comprueba con el manifiesto según llega. 'remote_FileName' puede ser el nombre del
+        fichero o "sha256:" (manifest.HASH_PREFIX) seguido del hash de su contenido.
         :param remote_FileName:
         :param local_FileName:
         :return:
@@ -640,76 +1269,473 @@ class client:
             print("c> GET_MULTIFILE FAIL, USER NOT CONNECTED")
             return client.RC.USER_ERROR
 
-        sck = None
         try:
-            sck = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sck.connect((client._server, client._port))
-            sck.sendall("GET_MULTIFILE\0".encode())
-            sck.sendall((client.get_wsdatetime() + "\0").encode())
-            username = client._current_user_connected + "\0"
-            sck.sendall(username.encode())
-
-            # Ahora enviamos el path
-            remote_FileName = remote_FileName + "\0"
-            sck.sendall(remote_FileName.encode())
+            # Por hash no hace falta preguntar al directorio si el contenido ya está en la caché
+            by_hash = remote_FileName.startswith(HASH_PREFIX)
+            if by_hash and client._cache.fetch(remote_FileName[len(HASH_PREFIX):], local_FileName):
+                print("c> GET_MULTIFILE OK")
+                return client.RC.OK
 
-            response = int.from_bytes(sck.recv(1), byteorder='big')
+            # Cada servidor del directorio conoce solo a sus usuarios, así que se pregunta a
+            # todos a la vez y se juntan los seeders. A cada uno se le piden el doble de los que
+            # se van a usar para tener de reserva si alguno falla.
+            limit = 2 * client._max_connections
+            response, _, users = client._merge(client._fan_out(
+                lambda shard: client._fetch_seeders(remote_FileName, shard, limit)), empty=1)
             if response == 0:
-                # Primero recibimos el número de usuarios que tienen el fichero
-                num_users = int.from_bytes(sck.recv(1), byteorder='big')
-                # Por cada usuario, recibimos su ip y su puerto
-                users = []
-                for _ in range(num_users):
-                    ip = recv_cstring(sck)
-                    port = recv_cstring(sck)
-                    file_path = recv_cstring(sck)
-                    users.append((ip, port, file_path))
-
-                # A partir de aquí, ya sabemos cuántos usuarios tienen el fichero y quiénes son exactamente
-                # por lo que procederemos a decir a cada usuario qué parte del fichero nos tienen que enviar
-                # para que lo ensamblemos según la porción que le corresponda a cada uno.
-                threads = []
-                # Lanzamos un hilo por cada seeder
-                for seeder_id, (ip, port, file_path) in enumerate(users):
-                    t = threading.Thread(target=download_range,
-                                         args=(ip, port, file_path.strip("\0"), seeder_id, num_users))
-                    threads.append(t)
-                    t.start()
-
-                for t in threads:
-                    t.join()
-
-                # Una vez descargados todos los fragmentos, concatenarlos en el fichero final.
-                with open(local_FileName, "wb") as fout:
-                    for seeder_id in range(num_users):
-                        temp_filename = f"{seeder_id}.temp"
-                        if os.path.exists(temp_filename):
-                            with open(temp_filename, "rb") as fin:
-                                fout.write(fin.read())
-                            os.remove(temp_filename)
-                        else:
-                            print(f"Error: Fichero temporal '{temp_filename}' no encontrado.")
-                            return client.RC.ERROR
-
+                # Cada servidor devuelve sus seeders del mejor al peor; se intercalan por puesto
+                # para que los primeros sean los mejores de cada servidor
+                users.sort(key=lambda seeder: seeder[5])
+                # Dos ficheros distintos pueden llamarse igual: se descarga el contenido del mejor
+                # seeder que publicó el hash y solo de los seeders con ese mismo hash. Si ninguno
+                # lo publicó, se descarga por nombre como antes, sin poder comprobar las piezas.
+                target = next((seeder[3] for seeder in users if seeder[3]), "")
+                candidates = [seeder_id for seeder_id, seeder in enumerate(users) if seeder[3] == target]
+                if target and not by_hash and client._cache.fetch(target, local_FileName):
+                    print("c> GET_MULTIFILE OK")
+                    return client.RC.OK
+                with client._metrics.transfer("GET_MULTIFILE", remote_FileName) as transfer:
+                    if target:
+                        ok, results = client._download_verified(users, candidates, target, local_FileName, transfer)
+                        if ok:
+                            ip, port, file_path = users[candidates[0]][:3]
+                            client._cache.store(target, local_FileName, f"{ip}:{port}:{file_path}")
+                    else:
+                        ok, results = client._download_parts(users, candidates, local_FileName, transfer)
+                    transfer.finish(ok)
+
+                client._report_seeders(users, results)
+
+                if not ok:
+                    print("c> GET_MULTIFILE FAIL")
+                    return client.RC.ERROR
                 print(f"c> GET_MULTIFILE OK")
 
                 return client.RC.OK
             elif response == 1:
                 print("c> GET_MULTIFILE FAIL, NO USER CONNECTED HAVE FILE")
-                sck.close()
                 return client.RC.USER_ERROR
             elif response == 2:
                 print("c> GET_MULTIFILE FAIL")
-                sck.close()
                 return client.RC.USER_ERROR
             else:
                 print("c> UNKNOWN RESPONSE FROM SERVER:", response)
         except Exception as e:
             print("c> GET_MULTIFILE CLIENT ERROR -", str(e))
-        finally:
-            if sck:
+
+        return client.RC.ERROR
+
+    @staticmethod
+    def _fallback_order(candidates, part, num_parts):
+        """Primero el seeder asignado al fragmento, después los de reserva y por último el resto."""
+        return [candidates[part]] + candidates[num_parts:] + \
+               [other for other in candidates[:num_parts] if other != candidates[part]]
+
+    @staticmethod
+    def _download_parts(users, candidates, local_FileName, transfer=NO_TRANSFER):
+        """
+        Descarga por nombre, sin comprobaciones, de seeders que no publicaron el hash. El fichero
+        se divide en tantos fragmentos como seeders se usan a la vez (como mucho _max_connections)
+        y cada fragmento se pide a un seeder; si falla, se pide a los demás candidatos. Retorna
+        (ok, {posición del seeder en 'users': (ok, bytes, milisegundos)}). Las conexiones y los
+        reintentos se contabilizan en 'transfer'.
+        """
+        num_parts = min(client._max_connections, len(candidates))
+        results = {}
+        results_lock = threading.Lock()
+
+        def fetch_part(part):
+            for attempt, seeder_id in enumerate(client._fallback_order(candidates, part, num_parts)):
+                ip, port, file_path = users[seeder_id][:3]
+                if attempt:
+                    transfer.retry(f"{ip}:{port}")
+                ok, received, millis = download_range(ip, port, file_path.strip("\0"), part, num_parts,
+                                                      client._compression, transfer)
+                with results_lock:
+                    prev_ok, prev_received, prev_millis = results.get(seeder_id, (True, 0, 0))
+                    results[seeder_id] = (prev_ok and ok, prev_received + received, prev_millis + millis)
+                if ok:
+                    return True
+            return False
+
+        # Un hilo por fragmento: nunca hay más de num_parts conexiones abiertas a la vez
+        with ThreadPoolExecutor(max_workers=num_parts) as pool:
+            parts_ok = list(pool.map(fetch_part, range(num_parts)))
+
+        if not all(parts_ok):
+            for part in range(num_parts):
+                if os.path.exists(f"{part}.temp"):
+                    os.remove(f"{part}.temp")
+            return False, results
+
+        # Una vez descargados todos los fragmentos, concatenarlos en el fichero final.
+        with open(local_FileName, "wb") as fout:
+            for part in range(num_parts):
+                temp_filename = f"{part}.temp"
+                if os.path.exists(temp_filename):
+                    with open(temp_filename, "rb") as fin:
+                        fout.write(fin.read())
+                    os.remove(temp_filename)
+                else:
+                    print(f"Error: Fichero temporal '{temp_filename}' no encontrado.")
+                    return False, results
+        return True, results
+
+    @staticmethod
+    def _download_verified(users, candidates, file_hash, local_FileName, transfer=NO_TRANSFER):
+        """
+        Descarga el contenido con hash 'file_hash'. Primero se pide el manifiesto a los candidatos
+        hasta que uno corresponde al hash; después las piezas se reparten en tantos fragmentos
+        como seeders se usan a la vez y cada pieza se escribe en su sitio solo si coincide con su
+        hash. Las piezas que fallan (y solo esas) se piden a los demás candidatos. Retorna lo
+        mismo que _download_parts.
+        """
+        results = {}
+        results_lock = threading.Lock()
+        local_path = os.path.abspath(local_FileName)
+
+        def record(seeder_id, ok, received, millis):
+            with results_lock:
+                prev_ok, prev_received, prev_millis = results.get(seeder_id, (True, 0, 0))
+                results[seeder_id] = (prev_ok and ok, prev_received + received, prev_millis + millis)
+
+        manifest = None
+        for seeder_id in candidates:
+            ip, port, file_path = users[seeder_id][:3]
+            manifest = fetch_manifest(ip, port, file_path)
+            if manifest is not None and manifest["hash"] == file_hash:
+                break
+            record(seeder_id, False, 0, 0)
+            manifest = None
+        if manifest is None:
+            return False, results
+
+        transfer.set_size(manifest["size"])
+        num_pieces = len(manifest["pieces"])
+        num_parts = min(client._max_connections, len(candidates), max(num_pieces, 1))
+        with open(local_FileName, "wb") as fout:
+            fout.truncate(manifest["size"])
+        # Piezas que tiene cada poseedor parcial; los seeders completos las tienen todas
+        available = {seeder_id: decode_pieces(users[seeder_id][6], num_pieces)
+                     for seeder_id in candidates if users[seeder_id][6]}
+
+        # En modo enjambre, las piezas se sirven en cuanto están comprobadas y se anuncian al
+        # directorio a la vez que se descargan (solo un hilo anuncia, y no más de una vez cada
+        # _announce_interval segundos)
+        announcing = threading.Lock()
+        last_announce = [0.0]
+
+        def on_piece(piece):
+            client._partials.mark(local_path, piece)
+            now = time.monotonic()
+            if now - last_announce[0] >= client._announce_interval and announcing.acquire(blocking=False):
+                try:
+                    last_announce[0] = now
+                    client._announce(file_hash, local_path, client._partials.pieces(local_path))
+                finally:
+                    announcing.release()
+
+        if client._swarm:
+            client._partials.add(local_path, manifest)
+
+        def fetch_part(part):
+            pending = list(range(part * num_pieces // num_parts, (part + 1) * num_pieces // num_parts))
+            first = True
+            for seeder_id in client._fallback_order(candidates, part, num_parts):
+                wanted = [piece for piece in pending if seeder_id not in available or piece in available[seeder_id]]
+                if not wanted:
+                    continue
+                ip, port, file_path = users[seeder_id][:3]
+                if not first:
+                    transfer.retry(f"{ip}:{port}")
+                first = False
+                verified, received, millis = download_pieces(ip, port, file_path, manifest, wanted, local_FileName,
+                                                             on_piece if client._swarm else None, client._compression,
+                                                             transfer)
+                record(seeder_id, len(verified) == len(wanted), received, millis)
+                pending = [piece for piece in pending if piece not in verified]
+                if not pending:
+                    break
+            return not pending
+
+        # Un hilo por fragmento: nunca hay más de num_parts conexiones abiertas a la vez
+        with ThreadPoolExecutor(max_workers=num_parts) as pool:
+            parts_ok = list(pool.map(fetch_part, range(num_parts)))
+
+        ok = all(parts_ok)
+        if client._swarm:
+            # Completo, se sigue ofreciendo mientras el usuario esté conectado; si ha fallado, se
+            # retira el anuncio
+            with announcing:
+                client._announce(file_hash, local_path, client._partials.pieces(local_path) if ok else "")
+            client._partials.remove(local_path)
+        if not ok:
+            os.remove(local_FileName)
+            return False, results
+        client._manifests.put(local_path, manifest)
+        return True, results
+
+    @staticmethod
+    def _announce(file_hash, path, pieces):
+        """
+        Anuncia al servidor del usuario las piezas que tiene del contenido 'file_hash' en 'path'
+        ("" para retirar el anuncio). Si no se puede anunciar, la descarga no se ve afectada.
+        """
+        try:
+            sck = client._open(client._current_user_connected)
+            try:
+                sck.sendall(("ANNOUNCE\0" + client.get_wsdatetime() + "\0" + client._current_user_connected + "\0" +
+                             file_hash + "\0" + path + "\0" + pieces + "\0").encode())
+                sck.recv(1)
+            finally:
                 sck.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _fetch_seeders(remote_FileName, shard, limit=0):
+        """
+        Pregunta a un servidor del directorio qué usuarios conectados tienen el fichero (como
+        mucho los 'limit' mejores; 0 para todos). Retorna (código de respuesta, número de
+        seeders, lista de (ip, puerto, ruta, hash del contenido, servidor, puesto, mapa de
+        piezas)). El mapa de piezas es "" si el seeder tiene el fichero completo.
+        """
+        sck = client._open(shard=shard)
+        try:
+            sck.sendall(("GET_MULTIFILE2\0" + client.get_wsdatetime() + "\0" +
+                         client._current_user_connected + "\0" + remote_FileName + "\0" +
+                         str(limit) + "\0").encode())
+
+            reader = CStringReader(sck)
+            response = reader.read_byte()
+            if response != 0:
+                return response, 0, []
+            # Primero recibimos el número de usuarios que tienen el fichero (en ascii, sin el
+            # límite de 255 de GET_MULTIFILE)
+            num_users = int(reader.read_cstring())
+            # Por cada usuario (del mejor al peor), recibimos su ip, su puerto, la ruta del
+            # fichero, su hash ("" si se publicó sin él) y su mapa de piezas. Se anota también el
+            # servidor y el puesto para poder informar del resultado
+            users = []
+            for rank in range(num_users):
+                ip, port, file_path, file_hash, pieces = (reader.read_cstring() for _ in range(5))
+                users.append((ip, port, file_path, file_hash, shard, rank, pieces))
+            return response, num_users, users
+        finally:
+            sck.close()
+
+    @staticmethod
+    def _report_seeders(users, results):
+        """
+        Informa a cada servidor del directorio del caudal obtenido de sus seeders (o de que han
+        fallado) para que los ordene mejor en las siguientes descargas. 'results' asocia la
+        posición de cada seeder usado en 'users' a (ok, bytes, milisegundos). Si no se puede
+        informar, la descarga no se ve afectada.
+        """
+        by_shard = {}
+        for seeder_id, (ok, received, millis) in sorted(results.items()):
+            ip, port, _, _, shard = users[seeder_id][:5]
+            by_shard.setdefault(shard, []).append(
+                f"{ip}\0{port}\0{received}\0{millis}\0{1 if ok else 0}\0")
+        for shard, entries in by_shard.items():
+            try:
+                sck = client._open(shard=shard)
+                try:
+                    sck.sendall(("REPORT_SEEDERS\0" + client.get_wsdatetime() + "\0" +
+                                 client._current_user_connected + "\0" + str(len(entries)) + "\0" +
+                                 "".join(entries)).encode())
+                    sck.recv(1)
+                finally:
+                    sck.close()
+            except Exception:
+                pass
+
+    # Opciones del cliente que se pueden cambiar con SET: nombre -> (atributo, conversión, validación)
+    _options = {
+        "MAX_CONNECTIONS": ("_max_connections", int, lambda value: value > 0),
+        "SWARM": ("_swarm", int, lambda value: value in (0, 1)),
+        "CACHE_MB": ("_cache_mb", int, lambda value: value >= 0),
+        "UPLOAD_LIMIT": ("_upload_limit", int, lambda value: value >= 0),
+        "UPLOAD_CONN_LIMIT": ("_upload_conn_limit", int, lambda value: value >= 0),
+        "BATCH_CONNECTIONS": ("_batch_connections", int, lambda value: value > 0),
+        "BATCH_PEER_CONNECTIONS": ("_batch_peer_connections", int, lambda value: value > 0),
+        "COMPRESSION": ("_compression",
+                        lambda value: tuple(codec for codec in value.lower().split(",") if codec != "none"),
+                        lambda value: all(codec in CODECS for codec in value)),
+        "METRICS_FILE": ("_metrics_file", lambda value: "" if value.lower() == "none" else value, lambda value: True),
+        "PROGRESS": ("_progress", int, lambda value: value in (0, 1)),
+    }
+
+    @staticmethod
+    def set_option(name, value):
+        option = client._options.get(name.upper())
+        if option is None:
+            print(f"c> SET FAIL, UNKNOWN OPTION {name}")
+            return client.RC.USER_ERROR
+        attribute, convert, valid = option
+        try:
+            value = convert(value)
+        except ValueError:
+            value = None
+        if value is None or not valid(value):
+            print(f"c> SET FAIL, INVALID VALUE FOR {name.upper()}")
+            return client.RC.USER_ERROR
+        setattr(client, attribute, value)
+        if attribute == "_cache_mb":
+            client._cache.resize(value * 1024 * 1024)
+        elif attribute in ("_upload_limit", "_upload_conn_limit"):
+            client._uploads.set_limits(client._upload_limit * 1024, client._upload_conn_limit * 1024)
+        elif attribute == "_metrics_file":
+            try:
+                client._metrics.set_file(value)
+            except OSError as e:
+                client._metrics_file = ""
+                print(f"c> SET FAIL, CANNOT OPEN {value} - {e.strerror}")
+                return client.RC.USER_ERROR
+        elif attribute == "_progress":
+            client._progress_display.enabled = bool(value)
+        print("c> SET OK")
+        return client.RC.OK
+
+    @staticmethod
+    def cache_stats():
+        """Muestra las estadísticas de la caché local de descargas."""
+        try:
+            stats = client._cache.stats()
+        except Exception as e:
+            print("c> CACHE CLIENT ERROR -", str(e))
+            return client.RC.ERROR
+        print("c> CACHE OK")
+        print(f"\tentries {stats['entries']}  size {stats['size']}/{stats['max_bytes']} bytes")
+        print(f"\thits {stats['hits']}  misses {stats['misses']}  hit bytes {stats['hit_bytes']}  "
+              f"evictions {stats['evictions']}")
+        return client.RC.OK
+
+    @staticmethod
+    def metrics():
+        """
+        Muestra las métricas de las descargas de esta sesión: los totales y, por seeder, las
+        conexiones, los bytes, el tiempo medio de conexión y el ritmo típico de sus conexiones.
+        """
+        totals, peers = client._metrics.snapshot()
+        print("c> METRICS OK")
+        print(f"\ttransfers {totals['transfers']} ({totals['failed']} failed)  bytes {totals['bytes']}  "
+              f"retries {totals['retries']}  stalls {totals['stalls']}")
+        if not peers:
+            return client.RC.OK
+        print(f"\t{'PEER':<22}{'CONNS':>7}{'FAILS':>7}{'BYTES':>12}{'CONN_MS':>9}{'P50_KIB/S':>11}{'P90_KIB/S':>11}")
+        for peer, stats in sorted(peers.items()):
+            connect_ms = int(stats["connect_s"] * 1000 / stats["connections"])
+            # El histograma de ritmo es logarítmico, como los de latencia del servidor
+            p50 = client._percentile_us(stats["hist"], 0.5)
+            p90 = client._percentile_us(stats["hist"], 0.9)
+            print(f"\t{peer:<22}{stats['connections']:>7}{stats['failures']:>7}{stats['bytes']:>12}"
+                  f"{connect_ms:>9}{p50:>11}{p90:>11}")
+        return client.RC.OK
+
+    @staticmethod
+    def _fetch_stats(shard=0):
+        """
+        Pide las métricas a un servidor. Retorna (código de respuesta, diccionario nombre -> valor);
+        los histogramas de latencia se devuelven como listas de enteros.
+        """
+        sck = client._open(shard=shard)
+        try:
+            user = client._current_user_connected or ""
+            sck.sendall(("STATS\0" + client.get_wsdatetime() + "\0" + user + "\0").encode())
+
+            reader = CStringReader(sck)
+            response = reader.read_byte()
+            if response != 0:
+                return response, {}
+            stats = {}
+            for _ in range(int(reader.read_cstring())):
+                name = reader.read_cstring()
+                value = reader.read_cstring()
+                if name.endswith(".hist"):
+                    stats[name] = [int(v) for v in value.split(",") if v]
+                else:
+                    stats[name] = int(value)
+            return response, stats
+        finally:
+            sck.close()
 
+    @staticmethod
+    def _percentile_us(hist, fraction):
+        """Cota superior (en us) del cubo del histograma logarítmico que contiene el percentil."""
+        total = sum(hist)
+        if total == 0:
+            return 0
+        seen = 0
+        for bucket, count in enumerate(hist):
+            seen += count
+            if seen >= fraction * total:
+                return 1 << bucket
+        return 1 << (len(hist) - 1)
+
+    @staticmethod
+    def _print_stats(stats, previous=None, interval=None):
+        print(f"\tuptime {stats['uptime_s']}s  connections {stats['connections_active']} active, "
+              f"{stats['connections_peak']} peak, {stats['connections_total']} total  "
+              f"users connected {stats['users_connected']}")
+        print(f"\tleases {stats.get('leases_tracked', 0)} tracked, {stats.get('leases_expired', 0)} expired  "
+              f"seeders scored {stats.get('seeders_scored', 0)} ({stats.get('seeder_reports', 0)} reports)  "
+              f"swarm {stats.get('swarm_files', 0)} files ({stats.get('swarm_holders', 0)} holders)")
+        print(f"\tlock waits {stats['lock_waits']} ({stats['lock_wait_us']} us)  "
+              f"logger in flight {stats['logger_inflight']} "
+              f"({stats['logger_calls']} calls, {stats['logger_errors']} errors)")
+        print(f"\tsearch index {stats.get('search_files', 0)} files ({stats.get('search_grams', 0)} trigrams)  "
+              f"subscribers {stats.get('subscribers', 0)} ({stats.get('events_delivered', 0)} events, "
+              f"{stats.get('events_lost', 0)} lost)")
+
+        ops = sorted(name[3:-6] for name in stats if name.startswith("op.") and name.endswith(".count"))
+        header = f"\t{'OPERATION':<18}{'COUNT':>9}{'AVG_US':>9}{'P50_US':>9}{'P99_US':>9}{'MAX_US':>9}"
+        if previous is not None:
+            header += f"{'OPS/S':>9}"
+        print(header)
+        for op in ops:
+            count = stats[f"op.{op}.count"]
+            hist = stats[f"op.{op}.hist"]
+            max_us = stats[f"op.{op}.max_us"]
+            # Los percentiles salen del histograma, así que nunca pueden superar el máximo real
+            p50 = min(client._percentile_us(hist, 0.5), max_us)
+            p99 = min(client._percentile_us(hist, 0.99), max_us)
+            row = (f"\t{op:<18}{count:>9}{stats[f'op.{op}.total_us'] // count:>9}"
+                   f"{p50:>9}{p99:>9}{max_us:>9}")
+            if previous is not None:
+                rate = (count - previous.get(f"op.{op}.count", 0)) / interval
+                row += f"{rate:>9.1f}"
+            print(row)
+
+    @staticmethod
+    def stats(interval=None, count=None):
+        """
+        Muestra las métricas del servidor. Con 'interval', las vuelve a pedir cada 'interval'
+        segundos ('count' veces, o hasta Ctrl+C) y añade el ritmo de cada operación.
+        """
+        previous = [None] * len(client._shards)
+        shown = 0
+        try:
+            while True:
+                results = client._fan_out(client._fetch_stats)
+                if any(response != 0 for response, _ in results):
+                    print("c> STATS FAIL")
+                    return client.RC.ERROR
+                if interval is not None and sys.stdout.isatty():
+                    print("\033[H\033[J", end="")
+                print("c> STATS OK")
+                for shard, (_, stats) in enumerate(results):
+                    if len(client._shards) > 1:
+                        host, port = client._shards[shard]
+                        print(f"\tSHARD{shard}: {host}:{port}")
+                    client._print_stats(stats, previous[shard], interval)
+                shown += 1
+                if interval is None or (count is not None and shown >= count):
+                    return client.RC.OK
+                previous = [stats for _, stats in results]
+                time.sleep(interval)
+        except Exception as e:
+            print("c> STATS CLIENT ERROR -", str(e))
         return client.RC.ERROR
 
     # *
@@ -793,14 +1819,38 @@ class client:
             elif (line[0] == "LIST_USERS"):
                 if (len(line) == 1):
                     client.listusers()
+                elif (len(line) == 2 and line[1].isdigit() and int(line[1]) > 0):
+                    client.listusers(int(line[1]))
                 else:
-                    print("Syntax error. Use: LIST_USERS")
+                    print("Syntax error. Use: LIST_USERS [pageSize]")
 
             elif (line[0] == "LIST_CONTENT"):
                 if (len(line) == 2):
                     client.listcontent(line[1])
+                elif (len(line) == 3 and line[2].isdigit() and int(line[2]) > 0):
+                    client.listcontent(line[1], int(line[2]))
                 else:
-                    print("Syntax error. Usage: LIST_CONTENT <userName>")
+                    print("Syntax error. Usage: LIST_CONTENT <userName> [pageSize]")
+
+            elif (line[0] == "SEARCH"):
+                if (len(line) == 2):
+                    client.search(line[1])
+                elif (len(line) == 3 and line[2].isdigit() and 0 < int(line[2]) <= 1000):
+                    client.search(line[1], int(line[2]))
+                else:
+                    print("Syntax error. Usage: SEARCH <text|prefix*> [limit]")
+
+            elif (line[0] == "SUBSCRIBE"):
+                if (len(line) <= 3):
+                    client.subscribe(*line[1:])
+                else:
+                    print("Syntax error. Usage: SUBSCRIBE [userPattern [pathPattern]]")
+
+            elif (line[0] == "UNSUBSCRIBE"):
+                if (len(line) == 1):
+                    client.unsubscribe()
+                else:
+                    print("Syntax error. Usage: UNSUBSCRIBE")
 
             elif (line[0] == "DISCONNECT"):
                 if (len(line) == 2):
@@ -814,12 +1864,54 @@ class client:
                 else:
                     print("Syntax error. Usage: GET_FILE <userName> <remote_fileName> <local_fileName>")
 
+            elif (line[0] == "GET_BATCH"):
+                if (len(line) >= 4):
+                    client.getbatch(line[1], line[2], line[3:])
+                else:
+                    print("Syntax error. Usage: GET_BATCH <userName|*> <local_dir> <remote_fileName|glob> ...")
+
             elif (line[0] == "GET_MULTIFILE"):
                 if (len(line) == 3):
                     client.getmultifile(line[1], line[2])
                 else:
                     print("Syntax error. Usage: GET_MULTIFILE <remote_fileName> <local_fileName>")
 
+            elif (line[0] == "STATS"):
+                try:
+                    args = [float(line[1])] if len(line) > 1 else []
+                    if len(line) > 2:
+                        args.append(int(line[2]))
+                except ValueError:
+                    args = None
+                if args is not None and len(line) <= 3 and all(a > 0 for a in args):
+                    client.stats(*args)
+                else:
+                    print("Syntax error. Usage: STATS [intervalSeconds [count]]")
+
+            elif (line[0] == "SHARE"):
+                if (len(line) == 2):
+                    client.share(line[1])
+                else:
+                    print("Syntax error. Usage: SHARE <folder>")
+
+            elif (line[0] == "CACHE"):
+                if (len(line) == 1):
+                    client.cache_stats()
+                else:
+                    print("Syntax error. Usage: CACHE")
+
+            elif (line[0] == "METRICS"):
+                if (len(line) == 1):
+                    client.metrics()
+                else:
+                    print("Syntax error. Usage: METRICS")
+
+            elif (line[0] == "SET"):
+                if (len(line) == 3):
+                    client.set_option(line[1], line[2])
+                else:
+                    print("Syntax error. Usage: SET <option> <value>")
+
             elif (line[0] == "QUIT"):
                 if (len(line) == 1):
                     pass
@@ -834,10 +1926,28 @@ class client:
                 print("\tDISCONNECT <userName>")
                 print("\tPUBLISH <fileName> <description>")
                 print("\tDELETE <fileName>")
-                print("\tLIST_USERS")
-                print("\tLIST_CONTENT <userName>")
+                print("\tSHARE <folder>")
+                print("\tLIST_USERS [pageSize]")
+                print("\tLIST_CONTENT <userName> [pageSize]")
+                print("\tSEARCH <text|prefix*> [limit]")
+                print("\tSUBSCRIBE [userPattern [pathPattern]]")
+                print("\tUNSUBSCRIBE")
                 print("\tGET_FILE <userName> <remote_fileName> <local_fileName>")
-                print("\tGET_MULTIFILE <remote_fileName> <local_fileName>")
+                print("\tGET_MULTIFILE <remote_fileName|sha256:hash> <local_fileName>")
+                print("\tGET_BATCH <userName|*> <local_dir> <remote_fileName|glob> ...")
+                print("\tSTATS [intervalSeconds [count]]")
+                print("\tSET MAX_CONNECTIONS <n>")
+                print("\tCACHE")
+                print("\tMETRICS")
+                print("\tSET SWARM <0|1>")
+                print("\tSET CACHE_MB <n>")
+                print("\tSET COMPRESSION <none|zlib|lzma|zlib,lzma>")
+                print("\tSET UPLOAD_LIMIT <KiB/s>")
+                print("\tSET UPLOAD_CONN_LIMIT <KiB/s>")
+                print("\tSET BATCH_CONNECTIONS <n>")
+                print("\tSET BATCH_PEER_CONNECTIONS <n>")
+                print("\tSET METRICS_FILE <path|none>")
+                print("\tSET PROGRESS <0|1>")
                 print("\tQUIT")
 
             else:
@@ -848,6 +1958,7 @@ class client:
     def usage():
 
         print("Usage: python3 client.py -s <server> -p <port>")
+        print("       python3 client.py --shards <ip:port>,<ip:port>,...")
 
     # *
 
@@ -856,19 +1967,37 @@ class client:
     @staticmethod
     def parseArguments(argv):
         parser = argparse.ArgumentParser()
-        parser.add_argument('-s', type=str, required=True, help='Server IP')
-        parser.add_argument('-p', type=int, required=True, help='Server Port')
+        parser.add_argument('-s', type=str, required=False, help='Server IP')
+        parser.add_argument('-p', type=int, required=False, help='Server Port')
+        parser.add_argument('--shards', type=str, required=False,
+                            help='Directory servers as ip:port,ip:port,... (replaces -s and -p)')
         parser.add_argument('--input-file', type=str, required=False, help='Command input file')
+        parser.add_argument('--heartbeat', type=float, required=False, default=10,
+                            help='Seconds between heartbeats while connected (0 disables them)')
         args = parser.parse_args()
-        if (args.s is None):
-            parser.error("Usage: python3 client.py -s <server> -p <port>")
+        if args.heartbeat < 0:
+            parser.error("Error: Heartbeat interval must be >= 0")
             return False
-        if ((args.p < 1024) or (args.p > 65535)):
-            parser.error("Error: Port must be in the range 1024 <= port <= 65535")
-            return False
-        client._server = args.s
-        client._port = args.p
+        if args.shards:
+            shards = []
+            for shard in args.shards.split(","):
+                host, _, port = shard.strip().rpartition(":")
+                if not host or not port.isdigit() or not 1024 <= int(port) <= 65535:
+                    parser.error("Error: Shards must be ip:port with 1024 <= port <= 65535")
+                    return False
+                shards.append((host, int(port)))
+        else:
+            if (args.s is None or args.p is None):
+                parser.error("Usage: python3 client.py -s <server> -p <port>")
+                return False
+            if ((args.p < 1024) or (args.p > 65535)):
+                parser.error("Error: Port must be in the range 1024 <= port <= 65535")
+                return False
+            shards = [(args.s, args.p)]
+        client._shards = shards
+        client._server, client._port = shards[0]
         client._input_file = args.input_file
+        client._heartbeat_interval = args.heartbeat
         return True
 
     @staticmethod
@@ -883,6 +2012,14 @@ class client:
                     print(output)
                 else:
                     print("No output from disconnect command")
+        # Si el DISCONNECT ha fallado (por ejemplo, porque el lease ya había caducado), el hilo
+        # de escucha sigue vivo y no dejaría terminar al proceso
+        if client._listen_thread:
+            client._listen_thread.kill()
+            client._listen_thread = None
+        if client._subscription:
+            client._subscription.close()
+            client._subscription = None
         print()
         print("+++ FINISHED +++")
         exit(0)
@@ -0,0 +1,164 @@
+"""
+Compresión negociada de las transferencias entre clientes.
+
+GET_FILE, GET_MULTIFILE y GET_RANGE tienen una variante con el sufijo "_Z" que añade al final de
+la petición los códecs que acepta el cliente ("zlib,lzma", por orden de preferencia). El seeder
+responde 0, el códec elegido ("" si no comprime) y los datos. No se comprime el contenido que ya
+está comprimido: se descarta por la extensión del fichero o porque una muestra no reduce su
+tamaño. Se comprime y descomprime por bloques de CHUNK_SIZE, así que la memoria no depende del
+tamaño del fichero.
+
+Un seeder que no conoce la variante responde 2 y open_transfer repite la petición sin compresión.
+"""
+import lzma
+import os
+import socket
+import zlib
+
+from netools import recv_cstring
+
+CODECS = ("zlib", "lzma")
+COMPRESSED_SUFFIX = "_Z"
+CHUNK_SIZE = 64 * 1024
+# Nivel de zlib y preset de lzma (ver bench_compression.py)
+ZLIB_LEVEL = 6
+LZMA_PRESET = 1
+# Si la muestra comprimida ocupa más de esta fracción del original, se envía sin comprimir
+MIN_SAVING = 0.9
+# Formatos que ya están comprimidos
+COMPRESSED_EXTENSIONS = {
+    ".gz", ".tgz", ".bz2", ".xz", ".txz", ".lz", ".lzma", ".zst", ".zip", ".7z", ".rar", ".jar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".mp4", ".mkv", ".avi", ".mov", ".ogg",
+    ".flac", ".pdf", ".docx", ".xlsx", ".pptx", ".odt",
+}
+
+
+def parse_codecs(text):
+    """Códecs conocidos de una lista separada por comas, en el mismo orden."""
+    return [codec for codec in text.split(",") if codec in CODECS]
+
+
+def choose_codec(path, offered, offset=0):
+    """
+    Primer códec de 'offered' con el que merece la pena enviar 'path' a partir de 'offset', o ""
+    si el contenido ya está comprimido.
+    """
+    if not offered or os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS:
+        return ""
+    with open(path, "rb") as f:
+        f.seek(offset)
+        sample = f.read(CHUNK_SIZE)
+    if sample and len(zlib.compress(sample, 1)) > MIN_SAVING * len(sample):
+        return ""
+    return offered[0]
+
+
+def compressor(codec):
+    if codec == "zlib":
+        return zlib.compressobj(ZLIB_LEVEL)
+    if codec == "lzma":
+        return lzma.LZMACompressor(preset=LZMA_PRESET)
+    return None
+
+
+def send_stream(sock, f, offset, length, codec):
+    """Envía 'length' bytes de 'f' a partir de 'offset', comprimidos con 'codec' ("" sin comprimir)."""
+    comp = compressor(codec)
+    f.seek(offset)
+    while length > 0:
+        data = f.read(min(CHUNK_SIZE, length))
+        if not data:
+            break
+        length -= len(data)
+        data = comp.compress(data) if comp else data
+        if data:
+            sock.sendall(data)
+    if comp:
+        sock.sendall(comp.flush())
+
+
+class StreamDecoder:
+    """Descompresor por bloques: feed() produce trozos de como mucho CHUNK_SIZE bytes."""
+
+    def __init__(self, codec):
+        self._codec = codec
+        if codec == "zlib":
+            self._decompressor = zlib.decompressobj()
+        elif codec == "lzma":
+            self._decompressor = lzma.LZMADecompressor()
+        else:
+            self._decompressor = None
+
+    def feed(self, data):
+        if self._decompressor is None:
+            if data:
+                yield data
+        elif self._codec == "zlib":
+            # Lo que no cabe en CHUNK_SIZE queda en unconsumed_tail y se sigue en la siguiente vuelta
+            while data:
+                out = self._decompressor.decompress(data, CHUNK_SIZE)
+                data = self._decompressor.unconsumed_tail
+                if out:
+                    yield out
+        else:
+            out = self._decompressor.decompress(data, CHUNK_SIZE)
+            if out:
+                yield out
+            while not self._decompressor.needs_input and not self._decompressor.eof:
+                out = self._decompressor.decompress(b"", CHUNK_SIZE)
+                if out:
+                    yield out
+
+
+class DecodingReader:
+    """Envuelve un socket: recv(n) devuelve como mucho n bytes ya descomprimidos (b"" al terminar)."""
+
+    def __init__(self, sock, codec):
+        self._sock = sock
+        self._decoder = StreamDecoder(codec)
+        self._pending = iter(())
+        self._buf = b""
+
+    def recv(self, size):
+        while not self._buf:
+            chunk = next(self._pending, None)
+            if chunk is None:
+                data = self._sock.recv(CHUNK_SIZE)
+                if not data:
+                    return b""
+                self._pending = self._decoder.feed(data)
+            else:
+                self._buf = chunk
+        data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+
+def open_transfer(ip, port, operation, fields, codecs=()):
+    """
+    Pide a un seeder la transferencia 'operation' con los campos 'fields'. Si se ofrecen 'codecs',
+    se pide la variante comprimida y, si el seeder no la conoce, se repite sin compresión.
+    Retorna (código de respuesta, socket, lector con recv() de los datos ya descomprimidos); si
+    el código no es 0, el socket ya está cerrado y los otros dos valores son None.
+    """
+    def request(op, extra):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.connect((ip, int(port)))
+            sock.sendall("".join(field + "\0" for field in [op] + fields + extra).encode())
+            return sock, int.from_bytes(sock.recv(1), byteorder='big')
+        except Exception:
+            sock.close()
+            raise
+
+    if codecs:
+        sock, response = request(operation + COMPRESSED_SUFFIX, [",".join(codecs)])
+        if response == 0:
+            return 0, sock, DecodingReader(sock, recv_cstring(sock))
+        sock.close()
+        if response != 2:
+            return response, None, None
+    sock, response = request(operation, [])
+    if response != 0:
+        sock.close()
+        return response, None, None
+    return 0, sock, sock
@@ -0,0 +1,87 @@
+"""
+Notificaciones de cambios del directorio (SUBSCRIBE).
+
+Un EventListener abre una conexión SUBSCRIBE con cada servidor del directorio, que la mantiene
+abierta y envía por ella los PUBLISH, DELETE, CONNECT y DISCONNECT de sus usuarios que cumplen los
+filtros. Los eventos se leen en un hilo por servidor y se pasan a 'callback' según llegan, así que
+el callback tiene que poder llamarse desde varios hilos. Un evento LOST indica que el servidor ha
+descartado eventos porque no se leían a tiempo: quien necesite el estado exacto tiene que volver a
+consultarlo (LIST_USERS, LIST_CONTENT).
+"""
+import socket
+import threading
+from collections import namedtuple
+
+from netools import CStringReader
+
+# type: PUBLISH, DELETE, CONNECT, DISCONNECT o LOST; info: la descripción en PUBLISH, "ip:puerto"
+# en CONNECT y el número de eventos perdidos en LOST
+Event = namedtuple("Event", ["type", "user", "path", "info"])
+
+
+class EventListener:
+
+    def __init__(self, addresses, request, callback):
+        """
+        'addresses' son los servidores del directorio [(ip, puerto), ...] y 'request' los campos
+        de la petición SUBSCRIBE (operación, fecha, usuario, patrón de usuario, patrón de ruta).
+        """
+        self._addresses = addresses
+        self._request = request
+        self._callback = callback
+        self._sockets = []
+        self._threads = []
+
+    def start(self):
+        """
+        Se suscribe en todos los servidores. Retorna 0 si todos aceptan la suscripción o, si no,
+        el primer código de error recibido (y no queda suscrito en ninguno).
+        """
+        data = "".join(field + "\0" for field in self._request).encode()
+        readers = []
+        try:
+            for address in self._addresses:
+                sck = socket.create_connection(address)
+                self._sockets.append(sck)
+                sck.sendall(data)
+                reader = CStringReader(sck)
+                response = reader.read_byte()
+                if response != 0:
+                    self.close()
+                    return response
+                readers.append(reader)
+        except Exception:
+            self.close()
+            raise
+
+        for reader in readers:
+            thread = threading.Thread(target=self._listen, args=(reader,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return 0
+
+    def _listen(self, reader):
+        while True:
+            try:
+                event = Event(*(reader.read_cstring() for _ in Event._fields))
+            except OSError:
+                return
+            # Sin tipo es que el servidor (o close) ha cerrado la conexión
+            if not event.type:
+                return
+            if event.type == "PING":
+                continue
+            try:
+                self._callback(event)
+            except Exception:
+                pass
+
+    def close(self):
+        """Cierra las conexiones; los hilos de escucha terminan al ver el cierre."""
+        for sck in self._sockets:
+            try:
+                sck.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sck.close()
+        self._sockets = []
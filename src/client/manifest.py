@@ -0,0 +1,208 @@
+"""
+Manifiestos de contenido de los ficheros publicados.
+
+Un fichero se divide en piezas de tamaño fijo y el manifiesto guarda el sha256 de cada pieza.
+El hash del contenido que se publica en el directorio es el sha256 del tamaño, del tamaño de
+pieza y de los hashes de las piezas, así que con él se puede comprobar un manifiesto recibido
+de cualquier seeder y, con el manifiesto, cada pieza según llega.
+"""
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Prefijo con el que GET_MULTIFILE2 busca los seeders por hash en lugar de por nombre
+HASH_PREFIX = "sha256:"
+# Tamaño mínimo de pieza; se duplica hasta que el fichero no tenga más de MAX_PIECES piezas
+PIECE_SIZE = 256 * 1024
+MAX_PIECES = 8192
+# Los ficheros se leen por bloques, sin cargar nunca una pieza entera en memoria
+READ_SIZE = 64 * 1024
+
+
+def piece_size_for(size):
+    piece_size = PIECE_SIZE
+    while size > piece_size * MAX_PIECES:
+        piece_size *= 2
+    return piece_size
+
+
+def piece_bounds(manifest, index):
+    """Retorna (desplazamiento, longitud) de la pieza 'index' del manifiesto."""
+    offset = index * manifest["piece_size"]
+    return offset, min(manifest["piece_size"], manifest["size"] - offset)
+
+
+def content_hash(size, piece_size, pieces):
+    digest = hashlib.sha256(f"{size}:{piece_size}:".encode())
+    for piece in pieces:
+        digest.update(bytes.fromhex(piece))
+    return digest.hexdigest()
+
+
+def hash_range(path, offset, length):
+    """sha256 (en hexadecimal) de 'length' bytes de 'path' a partir de 'offset'."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(offset)
+        while length > 0:
+            data = f.read(min(READ_SIZE, length))
+            if not data:
+                break
+            digest.update(data)
+            length -= len(data)
+    return digest.hexdigest()
+
+
+def build_manifest(path, workers=None):
+    """
+    Calcula el manifiesto de 'path'. Las piezas se reparten entre 'workers' hilos (por defecto,
+    uno por núcleo): hashlib suelta el GIL mientras calcula, así que los hilos aprovechan
+    todos los núcleos en ficheros grandes.
+    """
+    st = os.stat(path)
+    size = st.st_size
+    piece_size = piece_size_for(size)
+    num_pieces = (size + piece_size - 1) // piece_size
+    ranges = [(i * piece_size, min(piece_size, size - i * piece_size)) for i in range(num_pieces)]
+    workers = min(workers or os.cpu_count() or 1, max(num_pieces, 1))
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            pieces = list(pool.map(lambda r: hash_range(path, *r), ranges))
+    else:
+        pieces = [hash_range(path, *r) for r in ranges]
+    return {
+        "mtime_ns": st.st_mtime_ns,
+        "size": size,
+        "piece_size": piece_size,
+        "pieces": pieces,
+        "hash": content_hash(size, piece_size, pieces),
+    }
+
+
+class ManifestCache:
+    """
+    Manifiestos de los ficheros locales guardados en disco (un json por fichero en 'directory').
+    Un manifiesto se vuelve a calcular solo si el fichero ha cambiado de tamaño o de mtime, de
+    modo que publicar o servir un fichero grande no lo recorre cada vez.
+    """
+
+    def __init__(self, directory):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._manifests = {}
+
+    def _cache_path(self, path):
+        return os.path.join(self._directory, hashlib.sha1(path.encode()).hexdigest() + ".json")
+
+    def get(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            manifest = self._manifests.get(path)
+        if manifest is None:
+            try:
+                with open(self._cache_path(path)) as f:
+                    manifest = json.load(f)
+            except (OSError, ValueError):
+                manifest = None
+        if manifest and manifest["mtime_ns"] == st.st_mtime_ns and manifest["size"] == st.st_size:
+            with self._lock:
+                self._manifests[path] = manifest
+            return manifest
+
+        manifest = build_manifest(path)
+        with self._lock:
+            self._manifests[path] = manifest
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            temp_path = self._cache_path(path) + f".{threading.get_ident()}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(temp_path, self._cache_path(path))
+        except OSError:
+            # Sin caché en disco el manifiesto se vuelve a calcular la próxima vez
+            pass
+        return manifest
+
+    def put(self, path, manifest):
+        """
+        Guarda un manifiesto ya comprobado de 'path' (por ejemplo, el de un fichero recién
+        descargado), para no tener que recorrer el fichero la primera vez que se sirva.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        manifest = dict(manifest, mtime_ns=st.st_mtime_ns, size=st.st_size)
+        with self._lock:
+            self._manifests[path] = manifest
+
+
+def encode_pieces(have, num_pieces):
+    """Mapa de piezas en hexadecimal: el dígito k cubre las piezas 4k a 4k+3 (4k es el bit alto)."""
+    digits = []
+    for k in range((num_pieces + 3) // 4):
+        value = sum(8 >> j for j in range(4) if 4 * k + j in have)
+        digits.append("0123456789abcdef"[value])
+    return "".join(digits)
+
+
+def decode_pieces(pieces, num_pieces):
+    """Conjunto de piezas de un mapa hecho con encode_pieces."""
+    have = set()
+    for k, digit in enumerate(pieces[:(num_pieces + 3) // 4]):
+        value = int(digit, 16)
+        have.update(4 * k + j for j in range(4) if value & (8 >> j) and 4 * k + j < num_pieces)
+    return have
+
+
+class PartialFiles:
+    """
+    Ficheros que se están descargando, con su manifiesto y las piezas ya comprobadas, para que
+    ServerThread pueda servir esas piezas a otros clientes antes de que el fichero esté completo.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._files = {}
+
+    def add(self, path, manifest):
+        with self._lock:
+            self._files[os.path.abspath(path)] = (manifest, set())
+
+    def remove(self, path):
+        with self._lock:
+            self._files.pop(os.path.abspath(path), None)
+
+    def mark(self, path, piece):
+        with self._lock:
+            entry = self._files.get(os.path.abspath(path))
+            if entry:
+                entry[1].add(piece)
+
+    def manifest(self, path):
+        """Manifiesto del fichero si se está descargando, o None."""
+        with self._lock:
+            entry = self._files.get(os.path.abspath(path))
+            return entry[0] if entry else None
+
+    def pieces(self, path):
+        with self._lock:
+            manifest, have = self._files[os.path.abspath(path)]
+            return encode_pieces(have, len(manifest["pieces"]))
+
+    def has_range(self, path, offset, length):
+        """
+        None si el fichero no se está descargando; si no, True solo si todas las piezas que
+        cubren el rango están ya comprobadas.
+        """
+        with self._lock:
+            entry = self._files.get(os.path.abspath(path))
+            if entry is None:
+                return None
+            manifest, have = entry
+            if length == 0:
+                return True
+            first = offset // manifest["piece_size"]
+            last = (offset + length - 1) // manifest["piece_size"]
+            return all(piece in have for piece in range(first, last + 1))
@@ -0,0 +1,258 @@
+"""
+Instrumentación de las descargas (GET_FILE, GET_MULTIFILE y GET_BATCH).
+
+Cada descarga es un Transfer, y cada conexión con un seeder dentro de ella una Connection, que
+separa el tiempo hasta que el seeder acepta la petición (conexión) del tiempo recibiendo datos
+(transferencia). Con ello TransferMetrics acumula los totales de la sesión y, por seeder, los
+bytes, las conexiones fallidas, los tiempos, los parones (más de STALL_SECS sin recibir nada) y un
+histograma logarítmico del ritmo de cada conexión en KiB/s, para encontrar los seeders lentos.
+
+Los eventos de cada descarga (start, connect, retry, stall, peer_done y finish; nunca uno por
+bloque recibido) se pasan a los observadores registrados con add_hook y, si se ha indicado un
+fichero con set_file, se escriben en él como líneas JSON. ProgressDisplay es uno de esos
+observadores: muestra en stderr el progreso de las descargas activas.
+"""
+import json
+import sys
+import threading
+import time
+
+# Segundos sin recibir nada a partir de los que una conexión cuenta como parada
+STALL_SECS = 1.0
+# Cubos del histograma de ritmo: el cubo i cuenta las conexiones con menos de 2^i KiB/s
+RATE_BUCKETS = 24
+
+
+class Connection:
+
+    def __init__(self, transfer, peer):
+        self._transfer = transfer
+        self.peer = peer
+        self.bytes = 0
+        self._opened = self._last = time.monotonic()
+        self._connected = None
+
+    def connected(self):
+        """El seeder ha aceptado la petición: a partir de aquí se cuenta como transferencia."""
+        self._connected = self._last = time.monotonic()
+        self._transfer._emit("connect", peer=self.peer, connect_ms=self._ms(self._opened, self._connected))
+
+    def received(self, count):
+        now = time.monotonic()
+        if now - self._last > STALL_SECS:
+            self._transfer._stall(self.peer, self._ms(self._last, now))
+        self._last = now
+        self.bytes += count
+        self._transfer._received(count)
+
+    def close(self, ok):
+        now = time.monotonic()
+        connected = self._connected or now
+        self._transfer._metrics._peer_done(self.peer, ok, self.bytes, connected - self._opened, now - connected)
+        self._transfer._emit("peer_done", peer=self.peer, ok=ok, bytes=self.bytes,
+                             connect_ms=self._ms(self._opened, connected), transfer_ms=self._ms(connected, now))
+
+    @staticmethod
+    def _ms(start, end):
+        return int((end - start) * 1000)
+
+
+class Transfer:
+
+    def __init__(self, metrics, op, name, size=None):
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self.op = op
+        self.name = name
+        self.size = size
+        self.bytes = 0
+        self.retries = 0
+        self.stalls = 0
+        self.started = time.monotonic()
+        self.ok = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        # Una descarga que no se ha cerrado con finish (por ejemplo, por una excepción) ha fallado
+        if self.ok is None:
+            self.finish(False)
+
+    def connection(self, peer):
+        """Abre la contabilidad de una conexión con el seeder 'peer' ("ip:puerto")."""
+        return Connection(self, peer)
+
+    def set_size(self, size):
+        self.size = size
+
+    def retry(self, peer):
+        """Se vuelve a pedir a 'peer' algo que otro seeder no ha podido servir."""
+        with self._lock:
+            self.retries += 1
+        self._emit("retry", peer=peer)
+
+    def finish(self, ok):
+        self.ok = ok
+        seconds = time.monotonic() - self.started
+        self._metrics._finish(self)
+        self._emit("finish", ok=ok, bytes=self.bytes, size=self.size, seconds=round(seconds, 3),
+                   retries=self.retries, stalls=self.stalls)
+
+    def _received(self, count):
+        with self._lock:
+            self.bytes += count
+
+    def _stall(self, peer, gap_ms):
+        with self._lock:
+            self.stalls += 1
+        self._emit("stall", peer=peer, gap_ms=gap_ms)
+
+    def _emit(self, event, **fields):
+        self._metrics._emit(self, dict(event=event, op=self.op, name=self.name, **fields))
+
+
+class _NullConnection:
+
+    def connected(self):
+        pass
+
+    def received(self, count):
+        pass
+
+    def close(self, ok):
+        pass
+
+
+class _NullTransfer:
+
+    def connection(self, peer):
+        return _NullConnection()
+
+    def set_size(self, size):
+        pass
+
+    def retry(self, peer):
+        pass
+
+
+# Para las descargas que no se instrumentan
+NO_TRANSFER = _NullTransfer()
+
+
+class TransferMetrics:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self._file = None
+        self._active = []
+        self.totals = dict(transfers=0, failed=0, bytes=0, retries=0, stalls=0)
+        self.peers = {}
+
+    def add_hook(self, hook):
+        """Registra hook(transfer, record), al que se pasa cada evento (un diccionario)."""
+        self._hooks.append(hook)
+
+    def set_file(self, path):
+        """Escribe los eventos como líneas JSON al final de 'path' (None para dejar de escribirlos)."""
+        new_file = open(path, "a", encoding="utf-8") if path else None
+        with self._lock:
+            old_file, self._file = self._file, new_file
+        if old_file is not None:
+            old_file.close()
+
+    def transfer(self, op, name, size=None):
+        transfer = Transfer(self, op, name, size)
+        with self._lock:
+            self._active.append(transfer)
+        transfer._emit("start", size=size)
+        return transfer
+
+    def active(self):
+        with self._lock:
+            return list(self._active)
+
+    def snapshot(self):
+        """Retorna una copia de (totales, {seeder: contadores})."""
+        with self._lock:
+            return dict(self.totals), {peer: dict(stats, hist=list(stats["hist"]))
+                                       for peer, stats in self.peers.items()}
+
+    def _peer_done(self, peer, ok, received, connect_s, transfer_s):
+        with self._lock:
+            stats = self.peers.setdefault(peer, dict(connections=0, failures=0, bytes=0, connect_s=0.0,
+                                                     transfer_s=0.0, hist=[0] * RATE_BUCKETS))
+            stats["connections"] += 1
+            stats["failures"] += not ok
+            stats["bytes"] += received
+            stats["connect_s"] += connect_s
+            stats["transfer_s"] += transfer_s
+            if received:
+                rate = int(received / 1024 / max(transfer_s, 1e-6))
+                stats["hist"][min(rate.bit_length(), RATE_BUCKETS - 1)] += 1
+
+    def _finish(self, transfer):
+        with self._lock:
+            if transfer in self._active:
+                self._active.remove(transfer)
+            self.totals["transfers"] += 1
+            self.totals["failed"] += not transfer.ok
+            self.totals["bytes"] += transfer.bytes
+            self.totals["retries"] += transfer.retries
+            self.totals["stalls"] += transfer.stalls
+
+    def _emit(self, transfer, record):
+        for hook in self._hooks:
+            try:
+                hook(transfer, record)
+            except Exception:
+                pass
+        with self._lock:
+            if self._file is not None:
+                self._file.write(json.dumps(dict(ts=round(time.time(), 3), **record)) + "\n")
+                self._file.flush()
+
+
+class ProgressDisplay:
+
+    def __init__(self, metrics, interval=0.5, stream=sys.stderr):
+        """
+        Muestra en una línea de 'stream' (solo si es un terminal) el progreso de las descargas
+        activas, cada 'interval' segundos. El hilo que la dibuja arranca con la primera descarga y
+        termina, borrando la línea, cuando ya no queda ninguna activa.
+        """
+        self._metrics = metrics
+        self._interval = interval
+        self._stream = stream
+        self._lock = threading.Lock()
+        self._thread = None
+        self.enabled = True
+        metrics.add_hook(self._on_event)
+
+    def _on_event(self, transfer, record):
+        if record["event"] != "start" or not self.enabled or not self._stream.isatty():
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            active = self._metrics.active()
+            with self._lock:
+                if not active or not self.enabled:
+                    self._thread = None
+                    self._stream.write("\r\033[K")
+                    self._stream.flush()
+                    return
+            self._stream.write("\r\033[K" + "  ".join(self._describe(transfer) for transfer in active))
+            self._stream.flush()
+
+    @staticmethod
+    def _describe(transfer):
+        rate = transfer.bytes / max(time.monotonic() - transfer.started, 1e-6) / (1024 * 1024)
+        done = f"{100 * transfer.bytes // transfer.size}%" if transfer.size else f"{transfer.bytes} B"
+        return f"[{transfer.name} {done} {rate:.2f} MiB/s]"
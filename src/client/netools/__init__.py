@@ -1 +1 @@
-from .netools import recv_cstring
\ No newline at end of file
+from .netools import recv_cstring, CStringReader
\ No newline at end of file
@@ -12,4 +12,55 @@ def recv_cstring(sock: socket.socket, encoding: str = 'utf-8') -> str:
         if not chunk or chunk == b'\0':
             break
         data.extend(chunk)
-    return data.decode(encoding)
\ No newline at end of file
+    return data.decode(encoding)
+
+
+class CStringReader:
+    """
+    Lector con buffer de respuestas formadas por cadenas terminadas en b'\0'.
+    A diferencia de recv_cstring, lee del socket en bloques, de modo que una lista
+    de miles de elementos no supone una llamada a recv por cada byte.
+    """
+
+    def __init__(self, sock: socket.socket, encoding: str = 'utf-8', chunk_size: int = 65536):
+        self._sock = sock
+        self._encoding = encoding
+        self._chunk_size = chunk_size
+        self._buf = bytearray()
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self) -> bool:
+        if self._eof:
+            return False
+        if self._pos:
+            del self._buf[:self._pos]
+            self._pos = 0
+        chunk = self._sock.recv(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf.extend(chunk)
+        return True
+
+    def read_byte(self) -> int:
+        """Retorna el siguiente byte como entero (0 si se cierra la conexión)."""
+        while self._pos >= len(self._buf):
+            if not self._fill():
+                return 0
+        value = self._buf[self._pos]
+        self._pos += 1
+        return value
+
+    def read_cstring(self) -> str:
+        """Retorna la siguiente cadena (sin el b'\0'), o lo que quede si se cierra la conexión."""
+        while True:
+            end = self._buf.find(b'\0', self._pos)
+            if end != -1:
+                data = self._buf[self._pos:end]
+                self._pos = end + 1
+                return data.decode(self._encoding)
+            if not self._fill():
+                data = self._buf[self._pos:]
+                self._pos = len(self._buf)
+                return data.decode(self._encoding)
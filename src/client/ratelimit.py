@@ -0,0 +1,134 @@
+"""
+Límite de subida del seeder (ServerThread).
+
+Cada conexión que sirve datos pasa por dos cubos de fichas: el suyo (límite por conexión) y uno
+global compartido por todas. Los datos se envían en bloques de CHUNK_SIZE y el cubo global
+atiende los bloques por orden de llegada, así que las conexiones activas se turnan y se reparten
+el ancho de banda a partes iguales; lo que una conexión lenta no usa lo aprovechan las demás.
+Los límites se pueden cambiar en cualquier momento (SET UPLOAD_LIMIT / SET UPLOAD_CONN_LIMIT) y
+se aplican también a las conexiones que ya están enviando.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+CHUNK_SIZE = 16 * 1024
+# Sin límite se envía en bloques grandes, pero no de una vez: así un límite nuevo se aplica
+# también a los envíos que ya están en curso
+UNLIMITED_CHUNK_SIZE = 1024 * 1024
+
+
+class TokenBucket:
+    """
+    Cubo de fichas de 'rate' bytes por segundo (0 sin límite). Caben las fichas de una décima de
+    segundo (y al menos un bloque), de modo que tras un rato sin enviar no sale una ráfaga larga.
+    consume() atiende a los hilos por orden de llegada.
+    """
+
+    def __init__(self, rate=0):
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._serving = 0
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._cond:
+            self._rate = rate
+            self._capacity = max(CHUNK_SIZE, rate / 10)
+            self._tokens = self._capacity
+            self._updated = time.monotonic()
+            self._cond.notify_all()
+
+    @property
+    def limited(self):
+        return self._rate > 0
+
+    def consume(self, size):
+        """Espera a que haya 'size' fichas (como mucho CHUNK_SIZE) y las gasta."""
+        if not self._rate:
+            return
+        with self._cond:
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            while self._serving != ticket:
+                self._cond.wait()
+            try:
+                while self._rate:
+                    now = time.monotonic()
+                    self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                    self._updated = now
+                    if self._tokens >= size:
+                        self._tokens -= size
+                        break
+                    # set_rate despierta a los que esperan para aplicar el nuevo límite
+                    self._cond.wait((size - self._tokens) / self._rate)
+            finally:
+                self._serving += 1
+                self._cond.notify_all()
+
+
+class ShapedSocket:
+    """Socket de una conexión del seeder cuyos envíos respetan el límite global y el suyo."""
+
+    def __init__(self, sock, shared, own):
+        self._sock = sock
+        self._shared = shared
+        self._own = own
+
+    def _next_size(self, length):
+        """Tamaño del siguiente bloque: espera a tener sus fichas en los dos cubos."""
+        if not self._own.limited and not self._shared.limited:
+            return min(UNLIMITED_CHUNK_SIZE, length)
+        size = min(CHUNK_SIZE, length)
+        self._own.consume(size)
+        self._shared.consume(size)
+        return size
+
+    def sendall(self, data):
+        view = memoryview(data)
+        start = 0
+        while start < len(view):
+            size = self._next_size(len(view) - start)
+            self._sock.sendall(view[start:start + size])
+            start += size
+
+    def sendfile(self, f, offset, length):
+        """Como socket.sendfile (sin copiar los datos a Python), pero bloque a bloque."""
+        while length > 0:
+            sent = self._sock.sendfile(f, offset, self._next_size(length))
+            if sent == 0:
+                break
+            offset += sent
+            length -= sent
+
+
+class UploadShaper:
+    """Límite de subida del seeder: 'rate' bytes por segundo en total y 'connection_rate' por conexión."""
+
+    def __init__(self, rate=0, connection_rate=0):
+        self._lock = threading.Lock()
+        self._shared = TokenBucket(rate)
+        self._connection_rate = connection_rate
+        self._connections = set()
+
+    def set_limits(self, rate=None, connection_rate=None):
+        if rate is not None:
+            self._shared.set_rate(rate)
+        if connection_rate is not None:
+            with self._lock:
+                self._connection_rate = connection_rate
+                buckets = list(self._connections)
+            for bucket in buckets:
+                bucket.set_rate(connection_rate)
+
+    @contextmanager
+    def connection(self, sock):
+        """Envuelve 'sock' en un ShapedSocket mientras dura el envío."""
+        with self._lock:
+            own = TokenBucket(self._connection_rate)
+            self._connections.add(own)
+        try:
+            yield ShapedSocket(sock, self._shared, own)
+        finally:
+            with self._lock:
+                self._connections.discard(own)
@@ -0,0 +1,69 @@
+"""
+Planificador de transferencias de GET_BATCH.
+
+Todas las descargas de un lote pasan por un mismo planificador con 'max_workers' hilos, que
+además no abre más de 'per_peer' conexiones a la vez con el mismo seeder. Cada hilo libre coge
+la primera descarga pendiente cuyo seeder tiene una conexión libre, así que un seeder ocupado no
+detiene las descargas de los demás.
+"""
+import threading
+import time
+from collections import deque
+
+
+class TransferScheduler:
+
+    def __init__(self, max_workers, per_peer):
+        self.max_workers = max_workers
+        self.per_peer = per_peer
+
+    def run(self, jobs):
+        """
+        Ejecuta 'jobs', una lista de (seeder, función, argumentos), donde cada función retorna
+        (ok, bytes). Retorna (lista de (ok, bytes) en el orden de 'jobs', segundos transcurridos).
+        Si una función lanza una excepción, su descarga cuenta como fallida.
+        """
+        cond = threading.Condition()
+        # Descargas pendientes de cada seeder, y conexiones abiertas con él
+        queues = {}
+        for index, (peer, _, _) in enumerate(jobs):
+            queues.setdefault(peer, deque()).append(index)
+        active = dict.fromkeys(queues, 0)
+        results = [(False, 0)] * len(jobs)
+
+        def next_job():
+            with cond:
+                while queues:
+                    for peer, queue in queues.items():
+                        if active[peer] < self.per_peer:
+                            active[peer] += 1
+                            index = queue.popleft()
+                            if not queue:
+                                del queues[peer]
+                            return index
+                    cond.wait()
+                return None
+
+        def worker():
+            while True:
+                index = next_job()
+                if index is None:
+                    return
+                peer, function, args = jobs[index]
+                try:
+                    results[index] = function(*args)
+                except Exception:
+                    pass
+                finally:
+                    with cond:
+                        active[peer] -= 1
+                        cond.notify_all()
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=worker, daemon=True)
+                   for _ in range(min(self.max_workers, len(jobs)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, time.monotonic() - start
@@ -2,13 +2,27 @@ import os.path
 import threading
 import socket
 
+from compression import COMPRESSED_SUFFIX, choose_codec, parse_codecs, send_stream
 from netools import recv_cstring
+from ratelimit import UploadShaper
 
 
 class ServerThread(threading.Thread):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, heartbeat=None, heartbeat_interval=None, manifests=None, partials=None, shaper=None,
+                 **kwargs):
         super(ServerThread, self).__init__(*args, **kwargs)
         self.__stop_event = threading.Event()
+        # Límite de subida (ratelimit.UploadShaper) por el que pasan los datos que se envían
+        self.__shaper = shaper or UploadShaper()
+        # Caché de manifiestos (manifest.ManifestCache) con la que se responde a GET_MANIFEST
+        self.__manifests = manifests
+        # Ficheros que se están descargando (manifest.PartialFiles): de ellos solo se sirven
+        # las piezas ya comprobadas
+        self.__partials = partials
+        # Mientras el hilo escucha, se llama a heartbeat() cada heartbeat_interval segundos para
+        # que el servidor no dé por caducada la conexión
+        self.__heartbeat = heartbeat
+        self.__heartbeat_interval = heartbeat_interval
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.__socket.bind(('', 0))  # Lo bindeamos al primer puerto libre
         self.__socket.listen(10)
@@ -17,6 +31,10 @@ class ServerThread(threading.Thread):
         self._port = self.__socket.getsockname()[1]
 
     def run(self):
+        if self.__heartbeat and self.__heartbeat_interval:
+            heartbeat_thread = threading.Thread(target=self.heartbeat_loop)
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
         while not self.__stop_event.is_set():
             try:
                 client, addr = self.__socket.accept()
@@ -35,6 +53,14 @@ class ServerThread(threading.Thread):
             finally:
                 pass
 
+    def heartbeat_loop(self):
+        while not self.__stop_event.wait(self.__heartbeat_interval):
+            try:
+                self.__heartbeat()
+            except Exception:
+                # Si el servidor no responde, se vuelve a intentar en el siguiente intervalo
+                pass
+
     def get_port(self):
         return self._port
 
@@ -44,6 +70,11 @@ class ServerThread(threading.Thread):
         self.join()
 
     def handle_connection(self, client):
+        with self.__shaper.connection(client) as shaped:
+            self.__serve(client, shaped)
+
+    def __serve(self, client, shaped):
+        """Atiende una petición; los datos del fichero se envían por 'shaped', que aplica el límite de subida."""
         try:
             # Primero recibimos la operación y la ruta del fichero
             operation = recv_cstring(client)
@@ -52,8 +83,13 @@ class ServerThread(threading.Thread):
             client.close()
             return
 
-        # Verificamos que la operación sea "GET_FILE"
-        if operation != "GET_FILE" and operation != "GET_MULTIFILE":
+        # Las variantes "_Z" de las transferencias negocian la compresión (ver compression.py)
+        compress = operation in ("GET_FILE_Z", "GET_MULTIFILE_Z", "GET_RANGE_Z")
+        if compress:
+            operation = operation[:-len(COMPRESSED_SUFFIX)]
+
+        # Verificamos que la operación sea una de las que atiende el seeder
+        if operation not in ("GET_FILE", "GET_MULTIFILE", "GET_MANIFEST", "GET_RANGE"):
             client.send(b'\x02')
             client.close()
             return
@@ -66,14 +102,13 @@ class ServerThread(threading.Thread):
 
         # Si el fichero existe, lo enviamos al cliente
         if operation == "GET_FILE":
+            if compress:
+                self.__send_compressed(client, shaped, file_path, 0, os.path.getsize(file_path))
+                return
             client.send(b'\x00')
             try:
                 with open(file_path, 'rb') as f:
-                    while True:
-                        data = f.read(1)
-                        if not data:
-                            break
-                        client.send(data)
+                    shaped.sendfile(f, 0, os.path.getsize(file_path))
             except Exception as e:
                 client.send(b'\x02')
             finally:
@@ -101,19 +136,77 @@ class ServerThread(threading.Thread):
             else:
                 length = part_size
 
+            if compress:
+                self.__send_compressed(client, shaped, file_path, offset, length)
+                return
             # Enviar confirmación
             client.send(b'\x00')
             try:
                 with open(file_path, "rb") as f:
-                    f.seek(offset)
-                    bytes_sent = 0
-                    while bytes_sent < length:
-                        chunk = f.read(min(1024, length - bytes_sent))
-                        if not chunk:
-                            break
-                        client.send(chunk)
-                        bytes_sent += len(chunk)
+                    shaped.sendfile(f, offset, length)
             except Exception as e:
                 client.send(b'\x02')
             finally:
                 client.close()
+
+        elif operation == "GET_MANIFEST":
+            # Hash del contenido, tamaño, tamaño de pieza, número de piezas y el hash de cada una
+            try:
+                manifest = self.__partials.manifest(file_path) if self.__partials else None
+                if manifest is None:
+                    manifest = self.__manifests.get(file_path)
+            except Exception as e:
+                client.send(b'\x02')
+                client.close()
+                return
+            fields = [manifest["hash"], str(manifest["size"]), str(manifest["piece_size"]),
+                      str(len(manifest["pieces"]))] + manifest["pieces"]
+            try:
+                client.sendall(b'\x00' + "".join(field + "\0" for field in fields).encode())
+            except Exception as e:
+                pass
+            finally:
+                client.close()
+
+        elif operation == "GET_RANGE":
+            try:
+                # Desplazamiento y longitud del rango, que el cliente alinea con las piezas del
+                # manifiesto para poder comprobarlas según llegan
+                offset = int(recv_cstring(client))
+                length = int(recv_cstring(client))
+                if offset < 0 or length < 0 or offset + length > os.path.getsize(file_path):
+                    raise ValueError("range out of file")
+                # De un fichero a medio descargar solo se sirven piezas ya comprobadas
+                if self.__partials and self.__partials.has_range(file_path, offset, length) is False:
+                    raise ValueError("range not downloaded yet")
+            except Exception as e:
+                client.send(b'\x02')
+                client.close()
+                return
+
+            if compress:
+                self.__send_compressed(client, shaped, file_path, offset, length)
+                return
+            client.send(b'\x00')
+            try:
+                with open(file_path, "rb") as f:
+                    shaped.sendfile(f, offset, length)
+            except Exception as e:
+                pass
+            finally:
+                client.close()
+
+    def __send_compressed(self, client, shaped, file_path, offset, length):
+        """
+        Termina una variante "_Z": lee los códecs que acepta el cliente, elige uno según el
+        contenido (o ninguno) y envía 0, el códec y el rango comprimido (por 'shaped').
+        """
+        try:
+            codec = choose_codec(file_path, parse_codecs(recv_cstring(client)), offset)
+            client.sendall(b'\x00' + codec.encode() + b'\0')
+            with open(file_path, "rb") as f:
+                send_stream(shaped, f, offset, length, codec)
+        except Exception as e:
+            pass
+        finally:
+            client.close()
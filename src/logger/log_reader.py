@@ -0,0 +1,140 @@
+"""
+Lector del log de operaciones generado por el logger RPC.
+
+Reconoce automáticamente los dos formatos que escribe el logger (texto TSV y binario
+compacto) y permite filtrar por usuario, operación o intervalo de tiempo.
+
+Uso:
+    python3 logger/log_reader.py operations.log --user beto --op PUBLISH,DELETE
+    python3 logger/log_reader.py operations.log --rotated --since "19/10/2026 10:00:00" --count
+"""
+import argparse
+import mmap
+import os
+import struct
+import sys
+from datetime import datetime
+
+BIN_MAGIC = b"SSDDLOG1"
+_U16 = struct.Struct(">H")
+_U64 = struct.Struct(">Q")
+
+
+def _iter_binary(data):
+    """Recorre los registros binarios: [u16 len][u64 epoch_ms][4 campos con prefijo u8]."""
+    pos = len(BIN_MAGIC)
+    end = len(data)
+    while pos + 2 <= end:
+        (rec_len,) = _U16.unpack_from(data, pos)
+        rec_end = pos + 2 + rec_len
+        if rec_end > end:
+            break  # Registro truncado (p.ej. el logger murió a mitad de escritura)
+        (epoch_ms,) = _U64.unpack_from(data, pos + 2)
+        p = pos + 10
+        fields = []
+        for _ in range(4):
+            flen = data[p]
+            fields.append(data[p + 1:p + 1 + flen].decode('utf-8', 'replace'))
+            p += 1 + flen
+        yield (epoch_ms, fields[0], fields[1], fields[2], fields[3])
+        pos = rec_end
+
+
+def _iter_text(f):
+    for line in f:
+        parts = line.rstrip(b"\n").split(b"\t")
+        if len(parts) != 5:
+            continue
+        try:
+            epoch_ms = int(parts[0])
+        except ValueError:
+            continue
+        yield (epoch_ms,) + tuple(p.decode('utf-8', 'replace') for p in parts[1:])
+
+
+def read_records(path):
+    """
+    Genera las entradas del fichero como tuplas (epoch_ms, timestamp, usuario, operación, fichero).
+    epoch_ms es el instante en el que el logger recibió la entrada.
+    """
+    with open(path, 'rb') as f:
+        header = f.read(len(BIN_MAGIC))
+        f.seek(0)
+        if header == BIN_MAGIC:
+            if os.fstat(f.fileno()).st_size == len(BIN_MAGIC):
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield from _iter_binary(data)
+        else:
+            yield from _iter_text(f)
+
+
+def log_files(path, rotated=False):
+    """Devuelve los ficheros a leer, del más antiguo (path.N) al más reciente (path)."""
+    files = []
+    if rotated:
+        i = 1
+        while os.path.exists(f"{path}.{i}"):
+            files.append(f"{path}.{i}")
+            i += 1
+        files.reverse()
+    files.append(path)
+    return files
+
+
+def parse_time(value):
+    """Acepta milisegundos desde epoch, 'dd/mm/YYYY HH:MM:SS' (formato del servicio web) o ISO 8601."""
+    if value is None:
+        return None
+    if value.isdigit():
+        return int(value)
+    for fmt in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y"):
+        try:
+            return int(datetime.strptime(value, fmt).timestamp() * 1000)
+        except ValueError:
+            pass
+    return int(datetime.fromisoformat(value).timestamp() * 1000)
+
+
+def filter_records(records, users=None, ops=None, since=None, until=None):
+    for rec in records:
+        if users is not None and rec[2] not in users:
+            continue
+        if ops is not None and rec[3] not in ops:
+            continue
+        if since is not None and rec[0] < since:
+            continue
+        if until is not None and rec[0] > until:
+            continue
+        yield rec
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lector del log de operaciones del logger RPC")
+    parser.add_argument('file', help='Fichero de log')
+    parser.add_argument('--rotated', action='store_true', help='Incluir también los ficheros rotados (file.1, file.2...)')
+    parser.add_argument('--user', help='Usuarios separados por comas')
+    parser.add_argument('--op', help='Operaciones separadas por comas (p.ej. PUBLISH,DELETE)')
+    parser.add_argument('--since', help='Inicio del intervalo (epoch ms, dd/mm/YYYY HH:MM:SS o ISO)')
+    parser.add_argument('--until', help='Fin del intervalo (epoch ms, dd/mm/YYYY HH:MM:SS o ISO)')
+    parser.add_argument('--count', action='store_true', help='Mostrar solo el número de entradas')
+    args = parser.parse_args(argv)
+
+    users = set(args.user.split(",")) if args.user else None
+    ops = set(op.upper() for op in args.op.split(",")) if args.op else None
+    since = parse_time(args.since)
+    until = parse_time(args.until)
+
+    count = 0
+    out = sys.stdout
+    for path in log_files(args.file, args.rotated):
+        for rec in filter_records(read_records(path), users, ops, since, until):
+            count += 1
+            if not args.count:
+                out.write(f"[{rec[1]}] {rec[2]}: {rec[3]} {rec[4]}\n")
+    if args.count:
+        print(count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,417 @@
+#include "log_sink.h"
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <pthread.h>
+#include <signal.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <time.h>
+#include <unistd.h>
+
+#define LOG_BUFFER_SIZE (256 * 1024)
+/*
+ * Tamaño máximo que puede ocupar un registro en cualquiera de los dos formatos. Los campos
+ * del log_entry están acotados por logger.x (como mucho 255 caracteres cada uno).
+ */
+#define LOG_MAX_RECORD (2 + 8 + 4 * 256 + 32)
+
+#define DEFAULT_LOG_FILE "operations.log"
+#define DEFAULT_FLUSH_ENTRIES 64
+#define DEFAULT_FLUSH_MS 200
+#define DEFAULT_MAX_BYTES (64L * 1024 * 1024)
+#define DEFAULT_MAX_FILES 5
+
+typedef struct log_buffer_s {
+  char data[LOG_BUFFER_SIZE];
+  size_t len;
+  uint32_t entries;
+} log_buffer_t;
+
+/*
+ * Se utilizan dos buffers: mientras el hilo de volcado escribe uno en disco, el servicio RPC
+ * sigue añadiendo entradas en el otro. Así, la llamada RPC nunca espera a la escritura salvo
+ * que ambos buffers estén llenos.
+ */
+static struct {
+  pthread_mutex_t lock;
+  pthread_cond_t work_cond; // Despierta al hilo de volcado
+  pthread_cond_t space_cond; // Despierta a quien espera un buffer con espacio
+  pthread_t flusher;
+  log_buffer_t buffers[2];
+  log_buffer_t *active; // Buffer en el que se añaden las entradas
+  log_buffer_t *spare; // Buffer libre (NULL mientras se está volcando)
+  struct timespec first_pending; // Momento en el que llegó la primera entrada del buffer activo
+  int fd;
+  char path[PATH_MAX];
+  bool binary;
+  bool fsync;
+  bool stop;
+  uint32_t flush_entries;
+  uint32_t flush_ms;
+  off_t max_bytes;
+  unsigned int max_files;
+  off_t size; // Bytes escritos en el fichero actual
+} sink = {
+        .lock = PTHREAD_MUTEX_INITIALIZER,
+        .work_cond = PTHREAD_COND_INITIALIZER,
+        .space_cond = PTHREAD_COND_INITIALIZER,
+        .fd = -1,
+};
+
+static pthread_once_t sink_once = PTHREAD_ONCE_INIT;
+static int sink_init_ret = -1;
+
+/*
+ * Función auxiliar que lee un valor numérico de una variable de entorno
+ */
+static unsigned long env_ulong(const char *name, unsigned long def) {
+  const char *value = getenv(name);
+  if (!value || *value == '\0') {
+    return def;
+  }
+  char *end = NULL;
+  unsigned long ret = strtoul(value, &end, 10);
+  if (end == value || *end != '\0') {
+    fprintf(stderr, "logger> invalid value for %s, using %lu\n", name, def);
+    return def;
+  }
+  return ret;
+}
+
+static int write_all(int fd, const char *data, size_t len) {
+  while (len > 0) {
+    ssize_t r = write(fd, data, len);
+    if (r < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      return -1;
+    }
+    data += r;
+    len -= (size_t) r;
+  }
+  return 0;
+}
+
+/*
+ * Abre (o crea) el fichero de log. Si el fichero existente está en un formato distinto
+ * del configurado, se rota antes de escribir en él para no mezclar formatos.
+ */
+static int open_log_file(void) {
+  sink.fd = open(sink.path, O_WRONLY | O_CREAT | O_APPEND | O_CLOEXEC, 0644);
+  if (sink.fd < 0) {
+    perror("logger> error opening log file");
+    return -1;
+  }
+  struct stat st;
+  if (fstat(sink.fd, &st) != 0) {
+    perror("logger> error reading log file size");
+    close(sink.fd);
+    sink.fd = -1;
+    return -1;
+  }
+  sink.size = st.st_size;
+
+  if (sink.size == 0 && sink.binary) {
+    if (write_all(sink.fd, LOG_BIN_MAGIC, LOG_BIN_MAGIC_LEN) != 0) {
+      perror("logger> error writing log header");
+      return -1;
+    }
+    sink.size = LOG_BIN_MAGIC_LEN;
+  }
+  return 0;
+}
+
+static bool existing_file_matches_format(void) {
+  int fd = open(sink.path, O_RDONLY | O_CLOEXEC);
+  if (fd < 0) {
+    return true; // No existe todavía
+  }
+  char header[LOG_BIN_MAGIC_LEN] = {0};
+  ssize_t r = read(fd, header, sizeof(header));
+  close(fd);
+  if (r <= 0) {
+    return true; // Vacío
+  }
+  bool is_binary = r == LOG_BIN_MAGIC_LEN && memcmp(header, LOG_BIN_MAGIC, LOG_BIN_MAGIC_LEN) == 0;
+  return is_binary == sink.binary;
+}
+
+/*
+ * Rota los ficheros: path.(n-1) -> path.n, ..., path -> path.1 y abre un fichero nuevo.
+ */
+static int rotate_log_file(void) {
+  if (sink.fd >= 0) {
+    close(sink.fd);
+    sink.fd = -1;
+  }
+
+  char from[PATH_MAX + 16];
+  char to[PATH_MAX + 16];
+  if (sink.max_files == 0) {
+    unlink(sink.path);
+  } else {
+    for (unsigned int i = sink.max_files - 1; i >= 1; i--) {
+      snprintf(from, sizeof(from), "%s.%u", sink.path, i);
+      snprintf(to, sizeof(to), "%s.%u", sink.path, i + 1);
+      rename(from, to); // Puede no existir, no es un error
+    }
+    snprintf(to, sizeof(to), "%s.1", sink.path);
+    if (rename(sink.path, to) != 0 && errno != ENOENT) {
+      perror("logger> error rotating log file");
+    }
+  }
+  return open_log_file();
+}
+
+/*
+ * Escribe un bloque completo en el fichero. Solo lo llama el hilo de volcado,
+ * así que no necesita el cerrojo.
+ */
+static void write_batch(const log_buffer_t *batch) {
+  if (sink.fd < 0 && open_log_file() != 0) {
+    return;
+  }
+  if (sink.max_bytes > 0 && sink.size > LOG_BIN_MAGIC_LEN &&
+      sink.size + (off_t) batch->len > sink.max_bytes) {
+    if (rotate_log_file() != 0) {
+      return;
+    }
+  }
+  if (write_all(sink.fd, batch->data, batch->len) != 0) {
+    perror("logger> error writing log file");
+    return;
+  }
+  sink.size += (off_t) batch->len;
+  if (sink.fsync) {
+    fdatasync(sink.fd);
+  }
+}
+
+static bool flush_due(void) {
+  if (sink.active->entries == 0) {
+    return false;
+  }
+  if (sink.stop || sink.active->entries >= sink.flush_entries ||
+      sink.active->len + LOG_MAX_RECORD > LOG_BUFFER_SIZE) {
+    return true;
+  }
+  struct timespec now;
+  clock_gettime(CLOCK_REALTIME, &now);
+  long elapsed_ms = (now.tv_sec - sink.first_pending.tv_sec) * 1000L +
+                    (now.tv_nsec - sink.first_pending.tv_nsec) / 1000000L;
+  return elapsed_ms >= (long) sink.flush_ms;
+}
+
+static void *flusher_main(void *arg) {
+  (void) arg;
+  pthread_mutex_lock(&sink.lock);
+  while (true) {
+    while (!flush_due()) {
+      if (sink.stop && sink.active->entries == 0) {
+        pthread_mutex_unlock(&sink.lock);
+        return NULL;
+      }
+      if (sink.active->entries == 0) {
+        pthread_cond_wait(&sink.work_cond, &sink.lock);
+      } else {
+        // Esperamos como mucho hasta que venza el plazo de la primera entrada pendiente
+        struct timespec deadline = sink.first_pending;
+        deadline.tv_sec += sink.flush_ms / 1000;
+        deadline.tv_nsec += (long) (sink.flush_ms % 1000) * 1000000L;
+        if (deadline.tv_nsec >= 1000000000L) {
+          deadline.tv_sec++;
+          deadline.tv_nsec -= 1000000000L;
+        }
+        pthread_cond_timedwait(&sink.work_cond, &sink.lock, &deadline);
+      }
+    }
+
+    // Intercambiamos los buffers y escribimos fuera del cerrojo. Quien esperaba espacio ya puede
+    // escribir en el buffer vacío mientras se vuelca el lleno
+    log_buffer_t *batch = sink.active;
+    sink.active = sink.spare;
+    sink.spare = NULL;
+    pthread_cond_broadcast(&sink.space_cond);
+    pthread_mutex_unlock(&sink.lock);
+
+    write_batch(batch);
+
+    pthread_mutex_lock(&sink.lock);
+    batch->len = 0;
+    batch->entries = 0;
+    sink.spare = batch;
+  }
+}
+
+/*
+ * Hilo que atiende SIGINT y SIGTERM para volcar lo pendiente antes de salir.
+ */
+static void *signal_main(void *arg) {
+  sigset_t *set = (sigset_t *) arg;
+  int sig = 0;
+  sigwait(set, &sig);
+  log_sink_close();
+  printf("\nSaliendo del logger...\n");
+  exit(EXIT_SUCCESS);
+}
+
+static void log_sink_init_once(void) {
+  const char *path = getenv("LOG_FILE");
+  if (!path || *path == '\0') {
+    path = DEFAULT_LOG_FILE;
+  }
+  strncpy(sink.path, path, sizeof(sink.path) - 1);
+
+  const char *format = getenv("LOG_FORMAT");
+  sink.binary = format && strcmp(format, "binary") == 0;
+  sink.flush_entries = (uint32_t) env_ulong("LOG_FLUSH_ENTRIES", DEFAULT_FLUSH_ENTRIES);
+  if (sink.flush_entries == 0) {
+    sink.flush_entries = 1;
+  }
+  sink.flush_ms = (uint32_t) env_ulong("LOG_FLUSH_MS", DEFAULT_FLUSH_MS);
+  sink.max_bytes = (off_t) env_ulong("LOG_MAX_BYTES", DEFAULT_MAX_BYTES);
+  sink.max_files = (unsigned int) env_ulong("LOG_MAX_FILES", DEFAULT_MAX_FILES);
+  sink.fsync = env_ulong("LOG_FSYNC", 0) != 0;
+
+  sink.active = &sink.buffers[0];
+  sink.spare = &sink.buffers[1];
+
+  if (!existing_file_matches_format()) {
+    if (rotate_log_file() != 0) {
+      return;
+    }
+  } else if (open_log_file() != 0) {
+    return;
+  }
+
+  // Bloqueamos las señales de salida en este hilo (y en los que se creen a partir de él)
+  // para que sea el hilo de señales quien las atienda y pueda volcar el buffer.
+  static sigset_t set;
+  sigemptyset(&set);
+  sigaddset(&set, SIGINT);
+  sigaddset(&set, SIGTERM);
+  pthread_sigmask(SIG_BLOCK, &set, NULL);
+
+  pthread_t sig_thread;
+  if (pthread_create(&sig_thread, NULL, signal_main, &set) == 0) {
+    pthread_detach(sig_thread);
+  }
+  if (pthread_create(&sink.flusher, NULL, flusher_main, NULL) != 0) {
+    perror("logger> error creating flush thread");
+    return;
+  }
+
+  printf("logger> writing %s log to %s (flush every %u entries or %u ms)\n", sink.binary ? "binary" : "text",
+         sink.path, sink.flush_entries, sink.flush_ms);
+  fflush(stdout);
+  sink_init_ret = 0;
+}
+
+int log_sink_init(void) {
+  pthread_once(&sink_once, log_sink_init_once);
+  return sink_init_ret;
+}
+
+static void put_u64(char *p, uint64_t v) {
+  for (int i = 7; i >= 0; i--) {
+    p[i] = (char) (v & 0xFF);
+    v >>= 8;
+  }
+}
+
+/*
+ * Copia un campo como cadena con prefijo de longitud de un byte (formato binario)
+ */
+static size_t put_bin_field(char *p, const char *s) {
+  size_t len = strnlen(s, 255);
+  p[0] = (char) (uint8_t) len;
+  memcpy(p + 1, s, len);
+  return len + 1;
+}
+
+/*
+ * Copia un campo separado por tabuladores (formato texto). Los tabuladores y saltos de línea
+ * se sustituyen por espacios para no romper el formato.
+ */
+static size_t put_text_field(char *p, const char *s, char sep) {
+  size_t len = strnlen(s, 255);
+  for (size_t i = 0; i < len; i++) {
+    p[i] = (s[i] == '\t' || s[i] == '\n' || s[i] == '\r') ? ' ' : s[i];
+  }
+  p[len] = sep;
+  return len + 1;
+}
+
+int log_sink_append(const char *timestamp, const char *username, const char *operation, const char *filename) {
+  if (sink_init_ret != 0) {
+    return -1;
+  }
+
+  struct timespec now;
+  clock_gettime(CLOCK_REALTIME, &now);
+  uint64_t epoch_ms = (uint64_t) now.tv_sec * 1000u + (uint64_t) now.tv_nsec / 1000000u;
+
+  pthread_mutex_lock(&sink.lock);
+  while (sink.active->len + LOG_MAX_RECORD > LOG_BUFFER_SIZE) {
+    // Ambos buffers llenos: esperamos a que el hilo de volcado libere uno
+    pthread_cond_signal(&sink.work_cond);
+    pthread_cond_wait(&sink.space_cond, &sink.lock);
+  }
+
+  log_buffer_t *buf = sink.active;
+  char *p = buf->data + buf->len;
+  size_t len = 0;
+  if (sink.binary) {
+    // [u16 longitud][u64 epoch_ms][u8 len + timestamp][u8 len + usuario][u8 len + operación][u8 len + fichero]
+    len = 2;
+    put_u64(p + len, epoch_ms);
+    len += 8;
+    len += put_bin_field(p + len, timestamp);
+    len += put_bin_field(p + len, username);
+    len += put_bin_field(p + len, operation);
+    len += put_bin_field(p + len, filename);
+    p[0] = (char) (((len - 2) >> 8) & 0xFF);
+    p[1] = (char) ((len - 2) & 0xFF);
+  } else {
+    // epoch_ms \t timestamp \t usuario \t operación \t fichero \n
+    len = (size_t) snprintf(p, 32, "%llu\t", (unsigned long long) epoch_ms);
+    len += put_text_field(p + len, timestamp, '\t');
+    len += put_text_field(p + len, username, '\t');
+    len += put_text_field(p + len, operation, '\t');
+    len += put_text_field(p + len, filename, '\n');
+  }
+
+  if (buf->entries == 0) {
+    sink.first_pending = now;
+    pthread_cond_signal(&sink.work_cond); // Arranca el temporizador del volcado
+  }
+  buf->len += len;
+  buf->entries++;
+  if (buf->entries >= sink.flush_entries) {
+    pthread_cond_signal(&sink.work_cond);
+  }
+  pthread_mutex_unlock(&sink.lock);
+  return 0;
+}
+
+void log_sink_close(void) {
+  if (sink_init_ret != 0) {
+    return;
+  }
+  pthread_mutex_lock(&sink.lock);
+  sink.stop = true;
+  pthread_cond_signal(&sink.work_cond);
+  pthread_mutex_unlock(&sink.lock);
+
+  pthread_join(sink.flusher, NULL);
+  if (sink.fd >= 0) {
+    fdatasync(sink.fd);
+    close(sink.fd);
+    sink.fd = -1;
+  }
+  sink_init_ret = -1;
+}
@@ -0,0 +1,58 @@
+#ifndef LOG_SINK_H
+#define LOG_SINK_H
+
+#include <stdbool.h>
+#include <stddef.h>
+#include <stdint.h>
+
+/*
+ * Sumidero de log append-only del logger RPC.
+ *
+ * Las entradas se acumulan en un buffer en memoria y un hilo dedicado las vuelca
+ * al fichero en bloque (group commit) cada LOG_FLUSH_ENTRIES entradas o cada
+ * LOG_FLUSH_MS milisegundos, lo que ocurra antes. Cuando el fichero supera
+ * LOG_MAX_BYTES se rota (fichero -> fichero.1 -> fichero.2 ...).
+ *
+ * Configuración mediante variables de entorno:
+ *   - LOG_FILE           Ruta del fichero de log (por defecto "operations.log").
+ *   - LOG_FORMAT         "text" (TSV, por defecto) o "binary" (registros compactos).
+ *   - LOG_FLUSH_ENTRIES  Entradas por volcado (por defecto 64).
+ *   - LOG_FLUSH_MS       Tiempo máximo que una entrada espera en memoria (por defecto 200).
+ *   - LOG_MAX_BYTES      Tamaño a partir del cual se rota (por defecto 64 MiB, 0 desactiva).
+ *   - LOG_MAX_FILES      Número de ficheros rotados que se conservan (por defecto 5).
+ *   - LOG_FSYNC          Si vale 1, se hace fdatasync tras cada volcado.
+ */
+
+/* Cabecera de los ficheros en formato binario */
+#define LOG_BIN_MAGIC "SSDDLOG1"
+#define LOG_BIN_MAGIC_LEN 8
+
+/**
+ * @brief Inicializa el sumidero leyendo la configuración del entorno. Es idempotente.
+ *
+ * @return int:
+ *   - 0 si se ha inicializado correctamente.
+ *   - -1 si no se ha podido abrir el fichero de log.
+ */
+int log_sink_init(void);
+
+/**
+ * @brief Añade una entrada al buffer del sumidero. No bloquea salvo que ambos buffers estén llenos.
+ *
+ * @param[in] timestamp  Fecha y hora enviada por el cliente.
+ * @param[in] username   Nombre del usuario.
+ * @param[in] operation  Operación realizada.
+ * @param[in] filename   Fichero asociado (puede ser cadena vacía).
+ *
+ * @return int:
+ *   - 0 si se ha añadido correctamente.
+ *   - -1 en caso de error (sumidero no inicializado).
+ */
+int log_sink_append(const char *timestamp, const char *username, const char *operation, const char *filename);
+
+/**
+ * @brief Vuelca todo lo pendiente al fichero y detiene el hilo de volcado.
+ */
+void log_sink_close(void);
+
+#endif // LOG_SINK_H
@@ -1,18 +1,25 @@
 #include "logger.h"
 #include <stdio.h>
 
+#include "log_sink.h"
+
 void *
 log_op_1_svc(log_entry *entry, struct svc_req *rqstp)
 {
   static char res;
-  printf("[%s] %s: %s %s\n",
-          entry->timestamp,
-          entry->username,
-          entry->operation,
-         entry->filename);
+  (void) rqstp;
 
-  // flusheamos la salida
-  fflush(stdout);
+  // Las entradas se añaden al buffer del sumidero, que las vuelca al fichero en bloque.
+  // Si el fichero no está disponible, mantenemos el comportamiento anterior (stdout).
+  if (log_sink_init() != 0 ||
+      log_sink_append(entry->timestamp, entry->username, entry->operation, entry->filename) != 0) {
+    printf("[%s] %s: %s %s\n",
+            entry->timestamp,
+            entry->username,
+            entry->operation,
+           entry->filename);
+    fflush(stdout);
+  }
 
   // Devolvemos un valor cualquiera para indicar que la operación se ha realizado correctamente
   return (void *) &res;
@@ -0,0 +1,121 @@
+/*
+ * Benchmark de contención del almacén de usuarios (claves.c).
+ *
+ * Cada hilo registra y conecta su propio usuario y ejecuta una mezcla de escrituras
+ * (PUBLISH/DELETE sobre su usuario) y lecturas (LIST_CONTENT de otro usuario y, de vez en
+ * cuando, LIST_USERS). Se compila dos veces: bench_claves con las franjas por defecto y
+ * bench_claves_global con una única franja, que equivale al antiguo cerrojo global.
+ *
+ * Uso: bench_claves [-t hilos] [-n operaciones_por_hilo] [-r porcentaje_lecturas]
+ */
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "claves.h"
+
+typedef struct bench_args_s {
+  users_t *db;
+  unsigned int id;
+  unsigned int threads;
+  unsigned long ops;
+  unsigned int read_pct;
+} bench_args_t;
+
+static void *bench_thread(void *arg) {
+  bench_args_t *a = (bench_args_t *) arg;
+  char name[64];
+  char other[64];
+  char path[64];
+  unsigned int seed = a->id * 7919u + 1u;
+
+  snprintf(name, sizeof(name), "bench_user_%u", a->id);
+
+  for (unsigned long i = 0; i < a->ops; i++) {
+    unsigned int r = (unsigned int) rand_r(&seed);
+    if (r % 100 < a->read_pct) {
+      if (r % 1000 == 0) {
+        connected_user_t *users = NULL;
+        uint32_t n = 0;
+        get_connected_users(a->db, name, &users, &n);
+        free(users);
+      } else {
+        file_t *files = NULL;
+        uint32_t n = 0;
+        snprintf(other, sizeof(other), "bench_user_%u", (unsigned int) rand_r(&seed) % a->threads);
+        get_user_files(a->db, name, other, &files, &n);
+        free(files);
+      }
+    } else {
+      // Mantenemos como mucho 16 ficheros por usuario: publicamos y borramos alternativamente
+      snprintf(path, sizeof(path), "/bench/%u/file_%lu", a->id, (i / 2) % 16);
+      if (add_file(a->db, name, path, "bench") == 3) {
+        remove_file(a->db, name, path);
+      }
+    }
+  }
+  return NULL;
+}
+
+int main(int argc, char *argv[]) {
+  unsigned int threads = 8;
+  unsigned long ops = 200000;
+  unsigned int read_pct = 50;
+
+  for (int i = 1; i + 1 < argc; i += 2) {
+    if (strcmp(argv[i], "-t") == 0) {
+      threads = (unsigned int) strtoul(argv[i + 1], NULL, 10);
+    } else if (strcmp(argv[i], "-n") == 0) {
+      ops = strtoul(argv[i + 1], NULL, 10);
+    } else if (strcmp(argv[i], "-r") == 0) {
+      read_pct = (unsigned int) strtoul(argv[i + 1], NULL, 10);
+    } else {
+      fprintf(stderr, "Uso: %s [-t hilos] [-n operaciones_por_hilo] [-r porcentaje_lecturas]\n", argv[0]);
+      return EXIT_FAILURE;
+    }
+  }
+  if (threads == 0 || read_pct > 100) {
+    fprintf(stderr, "Parámetros no válidos\n");
+    return EXIT_FAILURE;
+  }
+
+  users_t db;
+  init_users(&db);
+
+  char name[64];
+  for (unsigned int t = 0; t < threads; t++) {
+    snprintf(name, sizeof(name), "bench_user_%u", t);
+    add_user(&db, name);
+    connect_user(&db, name, "127.0.0.1", (int) (1024 + t % 60000));
+  }
+
+  pthread_t *tids = malloc(threads * sizeof(pthread_t));
+  bench_args_t *args = malloc(threads * sizeof(bench_args_t));
+  if (!tids || !args) {
+    perror("malloc");
+    return EXIT_FAILURE;
+  }
+
+  struct timespec start, end;
+  clock_gettime(CLOCK_MONOTONIC, &start);
+  for (unsigned int t = 0; t < threads; t++) {
+    args[t] = (bench_args_t) {.db = &db, .id = t, .threads = threads, .ops = ops, .read_pct = read_pct};
+    pthread_create(&tids[t], NULL, bench_thread, &args[t]);
+  }
+  for (unsigned int t = 0; t < threads; t++) {
+    pthread_join(tids[t], NULL);
+  }
+  clock_gettime(CLOCK_MONOTONIC, &end);
+
+  double elapsed = (double) (end.tv_sec - start.tv_sec) + (double) (end.tv_nsec - start.tv_nsec) / 1e9;
+  double total = (double) ops * threads;
+  printf("stripes=%d threads=%u ops=%.0f reads=%u%% elapsed=%.3fs throughput=%.0f ops/s\n", USER_STRIPES, threads,
+         total, read_pct, elapsed, total / elapsed);
+
+  destroy(&db);
+  free(tids);
+  free(args);
+  return EXIT_SUCCESS;
+}
@@ -0,0 +1,126 @@
+/*
+ * Benchmark de recuperación del estado persistido (persist.c).
+ *
+ * Publica U usuarios con F ficheros cada uno (por defecto 1000 x 1000 = 1M ficheros) con el
+ * registro de operaciones activo y mide:
+ *   - el tiempo de escribir el registro,
+ *   - el tiempo de recuperar el estado reproduciendo solo el registro,
+ *   - el tiempo de escribir una instantánea,
+ *   - el tiempo de recuperar el estado desde la instantánea.
+ *
+ * Uso: bench_recovery [-u usuarios] [-f ficheros_por_usuario] [-d directorio]
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "claves.h"
+#include "persist.h"
+
+static double now_s(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (double) ts.tv_sec + (double) ts.tv_nsec / 1e9;
+}
+
+static void count_files(void *ctx, const user_t *user) {
+  uint64_t *count = (uint64_t *) ctx;
+  for (const file_t *f = user->files; f; f = f->next) {
+    (*count)++;
+  }
+}
+
+static uint64_t total_files(users_t *db) {
+  uint64_t count = 0;
+  visit_users(db, count_files, &count);
+  return count;
+}
+
+int main(int argc, char *argv[]) {
+  unsigned long users = 1000;
+  unsigned long files = 1000;
+  char dir_template[] = "/tmp/ssdd_bench_XXXXXX";
+  char *dir = NULL;
+
+  for (int i = 1; i + 1 < argc; i += 2) {
+    if (strcmp(argv[i], "-u") == 0) {
+      users = strtoul(argv[i + 1], NULL, 10);
+    } else if (strcmp(argv[i], "-f") == 0) {
+      files = strtoul(argv[i + 1], NULL, 10);
+    } else if (strcmp(argv[i], "-d") == 0) {
+      dir = argv[i + 1];
+    } else {
+      fprintf(stderr, "Uso: %s [-u usuarios] [-f ficheros_por_usuario] [-d directorio]\n", argv[0]);
+      return EXIT_FAILURE;
+    }
+  }
+  if (!dir) {
+    dir = mkdtemp(dir_template);
+    if (!dir) {
+      perror("mkdtemp");
+      return EXIT_FAILURE;
+    }
+  }
+
+  char name[64];
+  char path[128];
+
+  // 1. Estado inicial con el registro activo (sin instantáneas automáticas)
+  users_t db;
+  init_users(&db);
+  if (persist_open(&db, dir, 0, false) != 0) {
+    return EXIT_FAILURE;
+  }
+  double t0 = now_s();
+  for (unsigned long u = 0; u < users; u++) {
+    snprintf(name, sizeof(name), "user_%lu", u);
+    add_user(&db, name);
+    connect_user(&db, name, "127.0.0.1", 4000);
+    for (unsigned long f = 0; f < files; f++) {
+      snprintf(path, sizeof(path), "/home/%s/shared/file_%lu.dat", name, f);
+      add_file(&db, name, path, "benchmark file");
+    }
+  }
+  double t_log = now_s() - t0;
+  uint64_t expected = total_files(&db);
+  persist_close(false);
+  destroy(&db);
+
+  // 2. Recuperación reproduciendo solo el registro
+  users_t db_log;
+  init_users(&db_log);
+  t0 = now_s();
+  if (persist_open(&db_log, dir, 0, false) != 0) {
+    return EXIT_FAILURE;
+  }
+  double t_replay = now_s() - t0;
+  uint64_t got_replay = total_files(&db_log);
+
+  // 3. Instantánea
+  t0 = now_s();
+  persist_snapshot();
+  double t_snapshot = now_s() - t0;
+  persist_close(false);
+  destroy(&db_log);
+
+  // 4. Recuperación desde la instantánea
+  users_t db_snap;
+  init_users(&db_snap);
+  t0 = now_s();
+  if (persist_open(&db_snap, dir, 0, false) != 0) {
+    return EXIT_FAILURE;
+  }
+  double t_restore = now_s() - t0;
+  uint64_t got_snapshot = total_files(&db_snap);
+  persist_close(false);
+  destroy(&db_snap);
+
+  printf("users=%lu files=%llu dir=%s\n", users, (unsigned long long) expected, dir);
+  printf("log write:              %.3fs\n", t_log);
+  printf("recovery from log:      %.3fs (%llu files)\n", t_replay, (unsigned long long) got_replay);
+  printf("snapshot write:         %.3fs\n", t_snapshot);
+  printf("recovery from snapshot: %.3fs (%llu files)\n", t_restore, (unsigned long long) got_snapshot);
+
+  return (got_replay == expected && got_snapshot == expected) ? EXIT_SUCCESS : EXIT_FAILURE;
+}
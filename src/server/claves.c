@@ -4,16 +4,58 @@
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
 
 
-// Variables globales
-static pthread_rwlock_t lock = PTHREAD_RWLOCK_INITIALIZER;
+uint32_t user_hash(const char *name) {
+  uint32_t h = 2166136261u;
+  for (const unsigned char *p = (const unsigned char *) name; *p; p++) {
+    h ^= *p;
+    h *= 16777619u;
+  }
+  return h;
+}
+
+static unsigned int stripe_of(const char *name) { return user_hash(name) % USER_STRIPES; }
+
+static uint64_t now_ns(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t) ts.tv_sec * 1000000000ull + (uint64_t) ts.tv_nsec;
+}
+
+/*
+ * Toman el cerrojo de una franja. Primero se intenta sin bloquear; solo si la franja está
+ * ocupada se mide cuánto se espera, de modo que el caso sin contención no paga el reloj.
+ */
+static void stripe_rdlock(users_t *db, unsigned int s) {
+  if (pthread_rwlock_tryrdlock(&db->locks[s]) == 0) {
+    return;
+  }
+  uint64_t start = now_ns();
+  pthread_rwlock_rdlock(&db->locks[s]);
+  atomic_fetch_add(&db->lock_waits, 1);
+  atomic_fetch_add(&db->lock_wait_ns, now_ns() - start);
+}
+
+static void stripe_wrlock(users_t *db, unsigned int s) {
+  if (pthread_rwlock_trywrlock(&db->locks[s]) == 0) {
+    return;
+  }
+  uint64_t start = now_ns();
+  pthread_rwlock_wrlock(&db->locks[s]);
+  atomic_fetch_add(&db->lock_waits, 1);
+  atomic_fetch_add(&db->lock_wait_ns, now_ns() - start);
+}
+
 /*
- * Esta variable se utiliza para llevar la cuenta de los usuarios conectados, de
- * esta manera, podemos reservar memoria para la cantidad de usuarios exacta por ejemplo,
- * cuando la función list_users devuelve la lista de usuarios conectados, junto con su ip y puerto.
+ * Notifica un cambio a todos los observadores. Se llama con el cerrojo de la franja tomado.
  */
-u_int32_t users_connected = 0;
+static void notify(users_t *db, claves_op_t op, const user_t *user, const file_t *file) {
+  for (unsigned int i = 0; i < db->num_hooks; i++) {
+    db->hooks[i](db->hook_ctx[i], op, user, file);
+  }
+}
 
 static int find_user_internal(user_t *head, const char *name, user_t **out_user) {
   if (!out_user || !name) {
@@ -30,17 +72,83 @@ static int find_user_internal(user_t *head, const char *name, user_t **out_user)
   return 1; // No encontrado
 }
 
-int add_user(user_t **head, const char *name) {
-  if (!head || !name) {
+int check_connected(users_t *db, const char *name) {
+  unsigned int s = stripe_of(name);
+  stripe_rdlock(db, s);
+  user_t *usr = NULL;
+  int ret = find_user_internal(db->stripes[s], name, &usr);
+  if (ret != 0 || !usr) {
+    pthread_rwlock_unlock(&db->locks[s]);
+    return 1;
+  }
+  ret = usr->connected ? 0 : 2;
+  pthread_rwlock_unlock(&db->locks[s]);
+  return ret;
+}
+
+bool is_connected_address(users_t *db, const char *ip, int port) {
+  if (!db || !ip) {
+    return false;
+  }
+  for (unsigned int s = 0; s < USER_STRIPES; s++) {
+    stripe_rdlock(db, s);
+    for (user_t *u = db->stripes[s]; u != NULL; u = u->next) {
+      if (u->connected && u->port == port && strcmp(u->ip, ip) == 0) {
+        pthread_rwlock_unlock(&db->locks[s]);
+        return true;
+      }
+    }
+    pthread_rwlock_unlock(&db->locks[s]);
+  }
+  return false;
+}
+
+void init_users(users_t *db) {
+  for (unsigned int i = 0; i < USER_STRIPES; i++) {
+    db->stripes[i] = NULL;
+    pthread_rwlock_init(&db->locks[i], NULL);
+  }
+  atomic_init(&db->connected, 0);
+  atomic_init(&db->lock_waits, 0);
+  atomic_init(&db->lock_wait_ns, 0);
+  db->num_hooks = 0;
+}
+
+int add_hook(users_t *db, claves_hook_t hook, void *ctx) {
+  if (!db || !hook || db->num_hooks >= MAX_CLAVES_HOOKS) {
+    return 1;
+  }
+  db->hooks[db->num_hooks] = hook;
+  db->hook_ctx[db->num_hooks] = ctx;
+  db->num_hooks++;
+  return 0;
+}
+
+void visit_users(users_t *db, claves_visit_t visit, void *ctx) {
+  if (!db || !visit) {
+    return;
+  }
+  for (unsigned int s = 0; s < USER_STRIPES; s++) {
+    stripe_rdlock(db, s);
+    for (user_t *u = db->stripes[s]; u != NULL; u = u->next) {
+      visit(ctx, u);
+    }
+    pthread_rwlock_unlock(&db->locks[s]);
+  }
+}
+
+int add_user(users_t *db, const char *name) {
+  if (!db || !name) {
     return 2; // Error en parámetros
   }
 
-  pthread_rwlock_wrlock(&lock);
+  unsigned int s = stripe_of(name);
+  stripe_wrlock(db, s);
 
-  user_t *temp = *head;
+  user_t *temp = db->stripes[s];
   while (temp) {
     if (strcmp(temp->name, name) == 0) {
-      pthread_rwlock_unlock(&lock);
+      pthread_rwlock_unlock(&db->locks[s]);
       return 1; // Usuario ya existe
     }
     temp = temp->next;
@@ -48,7 +156,7 @@ int add_user(user_t **head, const char *name) {
 
   user_t *new_user = (user_t *) malloc(sizeof(user_t));
   if (!new_user) {
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 2; // Fallo de reserva
   }
   memset(new_user, 0, sizeof(user_t));
@@ -56,30 +164,33 @@ int add_user(user_t **head, const char *name) {
 
   new_user->connected = false;
   new_user->files = NULL;
-  new_user->next = *head;
-  *head = new_user;
+  new_user->next = db->stripes[s];
+  db->stripes[s] = new_user;
+  notify(db, CLAVES_REGISTER, new_user, NULL);
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return 0; // Éxito
 }
 
-int remove_user(user_t **head, const char *name) {
-  if (!head || !*head || !name) {
+int remove_user(users_t *db, const char *name) {
+  if (!db || !name) {
     return 2;
   }
 
-  pthread_rwlock_wrlock(&lock);
+  unsigned int s = stripe_of(name);
+  stripe_wrlock(db, s);
 
-  user_t *curr = *head;
+  user_t *curr = db->stripes[s];
   user_t *prev = NULL;
 
   while (curr) {
     if (strcmp(curr->name, name) == 0) {
       if (!prev) {
-        *head = curr->next;
+        db->stripes[s] = curr->next;
       } else {
         prev->next = curr->next;
       }
+      notify(db, CLAVES_UNREGISTER, curr, NULL);
       file_t *f = curr->files;
       while (f) {
         file_t *aux = f;
@@ -88,106 +199,176 @@ int remove_user(user_t **head, const char *name) {
       }
       // Si lo hemos encontrado y está conectado  hay que tenerlo en cuenta
       if (curr->connected) {
-        users_connected--;
+        atomic_fetch_sub(&db->connected, 1);
       }
       free(curr);
-      pthread_rwlock_unlock(&lock);
+      pthread_rwlock_unlock(&db->locks[s]);
       return 0; // Éxito
     }
     prev = curr;
     curr = curr->next;
   }
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return 1; // Usuario no encontrado
 }
 
-int find_user(user_t *head, const char *name, user_t **out_user) {
-  pthread_rwlock_rdlock(&lock);
-  int ret = find_user_internal(head, name, out_user);
-  pthread_rwlock_unlock(&lock);
+int find_user(users_t *db, const char *name, user_t **out_user) {
+  if (!db || !name) {
+    return 2;
+  }
+  unsigned int s = stripe_of(name);
+  stripe_rdlock(db, s);
+  int ret = find_user_internal(db->stripes[s], name, out_user);
+  pthread_rwlock_unlock(&db->locks[s]);
   return ret;
 }
 
-int connect_user(user_t **head, const char *name, const char *ip, int port) {
-  if (!head || !name || !ip) {
+int connect_user(users_t *db, const char *name, const char *ip, int port) {
+  if (!db || !name || !ip) {
     return 3;
   }
   if (port < 1024 || port > 65535) {
     return 3; // Puerto no válido
   }
 
-  pthread_rwlock_wrlock(&lock);
+  unsigned int s = stripe_of(name);
+  stripe_wrlock(db, s);
 
   user_t *usr = NULL;
-  int ret = find_user_internal(*head, name, &usr);
+  int ret = find_user_internal(db->stripes[s], name, &usr);
   if (ret == 0 && usr) {
     if (usr->connected) {
-      pthread_rwlock_unlock(&lock);
+      pthread_rwlock_unlock(&db->locks[s]);
       return 2; // Ya conectado
     }
     usr->connected = true;
     usr->port = port;
     strncpy(usr->ip, ip, sizeof(usr->ip) - 1);
-    users_connected++;
+    usr->lease_expiry = 0;
+    usr->lease_gen++;
+    atomic_fetch_add(&db->connected, 1);
+    notify(db, CLAVES_CONNECT, usr, NULL);
 
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 0;
   }
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return (ret == 1) ? 1 : 3;
 }
 
-int disconnect_user(user_t **head, const char *name) {
-  if (!head || !name) {
+int disconnect_user(users_t *db, const char *name) {
+  if (!db || !name) {
     return 3;
   }
 
-  pthread_rwlock_wrlock(&lock);
+  unsigned int s = stripe_of(name);
+  stripe_wrlock(db, s);
 
   user_t *usr = NULL;
-  int ret = find_user_internal(*head, name, &usr);
+  int ret = find_user_internal(db->stripes[s], name, &usr);
   if (ret == 0 && usr) {
     if (!usr->connected) {
-      pthread_rwlock_unlock(&lock);
+      pthread_rwlock_unlock(&db->locks[s]);
       return 2; // No estaba conectado
     }
     usr->connected = false;
     usr->port = 0;
     memset(usr->ip, 0, sizeof(usr->ip));
-    users_connected--;
-    pthread_rwlock_unlock(&lock);
+    usr->lease_expiry = 0;
+    atomic_fetch_sub(&db->connected, 1);
+    notify(db, CLAVES_DISCONNECT, usr, NULL);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 0;
   }
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return (ret == 1) ? 1 : 3;
 }
 
-int add_file(user_t **head, const char *username, const char *path, const char *description) {
-  if (!head || !username || !path || !description) {
+int renew_lease(users_t *db, const char *name, uint64_t expiry, uint32_t *gen) {
+  if (!db || !name) {
+    return 3;
+  }
+
+  unsigned int s = stripe_of(name);
+  stripe_wrlock(db, s);
+
+  user_t *usr = NULL;
+  int ret = find_user_internal(db->stripes[s], name, &usr);
+  if (ret != 0 || !usr) {
+    pthread_rwlock_unlock(&db->locks[s]);
+    return 1; // No existe
+  }
+  if (!usr->connected) {
+    pthread_rwlock_unlock(&db->locks[s]);
+    return 2; // No conectado
+  }
+  usr->lease_expiry = expiry;
+  if (gen) {
+    *gen = usr->lease_gen;
+  }
+  pthread_rwlock_unlock(&db->locks[s]);
+  return 0;
+}
+
+int expire_lease(users_t *db, const char *name, uint32_t gen, uint64_t now, uint64_t *expiry) {
+  if (!db || !name || !expiry) {
+    return 2;
+  }
+
+  unsigned int s = stripe_of(name);
+  stripe_wrlock(db, s);
+
+  user_t *usr = NULL;
+  int ret = find_user_internal(db->stripes[s], name, &usr);
+  if (ret != 0 || !usr || !usr->connected || usr->lease_gen != gen || usr->lease_expiry == 0) {
+    pthread_rwlock_unlock(&db->locks[s]);
+    return 2; // La concesión ya no existe
+  }
+  if (usr->lease_expiry > now) {
+    *expiry = usr->lease_expiry;
+    pthread_rwlock_unlock(&db->locks[s]);
+    return 1; // Renovada entretanto
+  }
+
+  // Caducada: el usuario pasa a estar desconectado, igual que con DISCONNECT
+  usr->connected = false;
+  usr->port = 0;
+  memset(usr->ip, 0, sizeof(usr->ip));
+  usr->lease_expiry = 0;
+  atomic_fetch_sub(&db->connected, 1);
+  notify(db, CLAVES_DISCONNECT, usr, NULL);
+  pthread_rwlock_unlock(&db->locks[s]);
+  return 0;
+}
+
+static int add_file_internal(users_t *db, const char *username, const char *path, const char *description,
+                             const char *hash, bool require_connected) {
+  if (!db || !username || !path || !description) {
     return 4;
   }
 
-  pthread_rwlock_wrlock(&lock);
+  unsigned int s = stripe_of(username);
+  stripe_wrlock(db, s);
 
   user_t *usr = NULL;
-  int ret_user = find_user_internal(*head, username, &usr);
+  int ret_user = find_user_internal(db->stripes[s], username, &usr);
   if (ret_user != 0 || !usr) {
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 1; // No existe
   }
 
-  if (!usr->connected) {
-    pthread_rwlock_unlock(&lock);
+  if (require_connected && !usr->connected) {
+    pthread_rwlock_unlock(&db->locks[s]);
     return 2; // No conectado
   }
 
   file_t *temp = usr->files;
   while (temp) {
     if (strcmp(temp->path, path) == 0) {
-      pthread_rwlock_unlock(&lock);
+      pthread_rwlock_unlock(&db->locks[s]);
       return 3; // Fichero ya publicado
     }
     temp = temp->next;
@@ -195,35 +376,93 @@ int add_file(user_t **head, const char *username, const char *path, const char *
 
   file_t *new_file = (file_t *) malloc(sizeof(file_t));
   if (!new_file) {
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 4; // Error de memoria
   }
   memset(new_file, 0, sizeof(file_t));
   strncpy(new_file->path, path, sizeof(new_file->path) - 1);
   strncpy(new_file->description, description, sizeof(new_file->description) - 1);
+  if (hash) {
+    strncpy(new_file->hash, hash, sizeof(new_file->hash) - 1);
+  }
   new_file->next = usr->files;
   usr->files = new_file;
+  notify(db, CLAVES_PUBLISH, usr, new_file);
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return 0;
 }
 
-int remove_file(user_t **head, const char *username, const char *path) {
-  if (!head || !username || !path) {
+int add_file(users_t *db, const char *username, const char *path, const char *description) {
+  return add_file_internal(db, username, path, description, NULL, true);
+}
+
+int add_file_with_hash(users_t *db, const char *username, const char *path, const char *description,
+                       const char *hash) {
+  return add_file_internal(db, username, path, description, hash, true);
+}
+
+int restore_add_file(users_t *db, const char *username, const char *path, const char *description,
+                     const char *hash) {
+  return add_file_internal(db, username, path, description, hash, false);
+}
+
+int restore_files(users_t *db, const char *username, const file_t *files, uint32_t n) {
+  if (!db || !username || (!files && n > 0)) {
     return 4;
   }
 
-  pthread_rwlock_wrlock(&lock);
+  unsigned int s = stripe_of(username);
+  stripe_wrlock(db, s);
 
   user_t *usr = NULL;
-  int ret_user = find_user_internal(*head, username, &usr);
+  int ret_user = find_user_internal(db->stripes[s], username, &usr);
   if (ret_user != 0 || !usr) {
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
+    return 1; // No existe
+  }
+
+  // Buscamos el final de la lista para conservar el orden de la instantánea
+  file_t **tail = &usr->files;
+  while (*tail) {
+    tail = &(*tail)->next;
+  }
+  for (uint32_t i = 0; i < n; i++) {
+    file_t *new_file = (file_t *) malloc(sizeof(file_t));
+    if (!new_file) {
+      pthread_rwlock_unlock(&db->locks[s]);
+      return 4; // Error de memoria
+    }
+    memset(new_file, 0, sizeof(file_t));
+    strncpy(new_file->path, files[i].path, sizeof(new_file->path) - 1);
+    strncpy(new_file->description, files[i].description, sizeof(new_file->description) - 1);
+    strncpy(new_file->hash, files[i].hash, sizeof(new_file->hash) - 1);
+    *tail = new_file;
+    tail = &new_file->next;
+    notify(db, CLAVES_PUBLISH, usr, new_file);
+  }
+
+  pthread_rwlock_unlock(&db->locks[s]);
+  return 0;
+}
+
+static int remove_file_internal(users_t *db, const char *username, const char *path, bool require_connected) {
+  if (!db || !username || !path) {
+    return 4;
+  }
+
+  unsigned int s = stripe_of(username);
+  stripe_wrlock(db, s);
+
+  user_t *usr = NULL;
+  int ret_user = find_user_internal(db->stripes[s], username, &usr);
+  if (ret_user != 0 || !usr) {
+    pthread_rwlock_unlock(&db->locks[s]);
     return 1; // usuario no existe
   }
 
-  if (!usr->connected) {
-    pthread_rwlock_unlock(&lock);
+  if (require_connected && !usr->connected) {
+    pthread_rwlock_unlock(&db->locks[s]);
     return 2; // no conectado
   }
 
@@ -236,30 +475,204 @@ int remove_file(user_t **head, const char *username, const char *path) {
       } else {
         prev->next = curr->next;
       }
+      notify(db, CLAVES_DELETE, usr, curr);
       free(curr);
-      pthread_rwlock_unlock(&lock);
+      pthread_rwlock_unlock(&db->locks[s]);
       return 0;
     }
     prev = curr;
     curr = curr->next;
   }
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return 3; // no se encontró
 }
 
-int find_file(user_t *head, const char *username, const char *path, file_t **out_file) {
-  if (!head || !username || !path || !out_file) {
+int remove_file(users_t *db, const char *username, const char *path) {
+  return remove_file_internal(db, username, path, true);
+}
+
+/*
+ * Conjunto de rutas para las operaciones por lotes (direccionamiento abierto). Cada hueco
+ * guarda la posición + 1 de la ruta en 'keys', o 0 si está libre.
+ */
+typedef struct {
+  const char **keys;
+  uint32_t *slots;
+  size_t mask;
+} path_set_t;
+
+static int path_set_init(path_set_t *set, size_t n) {
+  size_t cap = 16;
+  while (cap < 2 * n) {
+    cap <<= 1;
+  }
+  set->keys = (const char **) malloc((n ? n : 1) * sizeof(char *));
+  set->slots = (uint32_t *) calloc(cap, sizeof(uint32_t));
+  set->mask = cap - 1;
+  if (!set->keys || !set->slots) {
+    free(set->keys);
+    free(set->slots);
+    return -1;
+  }
+  return 0;
+}
+
+/* Devuelve el hueco que contiene 'path' o, si no está, el hueco libre en el que iría */
+static uint32_t *path_set_find(const path_set_t *set, const char *path) {
+  size_t i = user_hash(path) & set->mask;
+  while (set->slots[i] != 0 && strcmp(set->keys[set->slots[i] - 1], path) != 0) {
+    i = (i + 1) & set->mask;
+  }
+  return &set->slots[i];
+}
+
+static void path_set_free(path_set_t *set) {
+  free(set->keys);
+  free(set->slots);
+}
+
+/*
+ * Busca al usuario, comprueba que esté conectado y toma el cerrojo de su franja para las
+ * operaciones por lotes. Si devuelve 0, el cerrojo queda tomado.
+ */
+static int lock_connected_user(users_t *db, const char *username, unsigned int *s, user_t **usr) {
+  *s = stripe_of(username);
+  stripe_wrlock(db, *s);
+  int ret_user = find_user_internal(db->stripes[*s], username, usr);
+  if (ret_user != 0 || !*usr) {
+    pthread_rwlock_unlock(&db->locks[*s]);
+    return 1; // No existe
+  }
+  if (!(*usr)->connected) {
+    pthread_rwlock_unlock(&db->locks[*s]);
+    return 2; // No conectado
+  }
+  return 0;
+}
+
+int add_files(users_t *db, const char *username, const file_t *files, uint32_t n, uint8_t *results) {
+  if (!db || !username || (!files && n > 0) || (!results && n > 0)) {
+    return 4;
+  }
+
+  unsigned int s;
+  user_t *usr = NULL;
+  int ret = lock_connected_user(db, username, &s, &usr);
+  if (ret != 0) {
+    return ret;
+  }
+
+  size_t existing = 0;
+  for (file_t *temp = usr->files; temp; temp = temp->next) {
+    existing++;
+  }
+  path_set_t set;
+  if (path_set_init(&set, existing + n) != 0) {
+    pthread_rwlock_unlock(&db->locks[s]);
+    return 4; // Error de memoria
+  }
+  uint32_t keys = 0;
+  for (file_t *temp = usr->files; temp; temp = temp->next) {
+    uint32_t *slot = path_set_find(&set, temp->path);
+    set.keys[keys++] = temp->path;
+    *slot = keys;
+  }
+
+  notify(db, CLAVES_BATCH_BEGIN, usr, NULL);
+  for (uint32_t i = 0; i < n; i++) {
+    uint32_t *slot = path_set_find(&set, files[i].path);
+    if (*slot != 0) {
+      results[i] = 3; // Fichero ya publicado
+      continue;
+    }
+    file_t *new_file = (file_t *) malloc(sizeof(file_t));
+    if (!new_file) {
+      results[i] = 4; // Error de memoria
+      continue;
+    }
+    memset(new_file, 0, sizeof(file_t));
+    strncpy(new_file->path, files[i].path, sizeof(new_file->path) - 1);
+    strncpy(new_file->description, files[i].description, sizeof(new_file->description) - 1);
+    strncpy(new_file->hash, files[i].hash, sizeof(new_file->hash) - 1);
+    new_file->next = usr->files;
+    usr->files = new_file;
+    set.keys[keys++] = new_file->path;
+    *slot = keys;
+    notify(db, CLAVES_PUBLISH, usr, new_file);
+    results[i] = 0;
+  }
+  notify(db, CLAVES_BATCH_END, usr, NULL);
+
+  pthread_rwlock_unlock(&db->locks[s]);
+  path_set_free(&set);
+  return 0;
+}
+
+int remove_files(users_t *db, const char *username, const char *const *paths, uint32_t n, uint8_t *results) {
+  if (!db || !username || (!paths && n > 0) || (!results && n > 0)) {
+    return 4;
+  }
+
+  path_set_t set;
+  if (path_set_init(&set, n) != 0) {
+    return 4; // Error de memoria
+  }
+  for (uint32_t i = 0; i < n; i++) {
+    results[i] = 3; // No se encontró, salvo que aparezca al recorrer la lista
+    uint32_t *slot = path_set_find(&set, paths[i]);
+    if (*slot == 0) {
+      set.keys[i] = paths[i];
+      *slot = i + 1;
+    }
+  }
+
+  unsigned int s;
+  user_t *usr = NULL;
+  int ret = lock_connected_user(db, username, &s, &usr);
+  if (ret != 0) {
+    path_set_free(&set);
+    return ret;
+  }
+
+  notify(db, CLAVES_BATCH_BEGIN, usr, NULL);
+  file_t **link = &usr->files;
+  while (*link) {
+    file_t *curr = *link;
+    uint32_t *slot = path_set_find(&set, curr->path);
+    if (*slot == 0) {
+      link = &curr->next;
+      continue;
+    }
+    results[*slot - 1] = 0;
+    *link = curr->next;
+    notify(db, CLAVES_DELETE, usr, curr);
+    free(curr);
+  }
+  notify(db, CLAVES_BATCH_END, usr, NULL);
+
+  pthread_rwlock_unlock(&db->locks[s]);
+  path_set_free(&set);
+  return 0;
+}
+
+int restore_remove_file(users_t *db, const char *username, const char *path) {
+  return remove_file_internal(db, username, path, false);
+}
+
+int find_file(users_t *db, const char *username, const char *path, file_t **out_file) {
+  if (!db || !username || !path || !out_file) {
     return 3;
   }
 
-  pthread_rwlock_rdlock(&lock);
+  unsigned int s = stripe_of(username);
+  stripe_rdlock(db, s);
 
   user_t *usr = NULL;
-  int ret_user = find_user_internal(head, username, &usr);
+  int ret_user = find_user_internal(db->stripes[s], username, &usr);
   if (ret_user != 0 || !usr) {
     *out_file = NULL;
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 1;
   }
 
@@ -267,51 +680,68 @@ int find_file(user_t *head, const char *username, const char *path, file_t **out
   while (temp) {
     if (strcmp(temp->path, path) == 0) {
       *out_file = temp;
-      pthread_rwlock_unlock(&lock);
+      pthread_rwlock_unlock(&db->locks[s]);
       return 0;
     }
     temp = temp->next;
   }
   *out_file = NULL;
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return 2;
 }
 
-int get_connected_users(user_t **head, const char *username, connected_user_t **array, uint32_t *size) {
-  if (!head || !array) {
-    return 3;
-  }
-
-  pthread_rwlock_rdlock(&lock);
+int get_connected_users(users_t *db, const char *username, connected_user_t **array, uint32_t *size) {
+  return get_connected_users_page(db, username, 0, UINT32_MAX, array, size, NULL);
+}
 
-  user_t *usr = NULL;
-  int ret_user = find_user_internal(*head, username, &usr);
-  if (ret_user != 0 || !usr) {
-    pthread_rwlock_unlock(&lock);
-    return 1; // No existe
+int get_connected_users_page(users_t *db, const char *username, uint32_t offset, uint32_t limit,
+                             connected_user_t **array, uint32_t *size, uint32_t *total) {
+  if (!db || !array || !size) {
+    return 3;
   }
 
-  // comprobamos que el usuario está conectado
-  if (!usr->connected) {
-    pthread_rwlock_unlock(&lock);
-    return 2; // No conectado
+  int ret_user = username ? check_connected(db, username) : 0;
+  if (ret_user != 0) {
+    return ret_user; // 1 si no existe, 2 si no está conectado
   }
 
-  // Primero, reservamos memoria para el array en función de la
-  // cantidad de usuarios conectados que haya por el momento.
+  // Reservamos memoria en función de la cantidad de usuarios conectados que haya en este
+  // momento (o del tamaño de la página, si es menor). Como las franjas se recorren una a una,
+  // el número puede cambiar mientras tanto, así que el array crece si hace falta.
   // OJO: LIBERAR ESTA MEMORIA ES RESPONSABILIDAD DEL CALLER
-  *array = (connected_user_t *) malloc(users_connected * sizeof(connected_user_t));
+  uint32_t capacity = atomic_load(&db->connected) + 16;
+  if (limit < capacity) {
+    capacity = limit ? limit : 1;
+  }
+  *array = (connected_user_t *) malloc(capacity * sizeof(connected_user_t));
   if (!*array) {
-    pthread_rwlock_unlock(&lock);
     return 3; // Error de memoria
   }
 
-  *size = users_connected;
-
-  size_t count = 0;
-  for (user_t *u = *head; u != NULL; u = u->next) {
-    if (u->connected) {
+  // 'seen' cuenta todos los conectados; solo se copian los que caen en [offset, offset + limit)
+  uint32_t seen = 0;
+  uint32_t count = 0;
+  for (unsigned int s = 0; s < USER_STRIPES; s++) {
+    stripe_rdlock(db, s);
+    for (user_t *u = db->stripes[s]; u != NULL; u = u->next) {
+      if (!u->connected) {
+        continue;
+      }
+      if (seen++ < offset || count >= limit) {
+        continue;
+      }
+      if (count == capacity) {
+        capacity *= 2;
+        connected_user_t *tmp = (connected_user_t *) realloc(*array, capacity * sizeof(connected_user_t));
+        if (!tmp) {
+          pthread_rwlock_unlock(&db->locks[s]);
+          free(*array);
+          *array = NULL;
+          return 3; // Error de memoria
+        }
+        *array = tmp;
+      }
       strncpy((*array)[count].name, u->name, sizeof((*array)[count].name) - 1);
       (*array)[count].name[sizeof((*array)[count].name) - 1] = '\0';
 
@@ -321,91 +751,103 @@ int get_connected_users(user_t **head, const char *username, connected_user_t **
       (*array)[count].port = u->port;
       count++;
     }
+    pthread_rwlock_unlock(&db->locks[s]);
+  }
+  *size = count;
+  if (total) {
+    *total = seen;
   }
-  pthread_rwlock_unlock(&lock);
 
   return 0; // Éxito
 }
 
-int get_user_files(user_t **head, const char *username, const char *usertocheck, file_t **array, uint32_t *size) {
-  if (!head || !username || !usertocheck || !array) {
+int get_user_files(users_t *db, const char *username, const char *usertocheck, file_t **array, uint32_t *size) {
+  return get_user_files_page(db, username, usertocheck, 0, UINT32_MAX, array, size, NULL);
+}
+
+int get_user_files_page(users_t *db, const char *username, const char *usertocheck, uint32_t offset, uint32_t limit,
+                        file_t **array, uint32_t *size, uint32_t *total) {
+  if (!db || !usertocheck || !array || !size) {
     return 4;
   }
 
-  pthread_rwlock_rdlock(&lock);
-
-  // comprobacmos que el usuario que solicita la lista de ficheros existe
-  user_t *usr = NULL;
-  int ret_user = find_user_internal(*head, username, &usr);
-  if (ret_user != 0 || !usr) {
-    pthread_rwlock_unlock(&lock);
-    return 1; // No existe
-  }
-
-  // comprobamos que el usuario que solicita la lista de ficheros está conectado
-  if (!usr->connected) {
-    pthread_rwlock_unlock(&lock);
-    return 2; // No conectado
+  // comprobamos que el usuario que solicita la lista de ficheros existe y está conectado
+  int ret_user = username ? check_connected(db, username) : 0;
+  if (ret_user != 0) {
+    return ret_user; // 1 si no existe, 2 si no está conectado
   }
 
   // comprobamos que el usuario del que se quieren obtener los ficheros existe
+  unsigned int s = stripe_of(usertocheck);
+  stripe_rdlock(db, s);
   user_t *usr_to_check = NULL;
-  int ret_user_to_check = find_user_internal(*head, usertocheck, &usr_to_check);
+  int ret_user_to_check = find_user_internal(db->stripes[s], usertocheck, &usr_to_check);
   if (ret_user_to_check != 0 || !usr_to_check) {
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 3; // No existe
   }
 
-  // Como todo ha salido bien, reservamos memoria para el array
-  // en función de la cantidad de ficheros que haya publicado el usuario
+  // Como todo ha salido bien, reservamos memoria para el array en función de la cantidad
+  // de ficheros que haya publicado el usuario y que caigan dentro de la página
   // OJO: LIBERAR ESTA MEMORIA ES RESPONSABILIDAD DEL CALLER
+  uint32_t all = 0;
+  for (file_t *temp = usr_to_check->files; temp; temp = temp->next) {
+    all++;
+  }
   uint32_t count = 0;
-  file_t *temp = usr_to_check->files;
-  while (temp) {
-    count++;
-    temp = temp->next;
+  if (offset < all) {
+    count = (all - offset < limit) ? all - offset : limit;
   }
 
   // Ahora ya podemos reservar memoria
-  *array = (file_t *) malloc(count * sizeof(file_t));
+  *array = (file_t *) malloc((count ? count : 1) * sizeof(file_t));
   if (!*array) {
-    pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
     return 4; // Error de memoria
   }
   *size = count;
+  if (total) {
+    *total = all;
+  }
 
-  int i = 0;
-  for (file_t *f = usr_to_check->files; f; f = f->next, i++) {
+  file_t *f = usr_to_check->files;
+  for (uint32_t skip = 0; skip < offset && f; skip++) {
+    f = f->next;
+  }
+  for (uint32_t i = 0; i < count && f; f = f->next, i++) {
     strncpy((*array)[i].path, f->path, sizeof((*array)[i].path));
     (*array)[i].path[sizeof((*array)[i].path) - 1] = '\0';
+    memcpy((*array)[i].hash, f->hash, sizeof((*array)[i].hash));
   }
 
-  pthread_rwlock_unlock(&lock);
+  pthread_rwlock_unlock(&db->locks[s]);
   return 0; // Éxito
 }
 
-void destroy(user_t **head) {
-  pthread_rwlock_wrlock(&lock);
-
-  if (!head) {
-    pthread_rwlock_unlock(&lock);
+void destroy(users_t *db) {
+  if (!db) {
     return;
   }
 
-  user_t *curr_user = *head;
-  while (curr_user) {
-    user_t *tmp_user = curr_user;
-    curr_user = curr_user->next;
+  for (unsigned int s = 0; s < USER_STRIPES; s++) {
+    stripe_wrlock(db, s);
+
+    user_t *curr_user = db->stripes[s];
+    while (curr_user) {
+      user_t *tmp_user = curr_user;
+      curr_user = curr_user->next;
 
-    file_t *curr_file = tmp_user->files;
-    while (curr_file) {
-      file_t *tmp_file = curr_file;
-      curr_file = curr_file->next;
-      free(tmp_file);
+      file_t *curr_file = tmp_user->files;
+      while (curr_file) {
+        file_t *tmp_file = curr_file;
+        curr_file = curr_file->next;
+        free(tmp_file);
+      }
+      free(tmp_user);
     }
-    free(tmp_user);
-  }
-  *head = NULL;
+    db->stripes[s] = NULL;
 
-  pthread_rwlock_unlock(&lock);
+    pthread_rwlock_unlock(&db->locks[s]);
+  }
+  atomic_store(&db->connected, 0);
 }
@@ -1,14 +1,29 @@
 #ifndef CLAVES_H
 #define CLAVES_H
 
+#include <pthread.h>
+#include <stdatomic.h>
 #include <stdbool.h>
 #include <stddef.h>
 #include <stdint.h>
 
+/*
+ * Número de franjas (stripes) en las que se reparten los usuarios. Cada franja tiene su
+ * propia lista y su propio cerrojo, de manera que las operaciones sobre usuarios de franjas
+ * distintas no se bloquean entre sí. Se puede redefinir al compilar (-DUSER_STRIPES=1
+ * equivale al antiguo cerrojo global).
+ */
+#ifndef USER_STRIPES
+#define USER_STRIPES 64
+#endif
+
 // CABECERAS
 typedef struct user user_t;
 typedef struct file file_t;
 
+/** Longitud del hash del contenido de un fichero (sha256 en hexadecimal) */
+#define CONTENT_HASH_LEN 64
+
 /**
  * @struct file
  * @brief Estructura que representa un fichero publicado por un usuario.
@@ -16,6 +31,7 @@ typedef struct file file_t;
 struct file {
   char path[256]; /**< Ruta completa del fichero (máx. 255 caracteres) */
   char description[256]; /**< Descripción asociada al fichero (máx. 255 caracteres) */
+  char hash[CONTENT_HASH_LEN + 1]; /**< Hash del contenido calculado por el cliente, o "" si no lo envió */
   file_t *next; /**< Puntero al siguiente fichero en la lista enlazada */
 };
 
@@ -28,10 +44,51 @@ struct user {
   char ip[16]; /**< Dirección IP del usuario (máx. 15 caracteres) */
   int port; /**< Puerto asociado al usuario */
   bool connected; /**< Indica si el usuario está conectado o no */
+  uint64_t lease_expiry; /**< Instante (s, reloj monótono) en el que caduca la conexión; 0 si no caduca */
+  uint32_t lease_gen; /**< Número de conexión; distingue las concesiones de conexiones anteriores */
   file_t *files; /**< Lista de ficheros publicados por el usuario */
   user_t *next; /**< Puntero al siguiente usuario en la lista enlazada */
 };
 
+/**
+ * @brief Cambios que el almacén notifica a los observadores registrados con add_hook.
+ */
+typedef enum claves_op_e {
+  CLAVES_REGISTER,
+  CLAVES_UNREGISTER,
+  CLAVES_CONNECT,
+  CLAVES_DISCONNECT,
+  CLAVES_PUBLISH,
+  CLAVES_DELETE,
+  CLAVES_BATCH_BEGIN, /**< Empieza un lote de PUBLISH/DELETE (add_files, remove_files) */
+  CLAVES_BATCH_END, /**< Termina el lote: los cambios anteriores ya se han notificado */
+} claves_op_t;
+
+/*
+ * Observador de cambios. Se invoca tras aplicar cada cambio y con el cerrojo de la franja
+ * del usuario todavía tomado, de modo que los cambios de un mismo usuario se notifican en el
+ * mismo orden en el que se aplican. 'file' solo es distinto de NULL en PUBLISH y DELETE.
+ * No debe bloquearse ni volver a llamar al almacén.
+ */
+typedef void (*claves_hook_t)(void *ctx, claves_op_t op, const user_t *user, const file_t *file);
+
+#define MAX_CLAVES_HOOKS 4
+
+/**
+ * @struct users
+ * @brief Almacén de usuarios repartido en franjas según el hash del nombre.
+ */
+typedef struct users_s {
+  user_t *stripes[USER_STRIPES]; /**< Lista enlazada de usuarios de cada franja */
+  pthread_rwlock_t locks[USER_STRIPES]; /**< Cerrojo de cada franja */
+  atomic_uint connected; /**< Número de usuarios conectados */
+  atomic_ullong lock_waits; /**< Veces que se ha tenido que esperar por el cerrojo de una franja */
+  atomic_ullong lock_wait_ns; /**< Tiempo total esperado por los cerrojos de las franjas */
+  claves_hook_t hooks[MAX_CLAVES_HOOKS]; /**< Observadores de cambios */
+  void *hook_ctx[MAX_CLAVES_HOOKS]; /**< Contexto de cada observador */
+  unsigned int num_hooks; /**< Número de observadores registrados */
+} users_t;
+
 /*
  * La siguiente estructura es lo que se devuelve cuando se ejecuta la función
  * get_connected_users, que devuelve una lista de usuarios conectados.
@@ -42,10 +99,53 @@ typedef struct connected_user_s {
   int port;
 } connected_user_t;
 
+/**
+ * @brief Hash FNV-1a del nombre de usuario. Sus bits bajos determinan la franja (y por tanto
+ * el cerrojo) en la que vive cada usuario; los altos, el servidor del directorio particionado
+ * al que pertenece.
+ */
+uint32_t user_hash(const char *name);
+
+/**
+ * @brief Inicializa un almacén de usuarios vacío.
+ *
+ * @param[out] db  Almacén a inicializar.
+ */
+void init_users(users_t *db);
+
+/**
+ * @brief Registra un observador de cambios. Debe llamarse antes de que el almacén
+ * se use desde varios hilos.
+ *
+ * @param[in,out] db    Almacén de usuarios.
+ * @param[in]     hook  Función a invocar tras cada cambio.
+ * @param[in]     ctx   Contexto que se pasa a la función.
+ *
+ * @return int:
+ *   - 0 si se ha registrado correctamente.
+ *   - 1 si ya hay MAX_CLAVES_HOOKS observadores.
+ */
+int add_hook(users_t *db, claves_hook_t hook, void *ctx);
+
+/*
+ * Función que recibe cada usuario al recorrer el almacén con visit_users.
+ */
+typedef void (*claves_visit_t)(void *ctx, const user_t *user);
+
+/**
+ * @brief Recorre todos los usuarios (con sus ficheros), franja a franja y con el cerrojo de
+ * lectura de cada franja tomado mientras se visitan sus usuarios.
+ *
+ * @param[in] db     Almacén de usuarios.
+ * @param[in] visit  Función a invocar por cada usuario.
+ * @param[in] ctx    Contexto que se pasa a la función.
+ */
+void visit_users(users_t *db, claves_visit_t visit, void *ctx);
+
 /**
  * @brief Añade un nuevo usuario a la lista.
  *
- * @param[in,out] head  Doble puntero a la cabeza de la lista de usuarios.
+ * @param[in,out] db    Almacén de usuarios.
  * @param[in]     name  Nombre del usuario.
  * @param[in]     ip    Dirección IP del usuario.
  * @param[in]     port  Puerto del usuario.
@@ -55,12 +155,12 @@ typedef struct connected_user_s {
  *   - 1 si el usuario ya existe.
  *   - 2 en caso de error (parámetros nulos o fallo al reservar memoria).
  */
-int add_user(user_t **head, const char *name);
+int add_user(users_t *db, const char *name);
 
 /**
  * @brief Elimina de la lista al usuario cuyo nombre coincide.
  *
- * @param[in,out] head  Doble puntero a la cabeza de la lista de usuarios.
+ * @param[in,out] db    Almacén de usuarios.
  * @param[in]     name  Nombre del usuario a eliminar.
  *
  * @return int:
@@ -68,12 +168,12 @@ int add_user(user_t **head, const char *name);
  *   - 1 si no se encuentra el usuario.
  *   - 2 en caso de error (parámetros nulos).
  */
-int remove_user(user_t **head, const char *name);
+int remove_user(users_t *db, const char *name);
 
 /**
  * @brief Busca a un usuario por nombre y lo devuelve via parámetro 'out_user'.
  *
- * @param[in]  head       Cabeza de la lista de usuarios.
+ * @param[in]  db         Almacén de usuarios.
  * @param[in]  name       Nombre del usuario a buscar.
  * @param[out] out_user   Puntero que contendrá la dirección del usuario hallado.
  *
@@ -82,12 +182,36 @@ int remove_user(user_t **head, const char *name);
  *   - 1 si no se encuentra.
  *   - 2 en caso de error (parámetros nulos).
  */
-int find_user(user_t *head, const char *name, user_t **out_user);
+int find_user(users_t *db, const char *name, user_t **out_user);
+
+/**
+ * @brief Comprueba, bajo el cerrojo de su franja, que el usuario existe y está conectado.
+ *
+ * @param[in] db    Almacén de usuarios.
+ * @param[in] name  Nombre del usuario.
+ *
+ * @return int:
+ *   - 0 si está conectado.
+ *   - 1 si no existe.
+ *   - 2 si no está conectado.
+ */
+int check_connected(users_t *db, const char *name);
+
+/**
+ * @brief Comprueba si hay algún usuario conectado con la dirección ip:puerto indicada.
+ *
+ * @param[in] db    Almacén de usuarios.
+ * @param[in] ip    Dirección IP.
+ * @param[in] port  Puerto.
+ *
+ * @return true si algún usuario conectado tiene esa dirección, false en otro caso.
+ */
+bool is_connected_address(users_t *db, const char *ip, int port);
 
 /**
  * @brief Marca como 'conectado' a un usuario si existe.
  *
- * @param[in] head  Cabeza de la lista de usuarios.
+ * @param[in] db    Almacén de usuarios.
  * @param[in] name  Nombre del usuario a "conectar".
  *
  * @return int:
@@ -96,12 +220,12 @@ int find_user(user_t *head, const char *name, user_t **out_user);
  *   - 2 en caso de que el usuario ya esté conectado.
  *   - 3 cualquier otro caso.
  */
-int connect_user(user_t **head, const char *name, const char *ip, int port);
+int connect_user(users_t *db, const char *name, const char *ip, int port);
 
 /**
  * @brief Marca como 'desconectado' a un usuario si existe.
  *
- * @param[in] head  Cabeza de la lista de usuarios.
+ * @param[in] db    Almacén de usuarios.
  * @param[in] name  Nombre del usuario a "desconectar".
  *
  * @return int:
@@ -110,12 +234,45 @@ int connect_user(user_t **head, const char *name, const char *ip, int port);
  *   - 2 si el usuario no está conectado.
  *   - 3 en caso de error (parámetros nulos).
  */
-int disconnect_user(user_t **head, const char *name);
+int disconnect_user(users_t *db, const char *name);
+
+/**
+ * @brief Renueva la concesión (lease) de un usuario conectado.
+ *
+ * @param[in]  db      Almacén de usuarios.
+ * @param[in]  name    Nombre del usuario.
+ * @param[in]  expiry  Nuevo instante de caducidad (s, reloj monótono).
+ * @param[out] gen     Número de conexión del usuario (puede ser NULL).
+ *
+ * @return int:
+ *   - 0 si se ha renovado correctamente.
+ *   - 1 si el usuario no existe.
+ *   - 2 si el usuario no está conectado (la concesión ya había caducado).
+ *   - 3 en caso de error (parámetros nulos).
+ */
+int renew_lease(users_t *db, const char *name, uint64_t expiry, uint32_t *gen);
+
+/**
+ * @brief Desconecta al usuario si su concesión ha caducado. Solo se tiene en cuenta la
+ * conexión 'gen': si el usuario se ha desconectado y vuelto a conectar, no se toca.
+ *
+ * @param[in]  db      Almacén de usuarios.
+ * @param[in]  name    Nombre del usuario.
+ * @param[in]  gen     Número de conexión al que se refiere la concesión.
+ * @param[in]  now     Instante actual (s, reloj monótono).
+ * @param[out] expiry  Caducidad vigente si la concesión se ha renovado entretanto.
+ *
+ * @return int:
+ *   - 0 si la concesión había caducado y el usuario se ha desconectado.
+ *   - 1 si la concesión sigue vigente hasta *expiry.
+ *   - 2 si la concesión ya no existe (usuario borrado, desconectado o reconectado).
+ */
+int expire_lease(users_t *db, const char *name, uint32_t gen, uint64_t now, uint64_t *expiry);
 
 /**
  * @brief Añade un fichero a la lista del usuario 'username'.
  *
- * @param[in] head         Cabeza de la lista de usuarios.
+ * @param[in] db           Almacén de usuarios.
  * @param[in] username     Nombre del usuario dueño del fichero.
  * @param[in] path         Ruta del fichero.
  * @param[in] size         Tamaño del fichero en bytes.
@@ -128,12 +285,23 @@ int disconnect_user(user_t **head, const char *name);
  *   - 3 si el fichero ya está publicado.
  *   - 4 si ocurre otro error (parámetros nulos o fallo en malloc).
  */
-int add_file(user_t **head, const char *username, const char *path, const char *description);
+int add_file(users_t *db, const char *username, const char *path, const char *description);
+
+/**
+ * @brief Igual que add_file, pero guardando además el hash del contenido del fichero, que
+ * permite buscar seeders por contenido y no solo por nombre.
+ *
+ * @param[in] hash  Hash del contenido (CONTENT_HASH_LEN caracteres) o NULL si no se conoce.
+ *
+ * @return int: los mismos valores que add_file.
+ */
+int add_file_with_hash(users_t *db, const char *username, const char *path, const char *description,
+                       const char *hash);
 
 /**
  * @brief Elimina un fichero 'path' de la lista del usuario 'username'.
  *
- * @param[in] head       Cabeza de la lista de usuarios.
+ * @param[in] db         Almacén de usuarios.
  * @param[in] username   Nombre del usuario dueño del fichero.
  * @param[in] path       Ruta del fichero a eliminar.
  *
@@ -144,12 +312,46 @@ int add_file(user_t **head, const char *username, const char *path, const char *
  *   - 3 si el fichero no existe.
  *   - 4 si ocurre otro error (parámetros nulos).
  */
-int remove_file(user_t **head, const char *username, const char *path);
+int remove_file(users_t *db, const char *username, const char *path);
+
+/**
+ * @brief Añade varios ficheros a la lista del usuario 'username' tomando el cerrojo una sola
+ * vez. Los ficheros ya publicados se detectan con una tabla hash de rutas, sin recorrer la
+ * lista por cada fichero.
+ *
+ * @param[in]  db        Almacén de usuarios.
+ * @param[in]  username  Nombre del usuario.
+ * @param[in]  files     Ficheros a añadir (se copian la ruta, la descripción y el hash).
+ * @param[in]  n         Número de ficheros.
+ * @param[out] results   Resultado de cada fichero: 0 si se ha añadido, 3 si ya estaba
+ *                       publicado y 4 si no había memoria.
+ *
+ * @return int:
+ *   - 0 si se han procesado los ficheros (ver 'results').
+ *   - 1 si el usuario no existe.
+ *   - 2 si el usuario no está conectado.
+ *   - 4 si ocurre otro error (parámetros nulos o fallo en malloc).
+ */
+int add_files(users_t *db, const char *username, const file_t *files, uint32_t n, uint8_t *results);
+
+/**
+ * @brief Elimina varios ficheros de la lista del usuario 'username' tomando el cerrojo una sola
+ * vez y recorriendo la lista una única vez.
+ *
+ * @param[in]  db        Almacén de usuarios.
+ * @param[in]  username  Nombre del usuario.
+ * @param[in]  paths     Rutas de los ficheros a eliminar.
+ * @param[in]  n         Número de rutas.
+ * @param[out] results   Resultado de cada ruta: 0 si se ha eliminado, 3 si no existía.
+ *
+ * @return int: los mismos valores que add_files.
+ */
+int remove_files(users_t *db, const char *username, const char *const *paths, uint32_t n, uint8_t *results);
 
 /**
  * @brief Busca un fichero 'path' dentro del usuario 'username' y, si lo halla, lo devuelve en *out_file.
  *
- * @param[in]  head       Cabeza de la lista de usuarios.
+ * @param[in]  db         Almacén de usuarios.
  * @param[in]  username   Nombre del usuario.
  * @param[in]  path       Ruta del fichero a buscar.
  * @param[out] out_file   Puntero al que se asignará el fichero hallado (o NULL si no se halla).
@@ -160,15 +362,16 @@ int remove_file(user_t **head, const char *username, const char *path);
  *   - 2 si el fichero no existe.
  *   - 3 en caso de error (parámetros nulos).
  */
-int find_file(user_t *head, const char *username, const char *path, file_t **out_file);
+int find_file(users_t *db, const char *username, const char *path, file_t **out_file);
 
 /**
  * @brief Devuelve un array de usuarios conectados. OJO: la responsabilidad
  * de liberar la memoria del array es del caller, ya que esta función reserva memoria
  * en función del número de usuarios conectados.
  *
- * @param[in]  head       Cabeza de la lista de usuarios.
- * @param[in]  username   Nombre del usuario que solicita la lista.
+ * @param[in]  db         Almacén de usuarios.
+ * @param[in]  username   Nombre del usuario que solicita la lista (NULL si pertenece a otro
+ *                        servidor del directorio particionado y no se puede comprobar aquí).
  * @param[out] array      Array donde se almacenarán los usuarios conectados.
  * @param[out] size       Tamaño del array (número de usuarios conectados).
  *
@@ -178,15 +381,34 @@ int find_file(user_t *head, const char *username, const char *path, file_t **out
  *   - 2 si el usuario no está conectado.
  *   - 3 en cualquier otro caso (parámetros nulos o fallo en malloc).
  */
-int get_connected_users(user_t **head, const char *username, connected_user_t **array, uint32_t *size);
+int get_connected_users(users_t *db, const char *username, connected_user_t **array, uint32_t *size);
+
+/**
+ * @brief Igual que get_connected_users, pero solo devuelve la página [offset, offset + limit)
+ * de la lista. Los usuarios se recorren siempre en el mismo orden (franja a franja), de modo
+ * que, si no hay cambios entre llamadas, las páginas sucesivas cubren la lista completa.
+ *
+ * @param[in]  db         Almacén de usuarios.
+ * @param[in]  username   Nombre del usuario que solicita la lista.
+ * @param[in]  offset     Posición del primer usuario de la página.
+ * @param[in]  limit      Número máximo de usuarios de la página.
+ * @param[out] array      Array donde se almacenarán los usuarios de la página.
+ * @param[out] size       Tamaño del array.
+ * @param[out] total      Número total de usuarios conectados (puede ser NULL).
+ *
+ * @return int: los mismos valores que get_connected_users.
+ */
+int get_connected_users_page(users_t *db, const char *username, uint32_t offset, uint32_t limit,
+                             connected_user_t **array, uint32_t *size, uint32_t *total);
 
 /**
  * @brief Devuelve un array de ficheros publicados por el usuario 'username'.
  * OJO: la responsabilidad de liberar la memoria del array es del caller, ya que
  * esta función reserva memoria en función del número de ficheros publicados.
  *
- * @param[in]  head       Cabeza de la lista de usuarios.
- * @param[in]  username   Nombre del usuario que solicita la lista.
+ * @param[in]  db         Almacén de usuarios.
+ * @param[in]  username   Nombre del usuario que solicita la lista (NULL si pertenece a otro
+ *                        servidor del directorio particionado y no se puede comprobar aquí).
  * @param[in]  usertocheck Nombre del usuario cuyos ficheros se quieren obtener.
  * @param[out] array      Array donde se almacenarán los ficheros publicados.
  * @param[out] size       Tamaño del array (número de ficheros publicados).
@@ -198,13 +420,61 @@ int get_connected_users(user_t **head, const char *username, connected_user_t **
  *   - 3 si el usuario del que se quieren obtener los ficheros no existe.
  *   - 4 en cualquier otro caso (parámetros nulos o fallo en malloc).
  */
-int get_user_files(user_t **head, const char *username, const char *usertocheck, file_t **array, uint32_t *size);
+int get_user_files(users_t *db, const char *username, const char *usertocheck, file_t **array, uint32_t *size);
+
+/**
+ * @brief Igual que get_user_files, pero solo devuelve la página [offset, offset + limit)
+ * de la lista de ficheros del usuario 'usertocheck'.
+ *
+ * @param[in]  db           Almacén de usuarios.
+ * @param[in]  username     Nombre del usuario que solicita la lista.
+ * @param[in]  usertocheck  Nombre del usuario cuyos ficheros se quieren obtener.
+ * @param[in]  offset       Posición del primer fichero de la página.
+ * @param[in]  limit        Número máximo de ficheros de la página.
+ * @param[out] array        Array donde se almacenarán los ficheros de la página.
+ * @param[out] size         Tamaño del array.
+ * @param[out] total        Número total de ficheros publicados (puede ser NULL).
+ *
+ * @return int: los mismos valores que get_user_files.
+ */
+int get_user_files_page(users_t *db, const char *username, const char *usertocheck, uint32_t offset, uint32_t limit,
+                        file_t **array, uint32_t *size, uint32_t *total);
+
+/**
+ * @brief Añade al final de la lista del usuario una serie de ficheros sin comprobar si está
+ * conectado ni si los ficheros ya estaban publicados. Se usa al reconstruir el estado desde
+ * una instantánea, en la que no hay duplicados.
+ *
+ * @param[in] db        Almacén de usuarios.
+ * @param[in] username  Nombre del usuario dueño de los ficheros.
+ * @param[in] files     Ficheros a añadir (se copian la ruta, la descripción y el hash).
+ * @param[in] n         Número de ficheros.
+ *
+ * @return int:
+ *   - 0 si se añaden correctamente.
+ *   - 1 si el usuario no existe.
+ *   - 4 si ocurre otro error (parámetros nulos o fallo en malloc).
+ */
+int restore_files(users_t *db, const char *username, const file_t *files, uint32_t n);
+
+/**
+ * @brief Igual que add_file, pero sin exigir que el usuario esté conectado. Se usa al
+ * reproducir el registro de operaciones.
+ */
+int restore_add_file(users_t *db, const char *username, const char *path, const char *description,
+                     const char *hash);
+
+/**
+ * @brief Igual que remove_file, pero sin exigir que el usuario esté conectado. Se usa al
+ * reproducir el registro de operaciones.
+ */
+int restore_remove_file(users_t *db, const char *username, const char *path);
 
 /**
  * @brief Libera toda la memoria asociada a la lista de usuarios y sus ficheros.
  *
- * @param[in,out] head Doble puntero a la cabeza de la lista.
+ * @param[in,out] db Almacén de usuarios.
  */
-void destroy(user_t **head);
+void destroy(users_t *db);
 
 #endif // CLAVES_H
@@ -0,0 +1,349 @@
+#include "events.h"
+#include <errno.h>
+#include <fnmatch.h>
+#include <pthread.h>
+#include <stdatomic.h>
+#include <stdbool.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/socket.h>
+#include <time.h>
+
+#include "lines.h"
+
+/* Cambios que caben en la cola del observador; si se llena, se descartan */
+#define EVENTS_QUEUE_LEN 1024
+/* Cambios que el hilo repartidor saca de la cola de una vez */
+#define EVENTS_BATCH 64
+
+typedef struct event_s {
+  claves_op_t op;
+  char user[256];
+  char path[256];
+  char info[256];
+} event_t;
+
+struct subscriber_s {
+  char user_pattern[256];
+  char path_pattern[256];
+  pthread_mutex_t lock;
+  pthread_cond_t cond;
+  msg_buffer_t pending; /**< Eventos ya codificados pendientes de enviar */
+  uint64_t lost; /**< Eventos descartados desde el último envío */
+  subscriber_t *next;
+};
+
+static struct {
+  // Cola del observador
+  pthread_mutex_t lock;
+  pthread_cond_t cond;
+  event_t queue[EVENTS_QUEUE_LEN];
+  unsigned int head;
+  unsigned int count;
+  uint64_t queue_lost; /**< Cambios descartados por estar la cola llena */
+  // Suscriptores
+  pthread_mutex_t subs_lock;
+  subscriber_t *subs;
+  atomic_uint subscribers;
+  atomic_ullong delivered;
+  atomic_ullong lost;
+  pthread_t thread;
+} events = {
+        .lock = PTHREAD_MUTEX_INITIALIZER,
+        .cond = PTHREAD_COND_INITIALIZER,
+        .subs_lock = PTHREAD_MUTEX_INITIALIZER,
+};
+
+static const char *event_name(claves_op_t op) {
+  switch (op) {
+    case CLAVES_PUBLISH:
+      return "PUBLISH";
+    case CLAVES_DELETE:
+      return "DELETE";
+    case CLAVES_CONNECT:
+      return "CONNECT";
+    default:
+      return "DISCONNECT";
+  }
+}
+
+/*
+ * Añade un cambio a la cola. Se llama con events.lock tomado.
+ */
+static void enqueue(claves_op_t op, const char *user, const char *path, const char *info) {
+  if (events.count == EVENTS_QUEUE_LEN) {
+    events.queue_lost++;
+    return;
+  }
+  event_t *ev = &events.queue[(events.head + events.count) % EVENTS_QUEUE_LEN];
+  ev->op = op;
+  snprintf(ev->user, sizeof(ev->user), "%s", user);
+  snprintf(ev->path, sizeof(ev->path), "%s", path);
+  snprintf(ev->info, sizeof(ev->info), "%s", info);
+  events.count++;
+}
+
+/*
+ * Observador del almacén: se ejecuta con el cerrojo de la franja del usuario tomado, así que solo
+ * copia el cambio a la cola (si hay alguien suscrito) y despierta al hilo repartidor
+ */
+static void events_hook(void *ctx, claves_op_t op, const user_t *user, const file_t *file) {
+  (void) ctx;
+  if (atomic_load(&events.subscribers) == 0) {
+    return;
+  }
+  char address[32];
+  switch (op) {
+    case CLAVES_PUBLISH:
+    case CLAVES_DELETE:
+    case CLAVES_CONNECT:
+    case CLAVES_DISCONNECT:
+    case CLAVES_UNREGISTER:
+      break;
+    default:
+      return;
+  }
+
+  pthread_mutex_lock(&events.lock);
+  if (op == CLAVES_PUBLISH) {
+    enqueue(op, user->name, file->path, file->description);
+  } else if (op == CLAVES_DELETE) {
+    enqueue(op, user->name, file->path, "");
+  } else if (op == CLAVES_CONNECT) {
+    snprintf(address, sizeof(address), "%s:%d", user->ip, user->port);
+    enqueue(op, user->name, "", address);
+  } else if (op == CLAVES_DISCONNECT) {
+    enqueue(op, user->name, "", "");
+  } else {
+    for (const file_t *f = user->files; f; f = f->next) {
+      enqueue(CLAVES_DELETE, user->name, f->path, "");
+    }
+  }
+  pthread_cond_signal(&events.cond);
+  pthread_mutex_unlock(&events.lock);
+}
+
+static bool wants(const subscriber_t *sub, const event_t *ev) {
+  if (fnmatch(sub->user_pattern, ev->user, 0) != 0) {
+    return false;
+  }
+  return (ev->op != CLAVES_PUBLISH && ev->op != CLAVES_DELETE) || fnmatch(sub->path_pattern, ev->path, 0) == 0;
+}
+
+/*
+ * Hilo repartidor: saca los cambios de la cola por tandas y añade cada uno, ya codificado, a lo
+ * pendiente de los suscriptores que lo quieren. No toca el almacén ni los sockets.
+ */
+static void *dispatch_main(void *arg) {
+  (void) arg;
+  event_t batch[EVENTS_BATCH];
+  msg_buffer_t encoded[EVENTS_BATCH];
+  for (unsigned int i = 0; i < EVENTS_BATCH; i++) {
+    msg_buffer_init(&encoded[i]);
+  }
+
+  while (1) {
+    pthread_mutex_lock(&events.lock);
+    while (events.count == 0 && events.queue_lost == 0) {
+      pthread_cond_wait(&events.cond, &events.lock);
+    }
+    unsigned int n = 0;
+    while (n < EVENTS_BATCH && events.count > 0) {
+      batch[n++] = events.queue[events.head];
+      events.head = (events.head + 1) % EVENTS_QUEUE_LEN;
+      events.count--;
+    }
+    uint64_t queue_lost = events.queue_lost;
+    events.queue_lost = 0;
+    pthread_mutex_unlock(&events.lock);
+
+    for (unsigned int i = 0; i < n; i++) {
+      encoded[i].len = 0;
+      if ((msg_buffer_put_str(&encoded[i], event_name(batch[i].op), 16) |
+           msg_buffer_put_str(&encoded[i], batch[i].user, sizeof(batch[i].user)) |
+           msg_buffer_put_str(&encoded[i], batch[i].path, sizeof(batch[i].path)) |
+           msg_buffer_put_str(&encoded[i], batch[i].info, sizeof(batch[i].info))) != 0) {
+        encoded[i].len = 0;
+      }
+    }
+
+    pthread_mutex_lock(&events.subs_lock);
+    for (subscriber_t *sub = events.subs; sub; sub = sub->next) {
+      uint64_t delivered = 0, lost = queue_lost;
+      pthread_mutex_lock(&sub->lock);
+      for (unsigned int i = 0; i < n; i++) {
+        if (!wants(sub, &batch[i])) {
+          continue;
+        }
+        if (encoded[i].len == 0 || sub->pending.len + encoded[i].len > EVENTS_MAX_PENDING ||
+            msg_buffer_put(&sub->pending, encoded[i].data, encoded[i].len) != 0) {
+          lost++;
+        } else {
+          delivered++;
+        }
+      }
+      sub->lost += lost;
+      if (delivered > 0 || lost > 0) {
+        pthread_cond_signal(&sub->cond);
+      }
+      pthread_mutex_unlock(&sub->lock);
+      atomic_fetch_add(&events.delivered, delivered);
+      atomic_fetch_add(&events.lost, lost);
+    }
+    pthread_mutex_unlock(&events.subs_lock);
+  }
+  return NULL;
+}
+
+int events_start(users_t *db) {
+  if (add_hook(db, events_hook, NULL) != 0) {
+    return -1;
+  }
+  if (pthread_create(&events.thread, NULL, dispatch_main, NULL) != 0) {
+    perror("s> error creating events thread");
+    return -1;
+  }
+  pthread_detach(events.thread);
+  return 0;
+}
+
+subscriber_t *events_subscribe(const char *user_pattern, const char *path_pattern) {
+  subscriber_t *sub = (subscriber_t *) calloc(1, sizeof(subscriber_t));
+  if (!sub) {
+    return NULL;
+  }
+  snprintf(sub->user_pattern, sizeof(sub->user_pattern), "%s", user_pattern[0] ? user_pattern : "*");
+  snprintf(sub->path_pattern, sizeof(sub->path_pattern), "%s", path_pattern[0] ? path_pattern : "*");
+  pthread_mutex_init(&sub->lock, NULL);
+  pthread_condattr_t attr;
+  pthread_condattr_init(&attr);
+  pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+  pthread_cond_init(&sub->cond, &attr);
+  pthread_condattr_destroy(&attr);
+  msg_buffer_init(&sub->pending);
+
+  pthread_mutex_lock(&events.subs_lock);
+  if (atomic_load(&events.subscribers) >= EVENTS_MAX_SUBSCRIBERS) {
+    pthread_mutex_unlock(&events.subs_lock);
+    pthread_cond_destroy(&sub->cond);
+    pthread_mutex_destroy(&sub->lock);
+    free(sub);
+    return NULL;
+  }
+  sub->next = events.subs;
+  events.subs = sub;
+  atomic_fetch_add(&events.subscribers, 1);
+  pthread_mutex_unlock(&events.subs_lock);
+  return sub;
+}
+
+/*
+ * Envía todo 'len' sin que un cliente que ya ha cerrado la conexión provoque un SIGPIPE
+ */
+static int send_all(int socket, const char *data, size_t len) {
+  while (len > 0) {
+    ssize_t sent = send(socket, data, len, MSG_NOSIGNAL);
+    if (sent < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      return -1;
+    }
+    data += sent;
+    len -= (size_t) sent;
+  }
+  return 0;
+}
+
+/*
+ * Envía un evento sin usuario ni ruta (PING o LOST)
+ */
+static int send_notice(int socket, const char *type, uint64_t value) {
+  char info[24] = {0};
+  if (value > 0) {
+    snprintf(info, sizeof(info), "%lu", (unsigned long) value);
+  }
+  msg_buffer_t msg;
+  msg_buffer_init(&msg);
+  int err = msg_buffer_put_str(&msg, type, 16) | msg_buffer_put_str(&msg, "", 1) | msg_buffer_put_str(&msg, "", 1) |
+            msg_buffer_put_str(&msg, info, sizeof(info));
+  if (err == 0) {
+    err = send_all(socket, msg.data, msg.len);
+  }
+  msg_buffer_free(&msg);
+  return err;
+}
+
+/*
+ * Indica si el cliente ha cerrado la conexión (lo que envíe el cliente se ignora)
+ */
+static bool peer_closed(int socket) {
+  char c;
+  ssize_t r = recv(socket, &c, 1, MSG_PEEK | MSG_DONTWAIT);
+  if (r > 0) {
+    char discard[256];
+    recv(socket, discard, sizeof(discard), MSG_DONTWAIT);
+    return false;
+  }
+  return r == 0 || (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR);
+}
+
+void events_stream(subscriber_t *sub, int socket) {
+  struct timespec last_sent;
+  clock_gettime(CLOCK_MONOTONIC, &last_sent);
+  int err = 0;
+  while (err == 0) {
+    // Se despierta con cada tanda de eventos o, si no hay, cada segundo para comprobar que el
+    // cliente sigue ahí
+    pthread_mutex_lock(&sub->lock);
+    if (sub->pending.len == 0 && sub->lost == 0) {
+      struct timespec deadline;
+      clock_gettime(CLOCK_MONOTONIC, &deadline);
+      deadline.tv_sec += 1;
+      pthread_cond_timedwait(&sub->cond, &sub->lock, &deadline);
+    }
+    msg_buffer_t out = sub->pending;
+    msg_buffer_init(&sub->pending);
+    uint64_t lost = sub->lost;
+    sub->lost = 0;
+    pthread_mutex_unlock(&sub->lock);
+
+    struct timespec now;
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    if (out.len > 0 || lost > 0) {
+      // Lo perdido es posterior a lo pendiente: se avisa después
+      err = send_all(socket, out.data, out.len);
+      if (err == 0 && lost > 0) {
+        err = send_notice(socket, "LOST", lost);
+      }
+      last_sent = now;
+    } else if (peer_closed(socket)) {
+      err = -1;
+    } else if (now.tv_sec - last_sent.tv_sec >= EVENTS_PING_SECS) {
+      err = send_notice(socket, "PING", 0);
+      last_sent = now;
+    }
+    msg_buffer_free(&out);
+  }
+
+  pthread_mutex_lock(&events.subs_lock);
+  for (subscriber_t **link = &events.subs; *link; link = &(*link)->next) {
+    if (*link == sub) {
+      *link = sub->next;
+      break;
+    }
+  }
+  atomic_fetch_sub(&events.subscribers, 1);
+  pthread_mutex_unlock(&events.subs_lock);
+  msg_buffer_free(&sub->pending);
+  pthread_cond_destroy(&sub->cond);
+  pthread_mutex_destroy(&sub->lock);
+  free(sub);
+}
+
+void events_stats(uint64_t *subscribers, uint64_t *delivered, uint64_t *lost) {
+  *subscribers = atomic_load(&events.subscribers);
+  *delivered = atomic_load(&events.delivered);
+  *lost = atomic_load(&events.lost);
+}
@@ -0,0 +1,64 @@
+#ifndef EVENTS_H
+#define EVENTS_H
+
+#include <stdint.h>
+
+#include "claves.h"
+
+/*
+ * Notificaciones de cambios del directorio (SUBSCRIBE). Un cliente suscrito mantiene abierta la
+ * conexión y recibe los PUBLISH, DELETE, CONNECT y DISCONNECT de los usuarios de este servidor,
+ * filtrados por un patrón de usuario y otro de ruta (fnmatch; el de ruta solo se aplica a
+ * PUBLISH y DELETE). Al darse de baja un usuario se notifica un DELETE por cada fichero suyo.
+ *
+ * El observador del almacén solo copia cada cambio a una cola acotada; un hilo aparte lo reparte
+ * a los suscriptores sin el cerrojo del almacén, y el hilo de cada suscriptor envía lo suyo. Lo
+ * pendiente de cada suscriptor también está acotado (EVENTS_MAX_PENDING bytes): si un suscriptor
+ * lento lo llena, los eventos siguientes se descartan y, cuando vuelve a haber sitio, recibe un
+ * evento LOST con cuántos ha perdido, para que vuelva a consultar el directorio.
+ *
+ * Cada evento son cuatro cadenas: tipo, usuario, ruta e información (la descripción en PUBLISH,
+ * "ip:puerto" en CONNECT y el número de eventos perdidos en LOST). Si no hay eventos, cada
+ * EVENTS_PING_SECS se envía un PING, que además sirve para detectar los suscriptores que se han ido.
+ */
+
+/** Suscriptores a la vez como máximo */
+#define EVENTS_MAX_SUBSCRIBERS 256
+/** Bytes pendientes de enviar a un suscriptor como máximo */
+#define EVENTS_MAX_PENDING (64 * 1024)
+/** Segundos sin eventos tras los que se envía un PING */
+#define EVENTS_PING_SECS 10
+
+typedef struct subscriber_s subscriber_t;
+
+/**
+ * @brief Registra el observador de cambios y arranca el hilo que los reparte.
+ *
+ * @return int:
+ *   - 0 si se ha arrancado correctamente.
+ *   - -1 en caso de error.
+ */
+int events_start(users_t *db);
+
+/**
+ * @brief Da de alta un suscriptor con sus filtros.
+ *
+ * @param[in] user_pattern  Patrón de los usuarios de los que se quieren los eventos.
+ * @param[in] path_pattern  Patrón de las rutas de los ficheros de PUBLISH y DELETE.
+ *
+ * @return subscriber_t*: el suscriptor, o NULL si ya hay EVENTS_MAX_SUBSCRIBERS o no hay memoria.
+ */
+subscriber_t *events_subscribe(const char *user_pattern, const char *path_pattern);
+
+/**
+ * @brief Envía por 'socket' los eventos del suscriptor hasta que el cliente cierra la conexión
+ * (o falla un envío). Después da de baja al suscriptor y lo libera.
+ */
+void events_stream(subscriber_t *sub, int socket);
+
+/**
+ * @brief Devuelve el número de suscriptores y de eventos entregados a los suscriptores y perdidos.
+ */
+void events_stats(uint64_t *subscribers, uint64_t *delivered, uint64_t *lost);
+
+#endif // EVENTS_H
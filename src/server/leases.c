@@ -0,0 +1,207 @@
+#include "leases.h"
+#include <pthread.h>
+#include <stdbool.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+/* Casillas de la rueda (una por segundo). Las concesiones más largas dan varias vueltas. */
+#define WHEEL_SLOTS 256
+
+typedef struct lease_s {
+  char name[256];
+  uint32_t gen; // Conexión del usuario a la que pertenece la concesión
+  uint64_t expiry; // Caducidad con la que se colocó en la rueda
+  struct lease_s *next;
+} lease_t;
+
+static struct {
+  pthread_mutex_t lock; // Protege las casillas y los contadores
+  pthread_cond_t cond; // Despierta al hilo para que termine
+  pthread_t thread;
+  users_t *db;
+  unsigned int lease_secs;
+  lease_t *slots[WHEEL_SLOTS];
+  uint64_t tick; // Siguiente segundo por revisar
+  uint64_t tracked;
+  uint64_t expired;
+  bool active;
+  bool stop;
+} wheel = {
+        .lock = PTHREAD_MUTEX_INITIALIZER,
+};
+
+static uint64_t now_s(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (uint64_t) ts.tv_sec;
+}
+
+/*
+ * Coloca la entrada en la casilla de su caducidad. Si ya ha pasado, va a la siguiente casilla
+ * por revisar para no esperar una vuelta entera. Se llama con wheel.lock tomado.
+ */
+static void wheel_insert(lease_t *lease) {
+  uint64_t at = lease->expiry > wheel.tick ? lease->expiry : wheel.tick;
+  lease_t **slot = &wheel.slots[at % WHEEL_SLOTS];
+  lease->next = *slot;
+  *slot = lease;
+}
+
+/*
+ * Revisa una casilla. Las entradas se sacan de la rueda antes de consultar el almacén para no
+ * tener los dos cerrojos a la vez.
+ */
+static void wheel_advance(uint64_t tick, uint64_t now) {
+  pthread_mutex_lock(&wheel.lock);
+  lease_t *pending = wheel.slots[tick % WHEEL_SLOTS];
+  wheel.slots[tick % WHEEL_SLOTS] = NULL;
+  pthread_mutex_unlock(&wheel.lock);
+
+  lease_t *keep = NULL;
+  while (pending) {
+    lease_t *lease = pending;
+    pending = pending->next;
+
+    int ret = 1;
+    if (lease->expiry <= now) {
+      uint64_t expiry = 0;
+      ret = expire_lease(wheel.db, lease->name, lease->gen, now, &expiry);
+      if (ret == 0) {
+        printf("s> lease expired for %s, user disconnected\n", lease->name);
+        fflush(stdout);
+      } else if (ret == 1) {
+        lease->expiry = expiry; // Se ha renovado: se recoloca en su nueva casilla
+      }
+    }
+    if (ret == 1) {
+      lease->next = keep;
+      keep = lease;
+    } else {
+      pthread_mutex_lock(&wheel.lock);
+      wheel.tracked--;
+      wheel.expired += ret == 0 ? 1 : 0;
+      pthread_mutex_unlock(&wheel.lock);
+      free(lease);
+    }
+  }
+
+  pthread_mutex_lock(&wheel.lock);
+  while (keep) {
+    lease_t *lease = keep;
+    keep = keep->next;
+    wheel_insert(lease);
+  }
+  pthread_mutex_unlock(&wheel.lock);
+}
+
+static void *wheel_main(void *arg) {
+  (void) arg;
+  pthread_mutex_lock(&wheel.lock);
+  while (!wheel.stop) {
+    struct timespec deadline;
+    clock_gettime(CLOCK_MONOTONIC, &deadline);
+    deadline.tv_sec += 1;
+    pthread_cond_timedwait(&wheel.cond, &wheel.lock, &deadline);
+    if (wheel.stop) {
+      break;
+    }
+
+    uint64_t now = now_s();
+    while (wheel.tick <= now) {
+      uint64_t tick = wheel.tick++;
+      pthread_mutex_unlock(&wheel.lock);
+      wheel_advance(tick, now);
+      pthread_mutex_lock(&wheel.lock);
+    }
+  }
+  pthread_mutex_unlock(&wheel.lock);
+  return NULL;
+}
+
+int leases_start(users_t *db, unsigned int lease_secs) {
+  if (!db || wheel.active) {
+    return -1;
+  }
+  wheel.db = db;
+  wheel.lease_secs = lease_secs;
+  if (lease_secs == 0) {
+    return 0;
+  }
+
+  pthread_condattr_t attr;
+  pthread_condattr_init(&attr);
+  pthread_condattr_setclock(&attr, CLOCK_MONOTONIC);
+  pthread_cond_init(&wheel.cond, &attr);
+  pthread_condattr_destroy(&attr);
+
+  wheel.tick = now_s();
+  wheel.stop = false;
+  if (pthread_create(&wheel.thread, NULL, wheel_main, NULL) != 0) {
+    perror("s> error creating lease thread");
+    return -1;
+  }
+  wheel.active = true;
+  return 0;
+}
+
+int leases_track(const char *name) {
+  if (!wheel.active) {
+    return renew_lease(wheel.db, name, 0, NULL);
+  }
+
+  uint64_t expiry = now_s() + wheel.lease_secs;
+  uint32_t gen = 0;
+  int ret = renew_lease(wheel.db, name, expiry, &gen);
+  if (ret != 0) {
+    return ret;
+  }
+
+  lease_t *lease = (lease_t *) calloc(1, sizeof(lease_t));
+  if (!lease) {
+    return 3;
+  }
+  strncpy(lease->name, name, sizeof(lease->name) - 1);
+  lease->gen = gen;
+  lease->expiry = expiry;
+
+  pthread_mutex_lock(&wheel.lock);
+  wheel_insert(lease);
+  wheel.tracked++;
+  pthread_mutex_unlock(&wheel.lock);
+  return 0;
+}
+
+int leases_renew(const char *name) {
+  uint64_t expiry = wheel.active ? now_s() + wheel.lease_secs : 0;
+  return renew_lease(wheel.db, name, expiry, NULL);
+}
+
+void leases_stats(uint64_t *tracked, uint64_t *expired) {
+  pthread_mutex_lock(&wheel.lock);
+  *tracked = wheel.tracked;
+  *expired = wheel.expired;
+  pthread_mutex_unlock(&wheel.lock);
+}
+
+void leases_stop(void) {
+  if (!wheel.active) {
+    return;
+  }
+  pthread_mutex_lock(&wheel.lock);
+  wheel.stop = true;
+  pthread_cond_signal(&wheel.cond);
+  pthread_mutex_unlock(&wheel.lock);
+  pthread_join(wheel.thread, NULL);
+
+  for (unsigned int i = 0; i < WHEEL_SLOTS; i++) {
+    while (wheel.slots[i]) {
+      lease_t *lease = wheel.slots[i];
+      wheel.slots[i] = lease->next;
+      free(lease);
+    }
+  }
+  wheel.tracked = 0;
+  wheel.active = false;
+}
@@ -0,0 +1,56 @@
+#ifndef LEASES_H
+#define LEASES_H
+
+#include <stdint.h>
+
+#include "claves.h"
+
+/*
+ * Concesiones (leases) de conexión. Al conectarse, un usuario recibe una concesión de
+ * 'lease_secs' segundos que renueva con cada HEARTBEAT. Si deja de renovarla (por ejemplo,
+ * porque el cliente ha muerto sin enviar DISCONNECT), el usuario pasa a estar desconectado y
+ * deja de aparecer en LIST_USERS y como seeder en GET_MULTIFILE.
+ *
+ * Las caducidades se guardan en una rueda de temporización con una casilla por segundo. Renovar
+ * solo actualiza la caducidad del usuario en el almacén; la entrada de la rueda se recoloca
+ * cuando llega su casilla, de modo que cada tic solo revisa las concesiones de esa casilla y
+ * nunca recorre la lista completa de usuarios.
+ */
+
+/**
+ * @brief Arranca el hilo que revisa la rueda una vez por segundo.
+ *
+ * @param[in] db          Almacén de usuarios.
+ * @param[in] lease_secs  Duración de las concesiones (0 desactiva la caducidad).
+ *
+ * @return int:
+ *   - 0 si se ha arrancado correctamente (o la caducidad está desactivada).
+ *   - -1 en caso de error.
+ */
+int leases_start(users_t *db, unsigned int lease_secs);
+
+/**
+ * @brief Concede un lease al usuario recién conectado y lo añade a la rueda.
+ *
+ * @return int: los mismos valores que renew_lease.
+ */
+int leases_track(const char *name);
+
+/**
+ * @brief Renueva el lease de un usuario conectado (operación HEARTBEAT).
+ *
+ * @return int: los mismos valores que renew_lease.
+ */
+int leases_renew(const char *name);
+
+/**
+ * @brief Devuelve el número de concesiones en la rueda y el de concesiones caducadas.
+ */
+void leases_stats(uint64_t *tracked, uint64_t *expired);
+
+/**
+ * @brief Detiene el hilo de la rueda y libera sus entradas.
+ */
+void leases_stop(void);
+
+#endif // LEASES_H
@@ -1,6 +1,9 @@
 
 #include "lines.h"
 #include <errno.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
 #include <unistd.h>
 
 int send_message(int socket, char *buffer, size_t len) {
@@ -81,3 +84,99 @@ ssize_t read_line(int fd, void *buffer, size_t n) {
   *buf = '\0';
   return (ssize_t)totRead;
 }
+
+void msg_buffer_init(msg_buffer_t *b) {
+  b->data = NULL;
+  b->len = 0;
+  b->cap = 0;
+}
+
+int msg_buffer_put(msg_buffer_t *b, const void *data, size_t len) {
+  if (b->len + len > b->cap) {
+    size_t cap = b->cap ? b->cap : 4096;
+    while (b->len + len > cap) {
+      cap *= 2;
+    }
+    char *tmp = realloc(b->data, cap);
+    if (!tmp) {
+      return -1;
+    }
+    b->data = tmp;
+    b->cap = cap;
+  }
+  memcpy(b->data + b->len, data, len);
+  b->len += len;
+  return 0;
+}
+
+/* Añade la cadena (como mucho max_len caracteres) seguida de '\0' */
+int msg_buffer_put_str(msg_buffer_t *b, const char *str, size_t max_len) {
+  size_t len = strnlen(str, max_len);
+  if (msg_buffer_put(b, str, len) != 0) {
+    return -1;
+  }
+  return msg_buffer_put(b, "", 1);
+}
+
+/* Añade el número en ascii seguido de '\0' */
+int msg_buffer_put_uint(msg_buffer_t *b, unsigned long value) {
+  char buffer[32];
+  int len = snprintf(buffer, sizeof(buffer), "%lu", value);
+  return msg_buffer_put(b, buffer, (size_t) len + 1);
+}
+
+int msg_buffer_send(int socket, const msg_buffer_t *b) {
+  if (b->len == 0) {
+    return 0;
+  }
+  return send_message(socket, b->data, b->len);
+}
+
+void msg_buffer_free(msg_buffer_t *b) {
+  free(b->data);
+  msg_buffer_init(b);
+}
+
+void msg_reader_init(msg_reader_t *r, int fd) {
+  r->fd = fd;
+  r->pos = 0;
+  r->len = 0;
+}
+
+/* Igual que read_line, pero sirviendo los bytes desde el buffer del lector */
+ssize_t msg_reader_line(msg_reader_t *r, void *buffer, size_t n) {
+  if (n == 0 || buffer == NULL) {
+    errno = EINVAL;
+    return -1;
+  }
+
+  char *buf = buffer;
+  size_t totRead = 0;
+  for (;;) {
+    if (r->pos == r->len) {
+      ssize_t numRead = read(r->fd, r->data, sizeof(r->data));
+      if (numRead == -1) {
+        if (errno == EINTR)
+          continue;
+        return -1;
+      }
+      if (numRead == 0) { /* EOF */
+        if (totRead == 0)
+          return 0;
+        break;
+      }
+      r->pos = 0;
+      r->len = (size_t) numRead;
+    }
+    char ch = r->data[r->pos++];
+    if (ch == '\n' || ch == '\0')
+      break;
+    if (totRead < n - 1) { /* discard > (n-1) bytes */
+      totRead++;
+      *buf++ = ch;
+    }
+  }
+
+  *buf = '\0';
+  return (ssize_t) totRead;
+}
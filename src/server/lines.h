@@ -1,12 +1,52 @@
 #ifndef LINES_H
 #define LINES_H
 
+#include <stddef.h>
 #include <unistd.h>
 
+/*
+ * Buffer de salida que crece según se le añaden datos. Permite construir una respuesta
+ * completa (código de retorno + cadenas terminadas en '\0') y enviarla con una única
+ * llamada a send_message, en lugar de hacer una escritura por campo.
+ */
+typedef struct msg_buffer_s {
+  char *data; /**< Contenido acumulado */
+  size_t len; /**< Bytes ocupados */
+  size_t cap; /**< Bytes reservados */
+} msg_buffer_t;
+
+/*
+ * Lector con buffer para peticiones con muchos campos (PUBLISH_BATCH, DELETE_BATCH). read_line
+ * lee de byte en byte; este lector pide los datos al socket en bloques. Solo se debe usar para
+ * el resto de la petición, porque se queda con lo que haya leído de más.
+ */
+typedef struct msg_reader_s {
+  int fd; /**< Socket del que se lee */
+  size_t pos; /**< Siguiente byte por consumir de 'data' */
+  size_t len; /**< Bytes válidos en 'data' */
+  char data[4096]; /**< Datos leídos del socket */
+} msg_reader_t;
+
 int send_message(int socket, char * buffer, size_t len);
 
 int recv_message(int socket, char *buffer, size_t len);
 
 ssize_t read_line(int fd, void *buffer, size_t n);
 
+void msg_buffer_init(msg_buffer_t *b);
+
+int msg_buffer_put(msg_buffer_t *b, const void *data, size_t len);
+
+int msg_buffer_put_str(msg_buffer_t *b, const char *str, size_t max_len);
+
+int msg_buffer_put_uint(msg_buffer_t *b, unsigned long value);
+
+int msg_buffer_send(int socket, const msg_buffer_t *b);
+
+void msg_buffer_free(msg_buffer_t *b);
+
+void msg_reader_init(msg_reader_t *r, int fd);
+
+ssize_t msg_reader_line(msg_reader_t *r, void *buffer, size_t n);
+
 #endif //LINES_H
\ No newline at end of file
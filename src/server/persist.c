@@ -0,0 +1,606 @@
+#include "persist.h"
+#include <dirent.h>
+#include <errno.h>
+#include <fcntl.h>
+#include <limits.h>
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <unistd.h>
+
+#define SNAPSHOT_MAGIC "SSDDSNP1"
+#define SNAPSHOT_MAGIC_LEN 8
+/* Cabecera del registro: [u16 longitud][u32 checksum] */
+#define WAL_HEADER_SIZE 6
+/* Carga útil: [u8 op][u8 len + usuario][u8 len + ruta][u8 len + descripción][u8 len + hash] */
+#define WAL_MAX_RECORD (WAL_HEADER_SIZE + 1 + 4 * 256)
+
+/* WAL_PUBLISH_HASH es un PUBLISH con el hash del contenido como cuarto campo */
+enum { WAL_REGISTER = 1, WAL_UNREGISTER = 2, WAL_PUBLISH = 3, WAL_DELETE = 4, WAL_PUBLISH_HASH = 5 };
+
+static struct {
+  pthread_mutex_t lock; // Protege el segmento actual del registro
+  pthread_mutex_t snapshot_lock; // Serializa las instantáneas
+  pthread_cond_t cond; // Despierta al hilo de compactación
+  pthread_t compactor;
+  users_t *db;
+  char dir[PATH_MAX];
+  int fd;
+  uint64_t generation; // Generación del segmento actual
+  uint64_t records; // Operaciones en el segmento actual
+  uint64_t snapshot_every;
+  bool sync;
+  bool replaying;
+  bool active;
+  bool stop;
+  users_t *hooked_db; // Almacén en el que está registrado journal_hook
+} wal = {
+        .lock = PTHREAD_MUTEX_INITIALIZER,
+        .snapshot_lock = PTHREAD_MUTEX_INITIALIZER,
+        .cond = PTHREAD_COND_INITIALIZER,
+        .fd = -1,
+};
+
+static uint32_t checksum(const unsigned char *data, size_t len) {
+  uint32_t h = 2166136261u;
+  for (size_t i = 0; i < len; i++) {
+    h ^= data[i];
+    h *= 16777619u;
+  }
+  return h;
+}
+
+static int write_all(int fd, const char *data, size_t len) {
+  while (len > 0) {
+    ssize_t r = write(fd, data, len);
+    if (r < 0) {
+      if (errno == EINTR) {
+        continue;
+      }
+      return -1;
+    }
+    data += r;
+    len -= (size_t) r;
+  }
+  return 0;
+}
+
+static void fsync_dir(void) {
+  int dfd = open(wal.dir, O_RDONLY | O_DIRECTORY);
+  if (dfd >= 0) {
+    fsync(dfd);
+    close(dfd);
+  }
+}
+
+static void segment_path(char *out, size_t len, uint64_t gen) {
+  snprintf(out, len, "%s/wal.%llu", wal.dir, (unsigned long long) gen);
+}
+
+static int open_segment(uint64_t gen) {
+  char path[PATH_MAX + 32];
+  segment_path(path, sizeof(path), gen);
+  int fd = open(path, O_WRONLY | O_CREAT | O_APPEND | O_CLOEXEC, 0644);
+  if (fd < 0) {
+    perror("s> error opening write-ahead log");
+    return -1;
+  }
+  fsync_dir();
+  return fd;
+}
+
+static size_t put_field(unsigned char *p, const char *s) {
+  size_t len = strlen(s) < 255 ? strlen(s) : 255;
+  p[0] = (unsigned char) len;
+  memcpy(p + 1, s, len);
+  return len + 1;
+}
+
+/* Si el hilo está aplicando un lote, el fdatasync se hace una sola vez al terminarlo */
+static _Thread_local bool in_batch = false;
+
+/*
+ * Observador del almacén: añade cada cambio persistente al segmento actual del registro.
+ * Se ejecuta con el cerrojo de la franja del usuario tomado, así que los cambios de un mismo
+ * usuario quedan en el registro en el mismo orden en el que se aplicaron.
+ */
+static void journal_hook(void *ctx, claves_op_t op, const user_t *user, const file_t *file) {
+  (void) ctx;
+  if (wal.replaying) {
+    return;
+  }
+
+  unsigned char code;
+  switch (op) {
+    case CLAVES_BATCH_BEGIN:
+      in_batch = true;
+      return;
+    case CLAVES_BATCH_END:
+      in_batch = false;
+      pthread_mutex_lock(&wal.lock);
+      if (wal.fd >= 0 && wal.sync) {
+        fdatasync(wal.fd);
+      }
+      pthread_mutex_unlock(&wal.lock);
+      return;
+    case CLAVES_REGISTER:
+      code = WAL_REGISTER;
+      break;
+    case CLAVES_UNREGISTER:
+      code = WAL_UNREGISTER;
+      break;
+    case CLAVES_PUBLISH:
+      code = file->hash[0] ? WAL_PUBLISH_HASH : WAL_PUBLISH;
+      break;
+    case CLAVES_DELETE:
+      code = WAL_DELETE;
+      break;
+    default:
+      return; // Las conexiones no se persisten
+  }
+
+  unsigned char rec[WAL_MAX_RECORD];
+  size_t len = WAL_HEADER_SIZE;
+  rec[len++] = code;
+  len += put_field(rec + len, user->name);
+  len += put_field(rec + len, file ? file->path : "");
+  len += put_field(rec + len, file ? file->description : "");
+  if (code == WAL_PUBLISH_HASH) {
+    len += put_field(rec + len, file->hash);
+  }
+
+  size_t payload = len - WAL_HEADER_SIZE;
+  uint32_t sum = checksum(rec + WAL_HEADER_SIZE, payload);
+  rec[0] = (unsigned char) (payload >> 8);
+  rec[1] = (unsigned char) (payload & 0xFF);
+  rec[2] = (unsigned char) (sum >> 24);
+  rec[3] = (unsigned char) ((sum >> 16) & 0xFF);
+  rec[4] = (unsigned char) ((sum >> 8) & 0xFF);
+  rec[5] = (unsigned char) (sum & 0xFF);
+
+  pthread_mutex_lock(&wal.lock);
+  if (wal.fd >= 0) {
+    if (write_all(wal.fd, (char *) rec, len) != 0) {
+      perror("s> error writing write-ahead log");
+    } else if (wal.sync && !in_batch) {
+      fdatasync(wal.fd);
+    }
+    wal.records++;
+    if (wal.snapshot_every > 0 && wal.records >= wal.snapshot_every) {
+      pthread_cond_signal(&wal.cond);
+    }
+  }
+  pthread_mutex_unlock(&wal.lock);
+}
+
+static int read_file(const char *path, unsigned char **data, size_t *len) {
+  *data = NULL;
+  *len = 0;
+  int fd = open(path, O_RDONLY | O_CLOEXEC);
+  if (fd < 0) {
+    return errno == ENOENT ? 1 : -1;
+  }
+  struct stat st;
+  if (fstat(fd, &st) != 0) {
+    close(fd);
+    return -1;
+  }
+  *data = (unsigned char *) malloc((size_t) st.st_size + 1);
+  if (!*data) {
+    close(fd);
+    return -1;
+  }
+  size_t done = 0;
+  while (done < (size_t) st.st_size) {
+    ssize_t r = read(fd, *data + done, (size_t) st.st_size - done);
+    if (r < 0 && errno == EINTR) {
+      continue;
+    }
+    if (r <= 0) {
+      break;
+    }
+    done += (size_t) r;
+  }
+  close(fd);
+  *len = done;
+  return 0;
+}
+
+/*
+ * Lee un campo con prefijo de longitud. Devuelve los bytes consumidos o 0 si no cabe.
+ */
+static size_t get_field(const unsigned char *p, size_t avail, char *out, size_t out_len) {
+  if (avail < 1 || avail < 1u + p[0] || p[0] >= out_len) {
+    return 0;
+  }
+  memcpy(out, p + 1, p[0]);
+  out[p[0]] = '\0';
+  return 1u + p[0];
+}
+
+/*
+ * Reproduce un segmento del registro. Un registro incompleto o con checksum incorrecto
+ * (escritura interrumpida) marca el final útil del segmento.
+ */
+static uint64_t replay_segment(uint64_t gen) {
+  char path[PATH_MAX + 32];
+  segment_path(path, sizeof(path), gen);
+  unsigned char *data = NULL;
+  size_t len = 0;
+  if (read_file(path, &data, &len) != 0) {
+    return 0;
+  }
+
+  char name[256];
+  char file_path[256];
+  char desc[256];
+  char hash[256];
+  uint64_t applied = 0;
+  size_t pos = 0;
+  while (pos + WAL_HEADER_SIZE <= len) {
+    size_t payload = ((size_t) data[pos] << 8) | data[pos + 1];
+    uint32_t sum = ((uint32_t) data[pos + 2] << 24) | ((uint32_t) data[pos + 3] << 16) |
+                   ((uint32_t) data[pos + 4] << 8) | data[pos + 5];
+    const unsigned char *p = data + pos + WAL_HEADER_SIZE;
+    if (pos + WAL_HEADER_SIZE + payload > len || payload < 4 || checksum(p, payload) != sum) {
+      fprintf(stderr, "s> write-ahead log %s truncated at offset %zu\n", path, pos);
+      break;
+    }
+    size_t off = 1;
+    size_t r1 = get_field(p + off, payload - off, name, sizeof(name));
+    off += r1;
+    size_t r2 = r1 ? get_field(p + off, payload - off, file_path, sizeof(file_path)) : 0;
+    off += r2;
+    size_t r3 = r2 ? get_field(p + off, payload - off, desc, sizeof(desc)) : 0;
+    off += r3;
+    hash[0] = '\0';
+    if (r3 && p[0] == WAL_PUBLISH_HASH && !get_field(p + off, payload - off, hash, sizeof(hash))) {
+      r3 = 0;
+    }
+    if (!r3) {
+      fprintf(stderr, "s> malformed record in %s at offset %zu\n", path, pos);
+      break;
+    }
+
+    // Los cambios son idempotentes respecto al estado final: si una operación ya está
+    // reflejada en la instantánea, volver a aplicarla no altera el resultado.
+    switch (p[0]) {
+      case WAL_REGISTER:
+        add_user(wal.db, name);
+        break;
+      case WAL_UNREGISTER:
+        remove_user(wal.db, name);
+        break;
+      case WAL_PUBLISH:
+      case WAL_PUBLISH_HASH:
+        restore_add_file(wal.db, name, file_path, desc, hash);
+        break;
+      case WAL_DELETE:
+        restore_remove_file(wal.db, name, file_path);
+        break;
+      default:
+        break;
+    }
+    applied++;
+    pos += WAL_HEADER_SIZE + payload;
+  }
+  free(data);
+  return applied;
+}
+
+/*
+ * Carga la instantánea: [magic][u64 generación] y después, por cada usuario,
+ * 'U' + nombre seguido de sus ficheros 'F' + ruta + descripción, cada uno con 'H' + hash
+ * detrás si se publicó con el hash del contenido. Termina en 'E'.
+ */
+static int load_snapshot(uint64_t *gen) {
+  char path[PATH_MAX + 32];
+  snprintf(path, sizeof(path), "%s/snapshot", wal.dir);
+  unsigned char *data = NULL;
+  size_t len = 0;
+  int ret = read_file(path, &data, &len);
+  if (ret == 1) {
+    *gen = 0;
+    return 0; // No hay instantánea todavía
+  }
+  if (ret != 0 || len < SNAPSHOT_MAGIC_LEN + 9 || memcmp(data, SNAPSHOT_MAGIC, SNAPSHOT_MAGIC_LEN) != 0) {
+    fprintf(stderr, "s> invalid snapshot %s\n", path);
+    free(data);
+    return -1;
+  }
+
+  *gen = 0;
+  for (int i = 0; i < 8; i++) {
+    *gen = (*gen << 8) | data[SNAPSHOT_MAGIC_LEN + i];
+  }
+
+  uint32_t capacity = 1024;
+  uint32_t count = 0;
+  file_t *files = (file_t *) malloc(capacity * sizeof(file_t));
+  if (!files) {
+    free(data);
+    return -1;
+  }
+
+  char name[256] = {0};
+  bool have_user = false;
+  bool complete = false;
+  size_t pos = SNAPSHOT_MAGIC_LEN + 8;
+  while (pos < len) {
+    unsigned char tag = data[pos++];
+    if (tag == 'F' && have_user) {
+      if (count == capacity) {
+        capacity *= 2;
+        file_t *tmp = (file_t *) realloc(files, capacity * sizeof(file_t));
+        if (!tmp) {
+          break;
+        }
+        files = tmp;
+      }
+      size_t r1 = get_field(data + pos, len - pos, files[count].path, sizeof(files[count].path));
+      size_t r2 = r1 ? get_field(data + pos + r1, len - pos - r1, files[count].description,
+                                 sizeof(files[count].description))
+                     : 0;
+      if (!r2) {
+        break;
+      }
+      pos += r1 + r2;
+      files[count].hash[0] = '\0';
+      count++;
+      continue;
+    }
+    if (tag == 'H' && count > 0) {
+      size_t r = get_field(data + pos, len - pos, files[count - 1].hash, sizeof(files[count - 1].hash));
+      if (!r) {
+        break;
+      }
+      pos += r;
+      continue;
+    }
+
+    // Cambio de usuario o fin: volcamos los ficheros acumulados del usuario anterior
+    if (have_user) {
+      restore_files(wal.db, name, files, count);
+      count = 0;
+    }
+    if (tag == 'E') {
+      complete = true;
+      break;
+    }
+    if (tag != 'U') {
+      break;
+    }
+    size_t r = get_field(data + pos, len - pos, name, sizeof(name));
+    if (!r) {
+      break;
+    }
+    pos += r;
+    add_user(wal.db, name);
+    have_user = true;
+  }
+
+  free(files);
+  free(data);
+  if (!complete) {
+    fprintf(stderr, "s> snapshot %s is incomplete\n", path);
+    return -1;
+  }
+  return 0;
+}
+
+/*
+ * Busca los segmentos del registro en el directorio y devuelve la generación más alta.
+ * Los segmentos anteriores a 'min_gen' ya están cubiertos por la instantánea y se borran.
+ */
+static uint64_t scan_segments(uint64_t min_gen, bool remove_old) {
+  DIR *d = opendir(wal.dir);
+  if (!d) {
+    return 0;
+  }
+  uint64_t max_gen = 0;
+  struct dirent *e;
+  while ((e = readdir(d)) != NULL) {
+    unsigned long long g = 0;
+    char extra;
+    if (sscanf(e->d_name, "wal.%llu%c", &g, &extra) != 1) {
+      continue;
+    }
+    if (g < min_gen) {
+      if (remove_old) {
+        char path[PATH_MAX + 32];
+        segment_path(path, sizeof(path), g);
+        unlink(path);
+      }
+      continue;
+    }
+    if (g > max_gen) {
+      max_gen = g;
+    }
+  }
+  closedir(d);
+  return max_gen;
+}
+
+typedef struct snapshot_writer_s {
+  FILE *f;
+  bool error;
+} snapshot_writer_t;
+
+static void write_field(snapshot_writer_t *w, char tag, const char *s) {
+  unsigned char len = (unsigned char) (strlen(s) < 255 ? strlen(s) : 255);
+  if (tag) {
+    fputc(tag, w->f);
+  }
+  fputc(len, w->f);
+  if (fwrite(s, 1, len, w->f) != len) {
+    w->error = true;
+  }
+}
+
+static void snapshot_user(void *ctx, const user_t *user) {
+  snapshot_writer_t *w = (snapshot_writer_t *) ctx;
+  write_field(w, 'U', user->name);
+  for (const file_t *f = user->files; f; f = f->next) {
+    write_field(w, 'F', f->path);
+    write_field(w, 0, f->description);
+    if (f->hash[0]) {
+      write_field(w, 'H', f->hash);
+    }
+  }
+}
+
+int persist_snapshot(void) {
+  if (!wal.active) {
+    return -1;
+  }
+  pthread_mutex_lock(&wal.snapshot_lock);
+
+  // 1. Abrimos un segmento nuevo. Todo cambio posterior a este punto queda en él, y la
+  //    instantánea (que se toma después) puede incluirlo o no: reproducirlo es idempotente.
+  pthread_mutex_lock(&wal.lock);
+  uint64_t gen = wal.generation + 1;
+  int fd = open_segment(gen);
+  if (fd < 0) {
+    pthread_mutex_unlock(&wal.lock);
+    pthread_mutex_unlock(&wal.snapshot_lock);
+    return -1;
+  }
+  close(wal.fd);
+  wal.fd = fd;
+  wal.generation = gen;
+  wal.records = 0;
+  pthread_mutex_unlock(&wal.lock);
+
+  // 2. Escribimos la instantánea franja a franja en un fichero temporal
+  char tmp_path[PATH_MAX + 32];
+  char final_path[PATH_MAX + 32];
+  snprintf(tmp_path, sizeof(tmp_path), "%s/snapshot.tmp", wal.dir);
+  snprintf(final_path, sizeof(final_path), "%s/snapshot", wal.dir);
+  snapshot_writer_t w = {.f = fopen(tmp_path, "wb"), .error = false};
+  if (!w.f) {
+    perror("s> error creating snapshot");
+    pthread_mutex_unlock(&wal.snapshot_lock);
+    return -1;
+  }
+  setvbuf(w.f, NULL, _IOFBF, 1 << 20);
+  fwrite(SNAPSHOT_MAGIC, 1, SNAPSHOT_MAGIC_LEN, w.f);
+  for (int i = 7; i >= 0; i--) {
+    fputc((int) ((gen >> (i * 8)) & 0xFF), w.f);
+  }
+  visit_users(wal.db, snapshot_user, &w);
+  fputc('E', w.f);
+  if (fflush(w.f) != 0 || w.error || fdatasync(fileno(w.f)) != 0) {
+    perror("s> error writing snapshot");
+    fclose(w.f);
+    unlink(tmp_path);
+    pthread_mutex_unlock(&wal.snapshot_lock);
+    return -1;
+  }
+  fclose(w.f);
+
+  // 3. La sustituimos de forma atómica y borramos los segmentos que ya cubre
+  if (rename(tmp_path, final_path) != 0) {
+    perror("s> error installing snapshot");
+    pthread_mutex_unlock(&wal.snapshot_lock);
+    return -1;
+  }
+  fsync_dir();
+  scan_segments(gen, true);
+
+  pthread_mutex_unlock(&wal.snapshot_lock);
+  return 0;
+}
+
+static void *compactor_main(void *arg) {
+  (void) arg;
+  pthread_mutex_lock(&wal.lock);
+  while (!wal.stop) {
+    if (wal.snapshot_every == 0 || wal.records < wal.snapshot_every) {
+      pthread_cond_wait(&wal.cond, &wal.lock);
+      continue;
+    }
+    pthread_mutex_unlock(&wal.lock);
+    persist_snapshot();
+    pthread_mutex_lock(&wal.lock);
+  }
+  pthread_mutex_unlock(&wal.lock);
+  return NULL;
+}
+
+int persist_open(users_t *db, const char *dir, uint64_t snapshot_every, bool sync) {
+  if (!db || !dir || wal.active) {
+    return -1;
+  }
+  if (mkdir(dir, 0755) != 0 && errno != EEXIST) {
+    perror("s> error creating data directory");
+    return -1;
+  }
+  strncpy(wal.dir, dir, sizeof(wal.dir) - 1);
+  wal.db = db;
+  wal.snapshot_every = snapshot_every;
+  wal.sync = sync;
+  wal.stop = false;
+
+  if (wal.hooked_db != db) {
+    if (add_hook(db, journal_hook, NULL) != 0) {
+      return -1;
+    }
+    wal.hooked_db = db;
+  }
+
+  // Recuperación: instantánea + segmentos posteriores, en orden
+  wal.replaying = true;
+  uint64_t snap_gen = 0;
+  if (load_snapshot(&snap_gen) != 0) {
+    wal.replaying = false;
+    return -1;
+  }
+  uint64_t max_gen = scan_segments(snap_gen, true);
+  uint64_t replayed = 0;
+  for (uint64_t g = snap_gen; g <= max_gen; g++) {
+    replayed += replay_segment(g);
+  }
+  wal.replaying = false;
+
+  // Los cambios nuevos van a un segmento nuevo
+  wal.generation = (max_gen > snap_gen ? max_gen : snap_gen) + 1;
+  wal.records = replayed;
+  wal.fd = open_segment(wal.generation);
+  if (wal.fd < 0) {
+    return -1;
+  }
+  wal.active = true;
+
+  if (pthread_create(&wal.compactor, NULL, compactor_main, NULL) != 0) {
+    perror("s> error creating snapshot thread");
+  }
+  printf("s> restored state from %s (snapshot generation %llu, %llu logged operations replayed)\n", dir,
+         (unsigned long long) snap_gen, (unsigned long long) replayed);
+  return 0;
+}
+
+void persist_close(bool snapshot) {
+  if (!wal.active) {
+    return;
+  }
+  pthread_mutex_lock(&wal.lock);
+  wal.stop = true;
+  pthread_cond_signal(&wal.cond);
+  pthread_mutex_unlock(&wal.lock);
+  pthread_join(wal.compactor, NULL);
+
+  if (snapshot) {
+    persist_snapshot();
+  }
+
+  pthread_mutex_lock(&wal.lock);
+  if (wal.fd >= 0) {
+    fdatasync(wal.fd);
+    close(wal.fd);
+    wal.fd = -1;
+  }
+  wal.active = false;
+  pthread_mutex_unlock(&wal.lock);
+}
@@ -0,0 +1,50 @@
+#ifndef PERSIST_H
+#define PERSIST_H
+
+#include <stdbool.h>
+#include <stdint.h>
+
+#include "claves.h"
+
+/*
+ * Persistencia del almacén de usuarios mediante instantánea + registro de operaciones (WAL).
+ *
+ * Cada REGISTER, UNREGISTER, PUBLISH y DELETE se añade al segmento actual del registro
+ * (DIR/wal.<generación>). Cuando el segmento acumula suficientes operaciones, se abre un
+ * segmento nuevo y se escribe una instantánea del estado (DIR/snapshot) que sustituye a los
+ * segmentos anteriores. Al arrancar, se carga la instantánea y se reproducen los segmentos
+ * posteriores. Las conexiones no se persisten: tras reiniciar, todos los usuarios están
+ * desconectados y conservan sus ficheros publicados.
+ */
+
+/**
+ * @brief Reconstruye el estado desde el directorio y empieza a registrar los cambios del almacén.
+ *
+ * @param[in,out] db                Almacén de usuarios (vacío e inicializado).
+ * @param[in]     dir               Directorio de datos (se crea si no existe).
+ * @param[in]     snapshot_every    Operaciones del registro tras las que se hace una instantánea
+ *                                  (0 desactiva las instantáneas automáticas).
+ * @param[in]     sync              Si es true, se hace fdatasync tras cada operación registrada.
+ *
+ * @return int:
+ *   - 0 si se ha recuperado el estado correctamente.
+ *   - -1 en caso de error (directorio o ficheros inaccesibles, registro corrupto).
+ */
+int persist_open(users_t *db, const char *dir, uint64_t snapshot_every, bool sync);
+
+/**
+ * @brief Escribe una instantánea del estado actual y descarta los segmentos que cubre.
+ *
+ * @return int:
+ *   - 0 si se ha escrito correctamente.
+ *   - -1 en caso de error o si la persistencia no está activa.
+ */
+int persist_snapshot(void);
+
+/**
+ * @brief Detiene la persistencia. Si 'snapshot' es true, escribe antes una instantánea final
+ * para que el siguiente arranque no tenga que reproducir el registro.
+ */
+void persist_close(bool snapshot);
+
+#endif // PERSIST_H
@@ -0,0 +1,197 @@
+#include "scores.h"
+#include <math.h>
+#include <pthread.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
+
+#include "claves.h"
+
+#define SCORE_BUCKETS 4096
+/* Límite de seeders con puntuación; por encima, los nuevos se tratan como desconocidos */
+#define SCORE_MAX_ENTRIES 65536
+/* Vida media (s) del historial de caudal y fallos, y de la carga */
+#define HISTORY_HALF_LIFE_S 300.0
+#define LOAD_HALF_LIFE_S 30.0
+/* Por debajo de este peso, lo anotado de un seeder ya no cuenta y la entrada se puede borrar */
+#define FADED 0.01
+
+typedef struct score_s {
+  char key[32]; // ip:puerto
+  double rate_bps; // Caudal medio ponderado por 'weight'
+  double weight;
+  double ok;
+  double fail;
+  double load;
+  double updated; // Instante (s, reloj monótono) al que se refieren los valores
+  struct score_s *next;
+} score_t;
+
+static struct {
+  pthread_mutex_t lock;
+  score_t *buckets[SCORE_BUCKETS];
+  uint64_t entries;
+  uint64_t reports;
+} table = {
+        .lock = PTHREAD_MUTEX_INITIALIZER,
+};
+
+static double now_s(void) {
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return (double) ts.tv_sec + (double) ts.tv_nsec / 1e9;
+}
+
+/*
+ * Aplica el decaimiento transcurrido desde la última actualización
+ */
+static void decay(score_t *score, double now) {
+  double dt = now - score->updated;
+  if (dt <= 0) {
+    return;
+  }
+  double history = exp2(-dt / HISTORY_HALF_LIFE_S);
+  score->weight *= history;
+  score->ok *= history;
+  score->fail *= history;
+  score->load *= exp2(-dt / LOAD_HALF_LIFE_S);
+  score->updated = now;
+}
+
+static bool faded(const score_t *score) {
+  return score->weight < FADED && score->ok + score->fail < FADED && score->load < FADED;
+}
+
+/*
+ * Busca la puntuación de ip:port. Si 'create' es true y no existe, la crea, aprovechando para
+ * borrar las entradas de la misma cadena que ya no aportan nada. Se llama con table.lock tomado.
+ */
+static score_t *lookup(const char *ip, int port, double now, bool create) {
+  char key[32];
+  snprintf(key, sizeof(key), "%s:%d", ip, port);
+  score_t **link = &table.buckets[user_hash(key) % SCORE_BUCKETS];
+
+  while (*link) {
+    score_t *score = *link;
+    if (strcmp(score->key, key) == 0) {
+      decay(score, now);
+      return score;
+    }
+    if (create) {
+      decay(score, now);
+      if (faded(score)) {
+        *link = score->next;
+        free(score);
+        table.entries--;
+        continue;
+      }
+    }
+    link = &score->next;
+  }
+
+  if (!create || table.entries >= SCORE_MAX_ENTRIES) {
+    return NULL;
+  }
+  score_t *score = (score_t *) calloc(1, sizeof(score_t));
+  if (!score) {
+    return NULL;
+  }
+  memcpy(score->key, key, sizeof(key));
+  score->updated = now;
+  *link = score;
+  table.entries++;
+  return score;
+}
+
+void scores_report(const char *ip, int port, uint64_t bytes, uint64_t millis, bool ok) {
+  pthread_mutex_lock(&table.lock);
+  table.reports++;
+  score_t *score = lookup(ip, port, now_s(), true);
+  if (score) {
+    if (ok && millis > 0) {
+      double sample = (double) bytes * 1000.0 / (double) millis;
+      score->rate_bps = (score->rate_bps * score->weight + sample) / (score->weight + 1);
+      score->weight += 1;
+      score->ok += 1;
+    } else if (!ok) {
+      score->fail += 1;
+    }
+  }
+  pthread_mutex_unlock(&table.lock);
+}
+
+typedef struct {
+  double score;
+  uint32_t index;
+} ranked_t;
+
+static int compare_ranked(const void *a, const void *b) {
+  const ranked_t *ra = (const ranked_t *) a;
+  const ranked_t *rb = (const ranked_t *) b;
+  if (ra->score != rb->score) {
+    return ra->score > rb->score ? -1 : 1;
+  }
+  return ra->index < rb->index ? -1 : (ra->index > rb->index);
+}
+
+void scores_rank(seeder_t *seeders, uint32_t n, uint32_t keep) {
+  if (!seeders || n == 0) {
+    return;
+  }
+  ranked_t *ranked = (ranked_t *) malloc(n * sizeof(ranked_t));
+  seeder_t *sorted = (seeder_t *) malloc(n * sizeof(seeder_t));
+  if (!ranked || !sorted) {
+    free(ranked);
+    free(sorted);
+    return; // Sin memoria, se devuelven en el orden del almacén
+  }
+
+  pthread_mutex_lock(&table.lock);
+  double now = now_s();
+
+  // Primero el caudal conocido de cada candidato; a los desconocidos se les da el del mejor
+  double best_rate = 0;
+  for (uint32_t i = 0; i < n; i++) {
+    score_t *score = lookup(seeders[i].ip, seeders[i].port, now, false);
+    seeders[i].score = (score && score->weight >= FADED) ? score->rate_bps : -1;
+    if (seeders[i].score > best_rate) {
+      best_rate = seeders[i].score;
+    }
+  }
+  for (uint32_t i = 0; i < n; i++) {
+    score_t *score = lookup(seeders[i].ip, seeders[i].port, now, false);
+    double rate = seeders[i].score >= 0 ? seeders[i].score : (best_rate > 0 ? best_rate : 1.0);
+    double ok = score ? score->ok : 0;
+    double fail = score ? score->fail : 0;
+    double load = score ? score->load : 0;
+    seeders[i].score = rate * (ok + 1) / (ok + fail + 1) / (1 + load);
+    ranked[i].score = seeders[i].score;
+    ranked[i].index = i;
+  }
+
+  qsort(ranked, n, sizeof(ranked_t), compare_ranked);
+  for (uint32_t i = 0; i < n; i++) {
+    sorted[i] = seeders[ranked[i].index];
+  }
+  memcpy(seeders, sorted, n * sizeof(seeder_t));
+
+  // Los que se ofrecen al cliente suman carga hasta que decae
+  for (uint32_t i = 0; i < keep && i < n; i++) {
+    score_t *score = lookup(seeders[i].ip, seeders[i].port, now, true);
+    if (score) {
+      score->load += 1;
+    }
+  }
+  pthread_mutex_unlock(&table.lock);
+
+  free(ranked);
+  free(sorted);
+}
+
+void scores_stats(uint64_t *tracked, uint64_t *reports) {
+  pthread_mutex_lock(&table.lock);
+  *tracked = table.entries;
+  *reports = table.reports;
+  pthread_mutex_unlock(&table.lock);
+}
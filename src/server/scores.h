@@ -0,0 +1,59 @@
+#ifndef SCORES_H
+#define SCORES_H
+
+#include <stdbool.h>
+#include <stdint.h>
+
+/*
+ * Puntuación de los seeders. Tras cada descarga, los clientes informan (REPORT_SEEDERS) del
+ * caudal que han obtenido de cada seeder o de que ha fallado. Con esos informes, el servidor
+ * mantiene por cada seeder (ip:puerto) un caudal medio, un recuento de éxitos y fallos y la
+ * carga (veces que se ha ofrecido en GET_MULTIFILE), todo ello con decaimiento exponencial
+ * para que cuente más lo reciente. GET_MULTIFILE devuelve los seeders ordenados por
+ *
+ *     caudal * (éxitos + 1) / (éxitos + fallos + 1) / (1 + carga)
+ *
+ * Los seeders de los que aún no hay informes reciben el caudal del mejor candidato conocido, de
+ * modo que se prueban antes que los que ya se sabe que son lentos.
+ */
+
+/**
+ * @struct seeder_s
+ * @brief Candidato de GET_MULTIFILE: usuario conectado que tiene el fichero.
+ */
+typedef struct seeder_s {
+  char ip[17]; /**< IP del seeder */
+  int port; /**< Puerto de escucha del seeder */
+  char path[256]; /**< Ruta del fichero en el seeder */
+  char hash[65]; /**< Hash del contenido del fichero en el seeder, o "" si no se publicó */
+  char *pieces; /**< Mapa de piezas si solo tiene parte del fichero (ver swarm.h), o NULL */
+  double score; /**< Puntuación calculada por scores_rank */
+} seeder_t;
+
+/**
+ * @brief Anota el resultado de una descarga desde el seeder ip:port.
+ *
+ * @param[in] ip      IP del seeder.
+ * @param[in] port    Puerto del seeder.
+ * @param[in] bytes   Bytes recibidos del seeder.
+ * @param[in] millis  Duración de la descarga en milisegundos.
+ * @param[in] ok      false si la descarga ha fallado.
+ */
+void scores_report(const char *ip, int port, uint64_t bytes, uint64_t millis, bool ok);
+
+/**
+ * @brief Ordena los candidatos de mayor a menor puntuación (los empates conservan el orden) y
+ * anota como carga de los 'keep' primeros que se van a ofrecer al cliente.
+ *
+ * @param[in,out] seeders  Candidatos.
+ * @param[in]     n        Número de candidatos.
+ * @param[in]     keep     Número de candidatos que se devolverán al cliente.
+ */
+void scores_rank(seeder_t *seeders, uint32_t n, uint32_t keep);
+
+/**
+ * @brief Devuelve el número de seeders con puntuación y el de informes recibidos.
+ */
+void scores_stats(uint64_t *tracked, uint64_t *reports);
+
+#endif // SCORES_H
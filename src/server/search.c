@@ -0,0 +1,418 @@
+#include "search.h"
+#include <pthread.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define SEARCH_BUCKETS 65536
+/* Trigramas de un fichero como mucho: los de la ruta y los de la descripción */
+#define MAX_DOC_GRAMS 512
+
+/*
+ * Fichero indexado. Los ficheros se guardan en un array y se identifican por su posición; 'next'
+ * enlaza (con la posición + 1, 0 al final) los ficheros del mismo cubo de (usuario, ruta) o, si
+ * la posición está libre, las posiciones libres.
+ */
+typedef struct doc_s {
+  search_result_t entry;
+  uint32_t next;
+  bool used;
+} doc_t;
+
+/* Lista ordenada de los ficheros en los que aparece un trigrama */
+typedef struct gram_s {
+  uint32_t key;
+  uint32_t *docs;
+  uint32_t len;
+  uint32_t cap;
+  struct gram_s *next;
+} gram_t;
+
+static struct {
+  pthread_rwlock_t lock;
+  doc_t *docs;
+  uint32_t num_slots;
+  uint32_t cap;
+  uint32_t free_slots; /**< Primera posición libre + 1, 0 si no hay */
+  uint32_t keys[SEARCH_BUCKETS]; /**< Primer fichero + 1 de cada cubo de (usuario, ruta) */
+  gram_t *grams[SEARCH_BUCKETS];
+  uint64_t files;
+  uint64_t num_grams;
+} idx = {
+        .lock = PTHREAD_RWLOCK_INITIALIZER,
+};
+
+/*
+ * Los PUBLISH y DELETE de un lote se notifican en el mismo hilo entre BATCH_BEGIN y BATCH_END:
+ * el cerrojo del índice se toma una vez para todo el lote.
+ */
+static _Thread_local bool in_batch = false;
+
+static unsigned char fold(char c) { return (unsigned char) (c >= 'A' && c <= 'Z' ? c - 'A' + 'a' : c); }
+
+static bool starts_with(const char *text, const char *query) {
+  while (*query) {
+    if (fold(*text++) != fold(*query++)) {
+      return false;
+    }
+  }
+  return true;
+}
+
+static bool contains(const char *text, const char *query) {
+  for (; *text; text++) {
+    if (starts_with(text, query)) {
+      return true;
+    }
+  }
+  return false;
+}
+
+static bool matches(const search_result_t *entry, const char *query, bool prefix) {
+  if (!prefix) {
+    return contains(entry->path, query) || contains(entry->description, query);
+  }
+  const char *name = strrchr(entry->path, '/');
+  return starts_with(entry->path, query) || (name && starts_with(name + 1, query)) ||
+         starts_with(entry->description, query);
+}
+
+static int compare_grams(const void *a, const void *b) {
+  uint32_t x = *(const uint32_t *) a, y = *(const uint32_t *) b;
+  return (x > y) - (x < y);
+}
+
+/*
+ * Añade a 'grams' (a partir de la posición n) los trigramas de 'text' y devuelve cuántos hay
+ */
+static uint32_t text_grams(const char *text, uint32_t *grams, uint32_t n) {
+  size_t len = strlen(text);
+  for (size_t i = 0; i + 2 < len; i++) {
+    grams[n++] = (uint32_t) fold(text[i]) << 16 | (uint32_t) fold(text[i + 1]) << 8 | fold(text[i + 2]);
+  }
+  return n;
+}
+
+/*
+ * Ordena los trigramas y quita los repetidos; devuelve cuántos quedan
+ */
+static uint32_t unique_grams(uint32_t *grams, uint32_t n) {
+  if (n == 0) {
+    return 0;
+  }
+  qsort(grams, n, sizeof(uint32_t), compare_grams);
+  uint32_t unique = 1;
+  for (uint32_t i = 1; i < n; i++) {
+    if (grams[i] != grams[unique - 1]) {
+      grams[unique++] = grams[i];
+    }
+  }
+  return unique;
+}
+
+static uint32_t doc_grams(const search_result_t *entry, uint32_t *grams) {
+  uint32_t n = text_grams(entry->path, grams, 0);
+  return unique_grams(grams, text_grams(entry->description, grams, n));
+}
+
+static gram_t **gram_link(uint32_t key) {
+  gram_t **link = &idx.grams[(key * 2654435761u) % SEARCH_BUCKETS];
+  while (*link && (*link)->key != key) {
+    link = &(*link)->next;
+  }
+  return link;
+}
+
+/*
+ * Posición de la lista en la que está (o debería estar) el fichero 'id'
+ */
+static uint32_t lower_bound(const gram_t *gram, uint32_t id) {
+  uint32_t lo = 0, hi = gram->len;
+  while (lo < hi) {
+    uint32_t mid = lo + (hi - lo) / 2;
+    if (gram->docs[mid] < id) {
+      lo = mid + 1;
+    } else {
+      hi = mid;
+    }
+  }
+  return lo;
+}
+
+static bool gram_has(const gram_t *gram, uint32_t id) {
+  uint32_t pos = lower_bound(gram, id);
+  return pos < gram->len && gram->docs[pos] == id;
+}
+
+static int gram_insert(uint32_t key, uint32_t id) {
+  gram_t **link = gram_link(key);
+  if (!*link) {
+    *link = (gram_t *) calloc(1, sizeof(gram_t));
+    if (!*link) {
+      return 4;
+    }
+    (*link)->key = key;
+    idx.num_grams++;
+  }
+  gram_t *gram = *link;
+  if (gram->len == gram->cap) {
+    uint32_t grown_cap = gram->cap ? gram->cap * 2 : 4;
+    uint32_t *grown = (uint32_t *) realloc(gram->docs, grown_cap * sizeof(uint32_t));
+    if (!grown) {
+      return 4;
+    }
+    gram->docs = grown;
+    gram->cap = grown_cap;
+  }
+  uint32_t pos = lower_bound(gram, id);
+  memmove(&gram->docs[pos + 1], &gram->docs[pos], (gram->len - pos) * sizeof(uint32_t));
+  gram->docs[pos] = id;
+  gram->len++;
+  return 0;
+}
+
+/*
+ * Quita el fichero 'id' de la lista del trigrama (si está) y, si era el último, el trigrama
+ */
+static void gram_remove(uint32_t key, uint32_t id) {
+  gram_t **link = gram_link(key);
+  gram_t *gram = *link;
+  if (!gram || !gram_has(gram, id)) {
+    return;
+  }
+  uint32_t pos = lower_bound(gram, id);
+  gram->len--;
+  memmove(&gram->docs[pos], &gram->docs[pos + 1], (gram->len - pos) * sizeof(uint32_t));
+  if (gram->len == 0) {
+    *link = gram->next;
+    free(gram->docs);
+    free(gram);
+    idx.num_grams--;
+  }
+}
+
+/*
+ * Devuelve el enlace (posición + 1) al fichero 'path' de 'user', o el enlace vacío del final de su
+ * cubo si no está indexado. Se llama con el cerrojo del índice tomado.
+ */
+static uint32_t *key_link(const char *user, const char *path) {
+  uint32_t *link = &idx.keys[(user_hash(user) * 31u + user_hash(path)) % SEARCH_BUCKETS];
+  while (*link) {
+    const search_result_t *entry = &idx.docs[*link - 1].entry;
+    if (strcmp(entry->user, user) == 0 && strcmp(entry->path, path) == 0) {
+      break;
+    }
+    link = &idx.docs[*link - 1].next;
+  }
+  return link;
+}
+
+static void doc_remove(const char *user, const char *path) {
+  uint32_t *link = key_link(user, path);
+  if (!*link) {
+    return;
+  }
+  uint32_t id = *link - 1;
+  doc_t *doc = &idx.docs[id];
+  *link = doc->next;
+
+  uint32_t grams[MAX_DOC_GRAMS];
+  uint32_t n = doc_grams(&doc->entry, grams);
+  for (uint32_t i = 0; i < n; i++) {
+    gram_remove(grams[i], id);
+  }
+  doc->used = false;
+  doc->next = idx.free_slots;
+  idx.free_slots = id + 1;
+  idx.files--;
+}
+
+/*
+ * Indexa el fichero (o lo vuelve a indexar, si ya estaba). Se llama con el cerrojo del índice
+ * tomado. Si no hay memoria, el fichero se queda sin indexar.
+ */
+static int doc_add(const char *user, const file_t *file) {
+  doc_remove(user, file->path);
+
+  uint32_t id;
+  if (idx.free_slots) {
+    id = idx.free_slots - 1;
+    idx.free_slots = idx.docs[id].next;
+  } else {
+    if (idx.num_slots == idx.cap) {
+      uint32_t grown_cap = idx.cap ? idx.cap * 2 : 1024;
+      doc_t *grown = (doc_t *) realloc(idx.docs, grown_cap * sizeof(doc_t));
+      if (!grown) {
+        return 4;
+      }
+      idx.docs = grown;
+      idx.cap = grown_cap;
+    }
+    id = idx.num_slots++;
+  }
+
+  doc_t *doc = &idx.docs[id];
+  memset(doc, 0, sizeof(doc_t));
+  strncpy(doc->entry.user, user, sizeof(doc->entry.user) - 1);
+  memcpy(doc->entry.path, file->path, sizeof(doc->entry.path));
+  memcpy(doc->entry.description, file->description, sizeof(doc->entry.description));
+  doc->used = true;
+  uint32_t *link = key_link(user, file->path);
+  *link = id + 1;
+  idx.files++;
+
+  uint32_t grams[MAX_DOC_GRAMS];
+  uint32_t n = doc_grams(&doc->entry, grams);
+  for (uint32_t i = 0; i < n; i++) {
+    if (gram_insert(grams[i], id) != 0) {
+      doc_remove(user, file->path);
+      return 4;
+    }
+  }
+  return 0;
+}
+
+/* Ordena los resultados por usuario y ruta. Se llama con el cerrojo del índice tomado. */
+static int compare_docs(const void *a, const void *b) {
+  const search_result_t *x = &idx.docs[*(const uint32_t *) a].entry;
+  const search_result_t *y = &idx.docs[*(const uint32_t *) b].entry;
+  int cmp = strcmp(x->user, y->user);
+  return cmp ? cmp : strcmp(x->path, y->path);
+}
+
+int search_query(const char *query, bool prefix, uint32_t offset, uint32_t limit, search_result_t **results,
+                 uint32_t *n, uint32_t *total) {
+  *results = NULL;
+  *n = 0;
+  *total = 0;
+  if (!query || query[0] == '\0') {
+    return 3;
+  }
+  if (limit > SEARCH_MAX_RESULTS) {
+    limit = SEARCH_MAX_RESULTS;
+  }
+  uint32_t grams[MAX_DOC_GRAMS];
+  char text[256] = {0};
+  strncpy(text, query, sizeof(text) - 1);
+  uint32_t num_grams = unique_grams(grams, text_grams(text, grams, 0));
+
+  pthread_rwlock_rdlock(&idx.lock);
+  // Los candidatos son los ficheros del trigrama menos frecuente de la consulta (o, sin
+  // trigramas, todos); de ellos se quedan los que tienen los demás trigramas y la contienen
+  const gram_t *lists[MAX_DOC_GRAMS];
+  const gram_t *shortest = NULL;
+  for (uint32_t i = 0; i < num_grams; i++) {
+    lists[i] = *gram_link(grams[i]);
+    if (!lists[i]) {
+      pthread_rwlock_unlock(&idx.lock);
+      return 0;
+    }
+    if (!shortest || lists[i]->len < shortest->len) {
+      shortest = lists[i];
+    }
+  }
+  uint32_t num_candidates = shortest ? shortest->len : idx.num_slots;
+  uint32_t *found = (uint32_t *) malloc((num_candidates ? num_candidates : 1) * sizeof(uint32_t));
+  if (!found) {
+    pthread_rwlock_unlock(&idx.lock);
+    return 4;
+  }
+  uint32_t num_found = 0;
+  for (uint32_t c = 0; c < num_candidates; c++) {
+    uint32_t id = shortest ? shortest->docs[c] : c;
+    if (!idx.docs[id].used) {
+      continue;
+    }
+    bool candidate = true;
+    for (uint32_t i = 0; i < num_grams && candidate; i++) {
+      candidate = lists[i] == shortest || gram_has(lists[i], id);
+    }
+    if (candidate && matches(&idx.docs[id].entry, text, prefix)) {
+      found[num_found++] = id;
+    }
+  }
+  qsort(found, num_found, sizeof(uint32_t), compare_docs);
+
+  *total = num_found;
+  uint32_t first = offset < num_found ? offset : num_found;
+  uint32_t count = num_found - first < limit ? num_found - first : limit;
+  if (count > 0) {
+    *results = (search_result_t *) malloc(count * sizeof(search_result_t));
+    if (!*results) {
+      pthread_rwlock_unlock(&idx.lock);
+      free(found);
+      *total = 0;
+      return 4;
+    }
+    for (uint32_t i = 0; i < count; i++) {
+      (*results)[i] = idx.docs[found[first + i]].entry;
+    }
+    *n = count;
+  }
+  pthread_rwlock_unlock(&idx.lock);
+  free(found);
+  return 0;
+}
+
+void search_stats(uint64_t *files, uint64_t *grams) {
+  pthread_rwlock_rdlock(&idx.lock);
+  *files = idx.files;
+  *grams = idx.num_grams;
+  pthread_rwlock_unlock(&idx.lock);
+}
+
+/*
+ * Observador del almacén: indexa los ficheros publicados y olvida los borrados y los de los
+ * usuarios que se dan de baja
+ */
+static void search_hook(void *ctx, claves_op_t op, const user_t *user, const file_t *file) {
+  (void) ctx;
+  switch (op) {
+    case CLAVES_BATCH_BEGIN:
+      pthread_rwlock_wrlock(&idx.lock);
+      in_batch = true;
+      return;
+    case CLAVES_BATCH_END:
+      in_batch = false;
+      pthread_rwlock_unlock(&idx.lock);
+      return;
+    case CLAVES_PUBLISH:
+    case CLAVES_DELETE:
+    case CLAVES_UNREGISTER:
+      break;
+    default:
+      return;
+  }
+
+  if (!in_batch) {
+    pthread_rwlock_wrlock(&idx.lock);
+  }
+  if (op == CLAVES_PUBLISH) {
+    doc_add(user->name, file);
+  } else if (op == CLAVES_DELETE) {
+    doc_remove(user->name, file->path);
+  } else {
+    for (const file_t *f = user->files; f; f = f->next) {
+      doc_remove(user->name, f->path);
+    }
+  }
+  if (!in_batch) {
+    pthread_rwlock_unlock(&idx.lock);
+  }
+}
+
+static void index_user(void *ctx, const user_t *user) {
+  int *err = (int *) ctx;
+  pthread_rwlock_wrlock(&idx.lock);
+  for (const file_t *f = user->files; f; f = f->next) {
+    if (doc_add(user->name, f) != 0) {
+      *err = 2;
+    }
+  }
+  pthread_rwlock_unlock(&idx.lock);
+}
+
+int search_init(users_t *db) {
+  int err = 0;
+  visit_users(db, index_user, &err);
+  return err ? err : add_hook(db, search_hook, NULL);
+}
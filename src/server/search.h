@@ -0,0 +1,70 @@
+#ifndef SEARCH_H
+#define SEARCH_H
+
+#include <stdbool.h>
+#include <stdint.h>
+
+#include "claves.h"
+
+/*
+ * Índice de búsqueda de los ficheros publicados. Se indexan la ruta y la descripción de cada
+ * fichero por trigramas (grupos de tres bytes consecutivos, sin distinguir mayúsculas): cada
+ * trigrama guarda la lista ordenada de los ficheros en los que aparece. Una consulta se queda con
+ * los ficheros que contienen todos sus trigramas (recorriendo la lista más corta y buscando en las
+ * demás) y comprueba en ellos el texto completo; las consultas de menos de tres bytes recorren
+ * todos los ficheros.
+ *
+ * El índice se construye al arrancar con lo que ya hay en el almacén y se mantiene al día con un
+ * observador de cambios (PUBLISH, DELETE y UNREGISTER). Cada servidor del directorio particionado
+ * indexa solo los ficheros de sus usuarios.
+ */
+
+/** Máximo de resultados por consulta */
+#define SEARCH_MAX_RESULTS 1000
+
+/**
+ * @struct search_result_s
+ * @brief Fichero que coincide con una consulta.
+ */
+typedef struct search_result_s {
+  char user[256]; /**< Usuario que publica el fichero */
+  char path[256]; /**< Ruta del fichero */
+  char description[256]; /**< Descripción del fichero */
+} search_result_t;
+
+/**
+ * @brief Indexa los ficheros que ya hay en el almacén y registra el observador que mantiene el
+ * índice al día. Debe llamarse después de recuperar el estado persistido.
+ *
+ * @return int: los mismos valores que add_hook, o 2 si no hay memoria.
+ */
+int search_init(users_t *db);
+
+/**
+ * @brief Busca los ficheros cuya ruta o descripción contiene 'query' (o, si 'prefix', cuya
+ * ruta, nombre o descripción empieza por 'query'), sin distinguir mayúsculas. Los resultados se
+ * ordenan por usuario y ruta, y se devuelven los 'limit' (como mucho SEARCH_MAX_RESULTS) que hay a
+ * partir de 'offset'. LIBERAR 'results' ES RESPONSABILIDAD DEL CALLER.
+ *
+ * @param[in]  query    Texto a buscar.
+ * @param[in]  prefix   Si se busca por prefijo en lugar de por subcadena.
+ * @param[in]  offset   Resultados que se saltan.
+ * @param[in]  limit    Máximo de resultados a devolver.
+ * @param[out] results  Array de resultados.
+ * @param[out] n        Número de resultados devueltos.
+ * @param[out] total    Número total de ficheros que coinciden.
+ *
+ * @return int:
+ *   - 0 si todo va bien.
+ *   - 3 si la consulta está vacía.
+ *   - 4 si no hay memoria.
+ */
+int search_query(const char *query, bool prefix, uint32_t offset, uint32_t limit, search_result_t **results,
+                 uint32_t *n, uint32_t *total);
+
+/**
+ * @brief Devuelve el número de ficheros indexados y de trigramas distintos.
+ */
+void search_stats(uint64_t *files, uint64_t *grams);
+
+#endif // SEARCH_H
@@ -1,17 +1,26 @@
 #include <arpa/inet.h>
 #include <errno.h>
+#include <getopt.h>
 #include <pthread.h>
 #include <rpc/rpc.h>
 #include <signal.h>
+#include <stdatomic.h>
 #include <stdio.h>
 #include <stdlib.h>
 #include <string.h>
+#include <time.h>
 #include <unistd.h>
 
 #include "../logger/logger.h"
 #include "claves.h"
+#include "events.h"
+#include "leases.h"
 #include "lines.h"
+#include "persist.h"
+#include "scores.h"
+#include "search.h"
 #include "stdbool.h"
+#include "swarm.h"
 
 #define MAX_MSG_SIZE 2048
 #define MAX_DATETIME_SIZE 64
@@ -19,6 +28,10 @@
 #define MAX_USER_MSG_SIZE 255
 #define MAX_FILE_PATH_SIZE 256
 #define MAX_FILE_DESC_SIZE 256
+#define MAX_BATCH_FILES 10000
+/* Prefijo de GET_MULTIFILE2 para buscar los seeders por el hash del contenido y no por el nombre */
+#define HASH_PREFIX "sha256:"
+#define HASH_PREFIX_LEN (sizeof(HASH_PREFIX) - 1)
 
 pthread_mutex_t req_lock = PTHREAD_MUTEX_INITIALIZER;
 pthread_cond_t req_cond = PTHREAD_COND_INITIALIZER;
@@ -26,8 +39,51 @@ bool req_ready = false;
 
 // Variables globales
 int server_sock;
-user_t *usuarios = NULL;
+users_t usuarios;
 CLIENT *clnt = NULL;
+// El cliente RPC no se puede usar desde varios hilos a la vez
+pthread_mutex_t clnt_lock = PTHREAD_MUTEX_INITIALIZER;
+
+/*
+ * Métricas de ejecución. Todas son contadores atómicos que los hilos actualizan sin cerrojos
+ * y que la operación STATS lee tal cual (cada valor es coherente por sí mismo, pero no
+ * forman una instantánea atómica del conjunto).
+ *
+ * Las latencias se guardan en un histograma logarítmico: el cubo 0 cuenta las peticiones de
+ * menos de 1 us y el cubo i (i > 0) las de [2^(i-1), 2^i) us. El último cubo acumula todo lo
+ * que no cabe en los anteriores.
+ */
+#define LATENCY_BUCKETS 24
+
+typedef struct op_stats_s {
+  atomic_ullong count; /**< Peticiones atendidas */
+  atomic_ullong total_us; /**< Suma de latencias */
+  atomic_ullong max_us; /**< Latencia máxima */
+  atomic_ullong hist[LATENCY_BUCKETS]; /**< Histograma de latencias */
+} op_stats_t;
+
+typedef struct server_stats_s {
+  struct timespec started; /**< Arranque del servidor */
+  atomic_uint connections_active; /**< Conexiones (y por tanto hilos) atendiéndose ahora */
+  atomic_uint connections_peak; /**< Máximo de conexiones simultáneas */
+  atomic_ullong connections_total; /**< Conexiones aceptadas */
+  atomic_uint logger_inflight; /**< Llamadas al logger en curso o esperando el cliente RPC */
+  atomic_ullong logger_calls; /**< Llamadas al logger */
+  atomic_ullong logger_errors; /**< Llamadas al logger fallidas */
+} server_stats_t;
+
+server_stats_t stats;
+
+/*
+ * Posición de este servidor en el directorio particionado (opción -n índice/total). Cada
+ * usuario pertenece al servidor (user_hash(nombre) >> 16) % shard_count, el mismo reparto
+ * que hace el cliente. Con un único servidor todos los usuarios son suyos.
+ */
+unsigned int shard_index = 0;
+unsigned int shard_count = 1;
+
+/* Máximo de seeders por respuesta de GET_MULTIFILE (SERVER_SEEDERS_TOP_K, 0 para todos) */
+unsigned int seeders_top_k = 0;
 
 // Cabeceras
 void handle_register(int socket, char *user, char *datetime);
@@ -35,14 +91,76 @@ void handle_unregister(int socket, char *user, char *datetime);
 void handle_connect(int socket, char *user, char *datetime);
 void handle_disconnect(int socket, char *user, char *datetime);
 void handle_publish(int socket, char *user, char *datetime);
+void handle_publish2(int socket, char *user, char *datetime);
 void handle_delete(int socket, char *user, char *datetime);
+void handle_publish_batch(int socket, char *user, char *datetime);
+void handle_publish_batch2(int socket, char *user, char *datetime);
+void handle_delete_batch(int socket, char *user, char *datetime);
 void handle_list_users(int socket, char *user, char *datetime);
 void handle_list_files(int socket, char *user, char *datetime);
+void handle_list_users_page(int socket, char *user, char *datetime);
+void handle_list_files_page(int socket, char *user, char *datetime);
 // Funciones Extra
 void handle_getmultifile(int socket, char *user, char *datetime);
+void handle_getmultifile2(int socket, char *user, char *datetime);
+void handle_stats(int socket, char *user, char *datetime);
+void handle_heartbeat(int socket, char *user, char *datetime);
+void handle_report_seeders(int socket, char *user, char *datetime);
+void handle_announce(int socket, char *user, char *datetime);
+void handle_search(int socket, char *user, char *datetime);
+void handle_subscribe(int socket, char *user, char *datetime);
+
+/*
+ * Tabla de operaciones del protocolo. La posición de cada operación es también el índice de
+ * sus métricas en op_stats; la posición NUM_OPERATIONS se reserva para las desconocidas.
+ */
+typedef void (*op_handler_t)(int socket, char *user, char *datetime);
+
+static const struct {
+  const char *name;
+  op_handler_t handler;
+} operations[] = {
+    {"REGISTER", handle_register},
+    {"UNREGISTER", handle_unregister},
+    {"CONNECT", handle_connect},
+    {"DISCONNECT", handle_disconnect},
+    {"PUBLISH", handle_publish},
+    {"PUBLISH2", handle_publish2},
+    {"DELETE", handle_delete},
+    {"PUBLISH_BATCH", handle_publish_batch},
+    {"PUBLISH_BATCH2", handle_publish_batch2},
+    {"DELETE_BATCH", handle_delete_batch},
+    {"LIST_USERS", handle_list_users},
+    {"LIST_CONTENT", handle_list_files},
+    {"LIST_USERS_PAGE", handle_list_users_page},
+    {"LIST_CONTENT_PAGE", handle_list_files_page},
+    {"GET_MULTIFILE", handle_getmultifile},
+    {"GET_MULTIFILE2", handle_getmultifile2},
+    {"STATS", handle_stats},
+    {"HEARTBEAT", handle_heartbeat},
+    {"REPORT_SEEDERS", handle_report_seeders},
+    {"ANNOUNCE", handle_announce},
+    {"SEARCH", handle_search},
+    {"SUBSCRIBE", handle_subscribe},
+};
+
+#define NUM_OPERATIONS (sizeof(operations) / sizeof(operations[0]))
+
+op_stats_t op_stats[NUM_OPERATIONS + 1];
 
-void handle_poweroff() {
+/*
+ * Hilo que atiende SIGINT y SIGTERM. El apagado toma cerrojos y espera a otros hilos, así que no
+ * puede hacerse en un manejador de señal: si la señal interrumpiera a un hilo con el cerrojo del
+ * registro o de una franja del almacén, el servidor se quedaría bloqueado sin escribir la instantánea.
+ */
+static void *handle_poweroff(void *arg) {
+  sigset_t *set = (sigset_t *) arg;
+  int sig = 0;
+  sigwait(set, &sig);
   close(server_sock);
+  leases_stop();
+  // Dejamos una instantánea final para que el siguiente arranque no tenga que reproducir el registro
+  persist_close(true);
   destroy(&usuarios);
   printf("\nSaliendo del servidor...\n");
   exit(EXIT_SUCCESS);
@@ -92,6 +210,23 @@ bool is_same_file(const char *file1, const char *file2) {
   return strcmp(name1, name2) == 0;
 }
 
+/*
+ * Función auxiliar que comprueba que 'hash' sea un hash del contenido válido: CONTENT_HASH_LEN
+ * dígitos hexadecimales en minúscula
+ */
+static bool is_content_hash(const char *hash) {
+  size_t len = strnlen(hash, CONTENT_HASH_LEN + 1);
+  if (len != CONTENT_HASH_LEN) {
+    return false;
+  }
+  for (size_t i = 0; i < len; i++) {
+    if (!((hash[i] >= '0' && hash[i] <= '9') || (hash[i] >= 'a' && hash[i] <= 'f'))) {
+      return false;
+    }
+  }
+  return true;
+}
+
 int get_ip_address(char *ip) {
   char *ip_local = getenv("LOG_RPC_IP");
   if (!ip_local) {
@@ -122,37 +257,65 @@ static CLIENT *get_rpc_client() {
  * Función auxiliar que loggea la operación
  */
 int log_operation(char *user, char *operation, char *datetime, char *filename) {
+  // Las llamadas en curso incluyen las que esperan a que otro hilo libere el cliente RPC,
+  // así que este contador es la cola de operaciones pendientes de registrar
+  atomic_fetch_add(&stats.logger_inflight, 1);
+  atomic_fetch_add(&stats.logger_calls, 1);
+  pthread_mutex_lock(&clnt_lock);
+
+  int ret = 0;
   if (clnt == NULL) {
     clnt = get_rpc_client();
-    if (clnt == NULL) {
-      return -1;
-    }
   }
 
-  log_entry entry;
-  entry.username = user;
-  entry.operation = operation;
-  entry.timestamp = datetime;
-
-  if (filename != NULL) {
-    entry.filename = filename;
+  if (clnt == NULL) {
+    ret = -1;
   } else {
-    entry.filename = "";
+    log_entry entry;
+    entry.username = user;
+    entry.operation = operation;
+    entry.timestamp = datetime;
+
+    if (filename != NULL) {
+      entry.filename = filename;
+    } else {
+      entry.filename = "";
+    }
+
+    // Llamada RPC
+    if (log_op_1(&entry, clnt) == NULL) {
+      clnt_perror(clnt, "s> error calling RPC. Try again.");
+      clnt_destroy(clnt);
+      clnt = NULL;
+      ret = -1;
+    }
   }
 
-  // Llamada RPC
-  if (log_op_1(&entry, clnt) == NULL) {
-    clnt_perror(clnt, "s> error calling RPC. Try again.");
-    clnt_destroy(clnt);
-    clnt = NULL;
-    return -1;
+  pthread_mutex_unlock(&clnt_lock);
+  if (ret != 0) {
+    atomic_fetch_add(&stats.logger_errors, 1);
   }
-  return 0;
+  atomic_fetch_sub(&stats.logger_inflight, 1);
+  return ret;
 }
 
+/*
+ * Función auxiliar que indica si el usuario pertenece a este servidor del directorio
+ */
+static bool owns_user(const char *user) { return (user_hash(user) >> 16) % shard_count == shard_index; }
+
+/*
+ * Usuario que hay que comprobar como solicitante de una consulta. Las consultas que abarcan
+ * a varios servidores (LIST_USERS, GET_MULTIFILE) o que se dirigen al servidor del usuario
+ * consultado (LIST_CONTENT) llegan también a servidores en los que el solicitante no existe;
+ * en ellos la comprobación corresponde al servidor del solicitante, así que se omite.
+ */
+static const char *requester(const char *user) { return owns_user(user) ? user : NULL; }
+
 void handle_register(int socket, char *user, char *datetime) {
-  // En la operación register, solo hace falta el código de operación y el nombre de usuario
-  int res = add_user(&usuarios, user);
+  // En la operación register, solo hace falta el código de operación y el nombre de usuario.
+  // Un usuario que no pertenece a este servidor es un error de encaminamiento del cliente.
+  int res = owns_user(user) ? add_user(&usuarios, user) : 2;
   if (send_ret_value(socket, (uint8_t) res) != 0) {
     printf("s> error sending return value to %s", user);
   }
@@ -198,6 +361,9 @@ void handle_connect(int socket, char *user, char *datetime) {
   }
 
   int res = connect_user(&usuarios, user, inet_ntoa(client_addr.sin_addr), port);
+  if (res == 0 && leases_track(user) != 0) {
+    printf("s> error granting lease to %s\n", user);
+  }
   if (send_ret_value(socket, (uint8_t) res) != 0) {
     printf("s> error sending return value to %s", user);
   }
@@ -247,6 +413,34 @@ void handle_publish(int socket, char *user, char *datetime) {
   }
 }
 
+void handle_publish2(int socket, char *user, char *datetime) {
+  // Igual que PUBLISH, pero detrás de la descripción llega el hash del contenido calculado por el
+  // cliente (cadena vacía si no lo tiene), con el que GET_MULTIFILE2 encuentra los seeders
+  char file_path[MAX_FILE_PATH_SIZE] = {0};
+  char file_desc[MAX_FILE_DESC_SIZE] = {0};
+  char file_hash[CONTENT_HASH_LEN + 2] = {0};
+  if (read_line(socket, file_path, sizeof(file_path)) <= 0 || read_line(socket, file_desc, sizeof(file_desc)) <= 0 ||
+      read_line(socket, file_hash, sizeof(file_hash)) < 0) {
+    perror("s> error reading file");
+    close(socket);
+    return;
+  }
+  file_path[sizeof(file_path) - 1] = '\0';
+  file_desc[sizeof(file_desc) - 1] = '\0';
+  file_hash[sizeof(file_hash) - 1] = '\0';
+
+  int res = 4;
+  if (file_hash[0] == '\0' || is_content_hash(file_hash)) {
+    res = add_file_with_hash(&usuarios, user, file_path, file_desc, file_hash[0] ? file_hash : NULL);
+  }
+  if (send_ret_value(socket, (uint8_t) res) != 0) {
+    printf("s> error sending return value to %s", user);
+  }
+  if (log_operation(user, "PUBLISH", datetime, file_path) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
 void handle_delete(int socket, char *user, char *datetime) {
   char file_path[MAX_FILE_PATH_SIZE] = {0};
   ssize_t bytes_read = read_line(socket, file_path, sizeof(file_path));
@@ -266,49 +460,236 @@ void handle_delete(int socket, char *user, char *datetime) {
   }
 }
 
-void handle_list_users(int socket, char *user, char *datetime) {
-  connected_user_t *conn_users = NULL;
-  uint32_t num_users = 0;
+/*
+ * Función auxiliar que envía la respuesta de PUBLISH_BATCH y DELETE_BATCH: el código de retorno
+ * y, si es 0, una cadena con el resultado de cada fichero como un dígito ascii ('0' si ha ido
+ * bien, '3' si ya estaba publicado o no existía).
+ */
+static int send_batch_results(int socket, int res, const uint8_t *results, uint32_t n) {
+  msg_buffer_t msg;
+  msg_buffer_init(&msg);
+  uint8_t ret = (uint8_t) res;
+  int err = msg_buffer_put(&msg, &ret, sizeof(ret));
+  if (res == 0) {
+    for (uint32_t i = 0; i < n && err == 0; i++) {
+      char digit = (char) ('0' + results[i]);
+      err |= msg_buffer_put(&msg, &digit, 1);
+    }
+    err |= msg_buffer_put(&msg, "", 1);
+  }
+  if (err == 0) {
+    err = msg_buffer_send(socket, &msg);
+  }
+  msg_buffer_free(&msg);
+  return err;
+}
 
-  int res = get_connected_users(&usuarios, user, &conn_users, &num_users);
-  if (send_ret_value(socket, (uint8_t) res) != 0) {
-    printf("s> error sending return value to %s\n", user);
+/*
+ * Función auxiliar que lee el número de ficheros de un lote
+ */
+static int read_batch_count(msg_reader_t *reader, uint32_t *count) {
+  char buffer[16] = {0};
+  if (msg_reader_line(reader, buffer, sizeof(buffer)) <= 0) {
+    return -1;
+  }
+  unsigned long n = strtoul(buffer, NULL, 10);
+  if (n > MAX_BATCH_FILES) {
+    return -1;
+  }
+  *count = (uint32_t) n;
+  return 0;
+}
+
+/*
+ * Número de ficheros y, por cada uno, su ruta, su descripción y, si 'with_hash' (PUBLISH_BATCH2),
+ * el hash del contenido (cadena vacía si no lo tiene, como en PUBLISH2). Todos se añaden con una
+ * sola toma del cerrojo del usuario y la respuesta lleva el resultado de cada uno.
+ */
+static void publish_batch(int socket, char *user, char *datetime, bool with_hash) {
+  msg_reader_t reader;
+  msg_reader_init(&reader, socket);
+  uint32_t count = 0;
+  if (read_batch_count(&reader, &count) != 0) {
+    send_ret_value(socket, 4);
+    close(socket);
     return;
   }
 
+  file_t *files = (file_t *) calloc(count ? count : 1, sizeof(file_t));
+  uint8_t *results = (uint8_t *) calloc(count ? count : 1, sizeof(uint8_t));
+  int res = (files && results) ? 0 : 4;
+  // Un byte más que el hash para detectar los que son demasiado largos
+  char hash[CONTENT_HASH_LEN + 2] = {0};
+  for (uint32_t i = 0; i < count && res == 0; i++) {
+    if (msg_reader_line(&reader, files[i].path, sizeof(files[i].path)) <= 0 ||
+        msg_reader_line(&reader, files[i].description, sizeof(files[i].description)) <= 0 ||
+        (with_hash && msg_reader_line(&reader, hash, sizeof(hash)) < 0) ||
+        (hash[0] != '\0' && !is_content_hash(hash))) {
+      res = 4;
+    } else {
+      memcpy(files[i].hash, hash, sizeof(files[i].hash));
+      files[i].hash[sizeof(files[i].hash) - 1] = '\0';
+    }
+  }
   if (res == 0) {
-    char buffer[32] = {0};
-    snprintf(buffer, sizeof(buffer), "%u", num_users);
-    /*
-     * Es importante especificar el tamaño del buffer, ya que el buffer es más
-     * grande que el tamaño del mensaje a enviar. Si no se especifica el tamaño,
-     * el mensaje se enviará completo, incluyendo toda la basura residua en el buffer.
-     */
-    size_t len = strlen(buffer) + 1;
-    if (send_message(socket, buffer, len) != 0) {
-      free(conn_users);
-      return;
+    res = add_files(&usuarios, user, files, count, results);
+  }
+
+  if (send_batch_results(socket, res, results, count) != 0) {
+    printf("s> error sending return value to %s", user);
+  }
+  free(files);
+  free(results);
+  if (log_operation(user, "PUBLISH_BATCH", datetime, NULL) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+void handle_publish_batch(int socket, char *user, char *datetime) {
+  publish_batch(socket, user, datetime, false);
+}
+
+void handle_publish_batch2(int socket, char *user, char *datetime) {
+  publish_batch(socket, user, datetime, true);
+}
+
+void handle_delete_batch(int socket, char *user, char *datetime) {
+  // Número de ficheros y la ruta de cada uno
+  msg_reader_t reader;
+  msg_reader_init(&reader, socket);
+  uint32_t count = 0;
+  if (read_batch_count(&reader, &count) != 0) {
+    send_ret_value(socket, 4);
+    close(socket);
+    return;
+  }
+
+  char(*paths)[MAX_FILE_PATH_SIZE] = calloc(count ? count : 1, MAX_FILE_PATH_SIZE);
+  const char **path_list = (const char **) calloc(count ? count : 1, sizeof(char *));
+  uint8_t *results = (uint8_t *) calloc(count ? count : 1, sizeof(uint8_t));
+  int res = (paths && path_list && results) ? 0 : 4;
+  for (uint32_t i = 0; i < count && res == 0; i++) {
+    if (msg_reader_line(&reader, paths[i], MAX_FILE_PATH_SIZE) <= 0) {
+      res = 4;
     }
+    path_list[i] = paths[i];
+  }
+  if (res == 0) {
+    res = remove_files(&usuarios, user, path_list, count, results);
+  }
 
-    for (uint32_t i = 0; i < num_users; i++) {
-      len = strnlen(conn_users[i].name, sizeof(conn_users[i].name)) + 1;
-      if (send_message(socket, conn_users[i].name, len) != 0) {
-        free(conn_users);
-        return;
-      }
-      len = strnlen(conn_users[i].ip, sizeof(conn_users[i].ip)) + 1;
-      if (send_message(socket, conn_users[i].ip, len) != 0) {
-        free(conn_users);
-        return;
-      }
-      snprintf(buffer, sizeof(buffer), "%u", conn_users[i].port);
-      len = strlen(buffer) + 1;
-      if (send_message(socket, buffer, len) != 0) {
-        free(conn_users);
-        return;
-      }
+  if (send_batch_results(socket, res, results, count) != 0) {
+    printf("s> error sending return value to %s", user);
+  }
+  free(paths);
+  free(path_list);
+  free(results);
+  if (log_operation(user, "DELETE_BATCH", datetime, NULL) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+/*
+ * Función auxiliar que lee el desplazamiento y el tamaño de página de una operación paginada
+ */
+static int read_page(int socket, uint32_t *offset, uint32_t *limit) {
+  char buffer[16] = {0};
+  if (read_line(socket, buffer, sizeof(buffer)) <= 0) {
+    return -1;
+  }
+  *offset = (uint32_t) strtoul(buffer, NULL, 10);
+  memset(buffer, 0, sizeof(buffer));
+  if (read_line(socket, buffer, sizeof(buffer)) <= 0) {
+    return -1;
+  }
+  *limit = (uint32_t) strtoul(buffer, NULL, 10);
+  return 0;
+}
+
+/*
+ * Función auxiliar que construye la respuesta de LIST_USERS en un único buffer y la envía
+ * de una vez: código de retorno, [total si es paginada], número de usuarios y, por cada uno,
+ * nombre, ip y puerto.
+ */
+static int send_users(int socket, int res, const connected_user_t *users, uint32_t num_users, uint32_t total,
+                      bool paged) {
+  msg_buffer_t msg;
+  msg_buffer_init(&msg);
+  uint8_t ret = (uint8_t) res;
+  int err = msg_buffer_put(&msg, &ret, sizeof(ret));
+  if (res == 0) {
+    if (paged) {
+      err |= msg_buffer_put_uint(&msg, total);
+    }
+    err |= msg_buffer_put_uint(&msg, num_users);
+    for (uint32_t i = 0; i < num_users && err == 0; i++) {
+      err |= msg_buffer_put_str(&msg, users[i].name, sizeof(users[i].name));
+      err |= msg_buffer_put_str(&msg, users[i].ip, sizeof(users[i].ip));
+      err |= msg_buffer_put_uint(&msg, (unsigned long) users[i].port);
+    }
+  }
+  if (err == 0) {
+    err = msg_buffer_send(socket, &msg);
+  }
+  msg_buffer_free(&msg);
+  return err;
+}
+
+/*
+ * Igual que send_users, pero para LIST_CONTENT: por cada fichero se envía su ruta.
+ */
+static int send_files(int socket, int res, const file_t *files, uint32_t num_files, uint32_t total, bool paged) {
+  msg_buffer_t msg;
+  msg_buffer_init(&msg);
+  uint8_t ret = (uint8_t) res;
+  int err = msg_buffer_put(&msg, &ret, sizeof(ret));
+  if (res == 0) {
+    if (paged) {
+      err |= msg_buffer_put_uint(&msg, total);
+    }
+    err |= msg_buffer_put_uint(&msg, num_files);
+    for (uint32_t i = 0; i < num_files && err == 0; i++) {
+      err |= msg_buffer_put_str(&msg, files[i].path, sizeof(files[i].path));
     }
   }
+  if (err == 0) {
+    err = msg_buffer_send(socket, &msg);
+  }
+  msg_buffer_free(&msg);
+  return err;
+}
+
+void handle_list_users(int socket, char *user, char *datetime) {
+  connected_user_t *conn_users = NULL;
+  uint32_t num_users = 0;
+
+  int res = get_connected_users(&usuarios, requester(user), &conn_users, &num_users);
+  if (send_users(socket, res, conn_users, num_users, num_users, false) != 0) {
+    printf("s> error sending user list to %s\n", user);
+  }
+  free(conn_users);
+  if (log_operation(user, "LIST_USERS", datetime, NULL) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+void handle_list_users_page(int socket, char *user, char *datetime) {
+  uint32_t offset = 0;
+  uint32_t limit = 0;
+  if (read_page(socket, &offset, &limit) != 0) {
+    perror("s> error reading page");
+    close(socket);
+    return;
+  }
+
+  connected_user_t *conn_users = NULL;
+  uint32_t num_users = 0;
+  uint32_t total = 0;
+
+  int res = get_connected_users_page(&usuarios, requester(user), offset, limit, &conn_users, &num_users, &total);
+  if (send_users(socket, res, conn_users, num_users, total, true) != 0) {
+    printf("s> error sending user list to %s\n", user);
+  }
   free(conn_users);
   if (log_operation(user, "LIST_USERS", datetime, NULL) != 0) {
     printf("s> error logging operation\n");
@@ -328,40 +709,194 @@ void handle_list_files(int socket, char *user, char *datetime) {
 
   file_t *files = NULL;
   uint32_t num_files = 0;
-  int res = get_user_files(&usuarios, user, other, &files, &num_files);
-  if (send_ret_value(socket, (uint8_t) res) != 0) {
-    printf("s> error sending return value to %s\n", user);
+  int res = get_user_files(&usuarios, requester(user), other, &files, &num_files);
+  if (send_files(socket, res, files, num_files, num_files, false) != 0) {
+    printf("s> error sending file list to %s\n", user);
+  }
+  free(files);
+  if (log_operation(user, "LIST_CONTENT", datetime, other) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+void handle_list_files_page(int socket, char *user, char *datetime) {
+  char other[MAX_USER_MSG_SIZE];
+  memset(other, 0, MAX_USER_MSG_SIZE);
+  ssize_t bytes_read = read_line(socket, other, sizeof(other));
+  other[sizeof(other) - 1] = '\0';
+  uint32_t offset = 0;
+  uint32_t limit = 0;
+  if (bytes_read <= 0 || read_page(socket, &offset, &limit) != 0) {
+    perror("s> error reading other user or page");
     close(socket);
-    free(files);
     return;
   }
 
-  if (res == 0) {
-    char buffer[32] = {0};
-    snprintf(buffer, sizeof(buffer), "%u", num_files);
-    size_t len = strlen(buffer) + 1;
-    if (send_message(socket, buffer, len) != 0) {
-      free(files);
-      close(socket);
-      return;
+  file_t *files = NULL;
+  uint32_t num_files = 0;
+  uint32_t total = 0;
+  int res = get_user_files_page(&usuarios, requester(user), other, offset, limit, &files, &num_files, &total);
+  if (send_files(socket, res, files, num_files, total, true) != 0) {
+    printf("s> error sending file list to %s\n", user);
+  }
+  free(files);
+  if (log_operation(user, "LIST_CONTENT", datetime, other) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+/*
+ * Función auxiliar que añade un candidato vacío al array de seeders, agrandándolo si hace falta.
+ * Devuelve NULL si no hay memoria.
+ */
+static seeder_t *push_seeder(seeder_t **seeders, uint32_t *num_seeders, uint32_t *cap) {
+  if (*num_seeders == *cap) {
+    uint32_t grown_cap = *cap ? *cap * 2 : 8;
+    seeder_t *grown = (seeder_t *) realloc(*seeders, grown_cap * sizeof(seeder_t));
+    if (!grown) {
+      return NULL;
     }
+    *seeders = grown;
+    *cap = grown_cap;
+  }
+  seeder_t *seeder = &(*seeders)[(*num_seeders)++];
+  memset(seeder, 0, sizeof(seeder_t));
+  return seeder;
+}
+
+static void free_seeders(seeder_t *seeders, uint32_t num_seeders) {
+  for (uint32_t i = 0; i < num_seeders; i++) {
+    free(seeders[i].pieces);
+  }
+  free(seeders);
+}
 
-    for (uint32_t i = 0; i < num_files; i++) {
-      len = strnlen(files[i].path, sizeof(files[i].path)) + 1;
-      if (send_message(socket, files[i].path, len) != 0) {
-        free(files);
-        close(socket);
-        return;
+/*
+ * Función auxiliar que añade a los seeders los usuarios conectados que han anunciado piezas del
+ * contenido 'hash', con su mapa de piezas. Los 'full' primeros seeders tienen el fichero
+ * completo; si uno de ellos es el mismo usuario (ip y puerto), no se repite.
+ */
+static int add_partial_holders(const char *user, const char *hash, const connected_user_t *conn_users,
+                               uint32_t num_users, uint32_t full, seeder_t **seeders, uint32_t *num_seeders,
+                               uint32_t *cap) {
+  swarm_holder_t *holders = NULL;
+  uint32_t num_holders = 0;
+  if (swarm_holders(hash, user, &holders, &num_holders) != 0) {
+    return 2;
+  }
+
+  int res = 0;
+  for (uint32_t h = 0; h < num_holders && res == 0; h++) {
+    const connected_user_t *conn = NULL;
+    for (uint32_t i = 0; i < num_users && !conn; i++) {
+      if (strcmp(conn_users[i].name, holders[h].user) == 0) {
+        conn = &conn_users[i];
       }
     }
+    bool complete = false;
+    for (uint32_t i = 0; i < full && conn && !complete; i++) {
+      complete = (*seeders)[i].port == conn->port && strcmp((*seeders)[i].ip, conn->ip) == 0 &&
+                 strcmp((*seeders)[i].hash, hash) == 0;
+    }
+    if (!conn || complete) {
+      continue; // Ya no está conectado o ya aparece como seeder completo
+    }
+    seeder_t *seeder = push_seeder(seeders, num_seeders, cap);
+    char *pieces = seeder ? strdup(holders[h].pieces) : NULL;
+    if (!pieces) {
+      if (seeder) {
+        (*num_seeders)--;
+      }
+      res = 2;
+      break;
+    }
+    memcpy(seeder->ip, conn->ip, sizeof(seeder->ip));
+    seeder->port = conn->port;
+    memcpy(seeder->path, holders[h].path, sizeof(seeder->path));
+    memcpy(seeder->hash, hash, CONTENT_HASH_LEN);
+    seeder->pieces = pieces;
   }
-  free(files);
-  if (log_operation(user, "LIST_CONTENT", datetime, other) != 0) {
-    printf("s> error logging operation\n");
+  free(holders);
+  return res;
+}
+
+/*
+ * Función auxiliar que busca los usuarios conectados que tienen el fichero 'file_path' y los
+ * devuelve ordenados por su puntuación (ver scores.h). 'keep' es el número de candidatos que se
+ * van a ofrecer al cliente, que son los que suman carga. Si 'file_path' es HASH_PREFIX seguido
+ * de un hash, se buscan los ficheros publicados con ese contenido; si no, los que tienen el
+ * mismo nombre. Con 'partial', se añaden los poseedores parciales de esos contenidos.
+ */
+static int find_seeders(const char *user, const char *file_path, uint32_t keep, bool partial, seeder_t **seeders,
+                        uint32_t *num_seeders) {
+  connected_user_t *conn_users = NULL;
+  uint32_t num_users = 0;
+  *seeders = NULL;
+  *num_seeders = 0;
+
+  int res = get_connected_users(&usuarios, requester(user), &conn_users, &num_users);
+  if (res != 0) {
+    return res;
+  }
+  const char *by_hash = strncmp(file_path, HASH_PREFIX, HASH_PREFIX_LEN) == 0 ? file_path + HASH_PREFIX_LEN : NULL;
+
+  uint32_t cap = 0;
+  for (uint32_t i = 0; i < num_users && res == 0; i++) {
+    file_t *files = NULL;
+    uint32_t num_files = 0;
+    if (get_user_files(&usuarios, requester(user), conn_users[i].name, &files, &num_files) != 0) {
+      continue;
+    }
+    for (uint32_t j = 0; j < num_files; j++) {
+      if (by_hash ? strcmp(files[j].hash, by_hash) != 0 : !is_same_file(files[j].path, file_path)) {
+        continue;
+      }
+      seeder_t *seeder = push_seeder(seeders, num_seeders, &cap);
+      if (!seeder) {
+        res = 2;
+        break;
+      }
+      memcpy(seeder->ip, conn_users[i].ip, sizeof(seeder->ip));
+      seeder->port = conn_users[i].port;
+      memcpy(seeder->path, files[j].path, sizeof(seeder->path));
+      memcpy(seeder->hash, files[j].hash, sizeof(seeder->hash));
+    }
+    free(files);
+  }
+
+  // Poseedores parciales (ver swarm.h) del contenido pedido o de cada contenido encontrado por
+  // nombre, salvo el propio usuario
+  uint32_t full = *num_seeders;
+  for (uint32_t i = 0; partial && res == 0 && i < (by_hash ? 1 : full); i++) {
+    const char *hash = by_hash ? by_hash : (*seeders)[i].hash;
+    bool seen = hash[0] == '\0';
+    for (uint32_t j = 0; j < i && !seen; j++) {
+      seen = strcmp((*seeders)[j].hash, hash) == 0;
+    }
+    if (!seen) {
+      res = add_partial_holders(user, hash, conn_users, num_users, full, seeders, num_seeders, &cap);
+    }
+  }
+  free(conn_users);
+  if (res != 0) {
+    free_seeders(*seeders, *num_seeders);
+    *seeders = NULL;
+    *num_seeders = 0;
+    return res;
   }
+
+  scores_rank(*seeders, *num_seeders, keep < *num_seeders ? keep : *num_seeders);
+  return 0;
 }
 
-void handle_getmultifile(int socket, char *user, char *datetime) {
+/*
+ * Función auxiliar común a GET_MULTIFILE y GET_MULTIFILE2. En la versión original el número de
+ * seeders va en un byte, así que como mucho se envían los 255 mejores; en la 2 va en ascii,
+ * sin límite, y el cliente puede pedir solo los 'limit' mejores (0 para todos). La versión 2
+ * envía también el hash del contenido de cada seeder, para no mezclar fragmentos de ficheros
+ * distintos que se llaman igual, y añade los poseedores parciales con su mapa de piezas.
+ */
+static void send_seeders(int socket, char *user, char *datetime, bool wide) {
   // Primero, nos ha de llegar el path del fichero
   char file_path[MAX_FILE_PATH_SIZE] = {0};
   ssize_t bytes_read = read_line(socket, file_path, sizeof(file_path));
@@ -372,115 +907,382 @@ void handle_getmultifile(int socket, char *user, char *datetime) {
     return;
   }
 
-  // Ahora, nos recorremos todos los ficheros de todos los usuarios para
-  // comprobar quién tiene el fichero y enviárselo al cliente
-  connected_user_t *conn_users = NULL;
-  uint32_t num_users = 0;
-  u_int32_t users_with_file = 0;
+  uint32_t keep = wide ? UINT32_MAX : 255;
+  if (wide) {
+    char limit[16] = {0};
+    if (read_line(socket, limit, sizeof(limit)) <= 0) {
+      perror("s> error reading seeder limit");
+      close(socket);
+      return;
+    }
+    uint32_t requested = (uint32_t) strtoul(limit, NULL, 10);
+    if (requested > 0) {
+      keep = requested;
+    }
+  }
+  if (seeders_top_k > 0 && seeders_top_k < keep) {
+    keep = seeders_top_k;
+  }
+  seeder_t *seeders = NULL;
+  uint32_t num_seeders = 0;
+  int res = find_seeders(user, file_path, keep, wide, &seeders, &num_seeders);
+  if (res == 0 && num_seeders == 0) {
+    res = 1; // Ningún usuario conectado tiene el fichero
+  }
+  uint32_t num_sent = num_seeders > keep ? keep : num_seeders;
+
+  // Código de retorno, número de seeders y, por cada uno (del mejor al peor), su ip, su puerto,
+  // la ruta del fichero y, en la versión 2, su hash y su mapa de piezas ("" si tiene el fichero
+  // completo). Enviar la ruta es necesario porque un mismo fichero puede estar en dos rutas
+  // distintas.
+  msg_buffer_t msg;
+  msg_buffer_init(&msg);
+  uint8_t ret = (uint8_t) res;
+  int err = msg_buffer_put(&msg, &ret, sizeof(ret));
+  if (res == 0) {
+    if (wide) {
+      err |= msg_buffer_put_uint(&msg, num_sent);
+    } else {
+      uint8_t count = (uint8_t) num_sent;
+      err |= msg_buffer_put(&msg, &count, sizeof(count));
+    }
+    for (uint32_t i = 0; i < num_sent && err == 0; i++) {
+      err |= msg_buffer_put_str(&msg, seeders[i].ip, sizeof(seeders[i].ip));
+      err |= msg_buffer_put_uint(&msg, (unsigned long) seeders[i].port);
+      err |= msg_buffer_put_str(&msg, seeders[i].path, sizeof(seeders[i].path));
+      if (wide) {
+        err |= msg_buffer_put_str(&msg, seeders[i].hash, sizeof(seeders[i].hash));
+        err |= msg_buffer_put_str(&msg, seeders[i].pieces ? seeders[i].pieces : "", SWARM_MAX_PIECES_HEX + 1);
+      }
+    }
+  }
+  if (err != 0 || msg_buffer_send(socket, &msg) != 0) {
+    perror("s> error sending seeders to user");
+  }
+  msg_buffer_free(&msg);
+  free_seeders(seeders, num_seeders);
 
-  int res_con_users = get_connected_users(&usuarios, user, &conn_users, &num_users);
+  close(socket);
+  if (log_operation(user, wide ? "GET_MULTIFILE2" : "GET_MULTIFILE", datetime, file_path) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+void handle_getmultifile(int socket, char *user, char *datetime) { send_seeders(socket, user, datetime, false); }
+
+void handle_getmultifile2(int socket, char *user, char *datetime) { send_seeders(socket, user, datetime, true); }
 
-  if (res_con_users != 0) {
-    send_ret_value(socket, (uint8_t) res_con_users);
+void handle_report_seeders(int socket, char *user, char *datetime) {
+  // Resultado de una descarga: número de seeders y, por cada uno, ip, puerto, bytes recibidos,
+  // milisegundos y si ha ido bien (1) o ha fallado (0)
+  char buffer[32] = {0};
+  if (read_line(socket, buffer, sizeof(buffer)) <= 0) {
+    perror("s> error reading seeder count");
     close(socket);
     return;
   }
-
-  for (u_int32_t i = 0; i < num_users; i++) {
-    file_t *files = NULL;
-    uint32_t num_files = 0;
-    int res_get_user_files = get_user_files(&usuarios, user, conn_users[i].name, &files, &num_files);
-    if (res_get_user_files == 0 && num_files > 0) {
-      for (u_int32_t j = 0; j < num_files; j++) {
-        if (is_same_file(files[j].path, file_path)) {
-          users_with_file++;
-        }
+  unsigned long count = strtoul(buffer, NULL, 10);
+
+  // Como en el resto de operaciones, si el usuario es de este shard tiene que estar conectado. Además
+  // solo se aceptan muestras de seeders conectados a este shard: así nadie puede subir o hundir la
+  // puntuación de direcciones arbitrarias ni llenar la tabla. Las entradas se leen igualmente para no
+  // desincronizar el protocolo.
+  const char *req = requester(user);
+  int res = req ? check_connected(&usuarios, req) : 0;
+  int read_res = 0;
+  for (unsigned long i = 0; i < count; i++) {
+    char ip[17] = {0};
+    char fields[4][32] = {{0}};
+    if (read_line(socket, ip, sizeof(ip)) <= 0) {
+      read_res = 4;
+      break;
+    }
+    ip[sizeof(ip) - 1] = '\0';
+    for (int f = 0; f < 4 && read_res == 0; f++) {
+      if (read_line(socket, fields[f], sizeof(fields[f])) <= 0) {
+        read_res = 4;
       }
     }
-    free(files);
+    if (read_res != 0) {
+      break;
+    }
+    int port = atoi(fields[0]);
+    if (res != 0 || port < 1024 || port > 65535 || !is_connected_address(&usuarios, ip, port)) {
+      continue;
+    }
+    scores_report(ip, port, strtoull(fields[1], NULL, 10), strtoull(fields[2], NULL, 10), strcmp(fields[3], "0") != 0);
   }
 
-  // Ahora que ya sabemos cuántos usuarios tienen el fichero, enviamos el número de usuarios que lo poseen
-  if (users_with_file > 255) {
-    users_with_file = 255;
-  } else if (users_with_file == 0) {
-    if (send_ret_value(socket, (uint8_t) 1) != 0) {
-      perror("s> error sending return value to user");
-      close(socket);
-      free(conn_users);
-      return;
-    }
+  if (read_res != 0) {
+    res = read_res;
   }
-  // Primero enviamos el código de operación de que ha ido bien
-  if (send_ret_value(socket, (uint8_t) 0) != 0) {
-    perror("s> error sending return value to user");
+  if (send_ret_value(socket, (uint8_t) res) != 0) {
+    printf("s> error sending return value to %s", user);
+  }
+  if (log_operation(user, "REPORT_SEEDERS", datetime, NULL) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+void handle_announce(int socket, char *user, char *datetime) {
+  // Hash del contenido, ruta del fichero en la máquina del usuario y mapa de piezas que ya tiene
+  // comprobadas (vacío para retirar el anuncio). Los clientes lo envían a menudo mientras
+  // descargan, así que, como HEARTBEAT, no se registra en el logger.
+  (void) datetime;
+  char hash[CONTENT_HASH_LEN + 2] = {0};
+  char file_path[MAX_FILE_PATH_SIZE] = {0};
+  char pieces[SWARM_MAX_PIECES_HEX + 2] = {0};
+  if (read_line(socket, hash, sizeof(hash)) <= 0 || read_line(socket, file_path, sizeof(file_path)) <= 0 ||
+      read_line(socket, pieces, sizeof(pieces)) < 0) {
+    perror("s> error reading announce");
     close(socket);
-    free(conn_users);
     return;
   }
+  hash[sizeof(hash) - 1] = '\0';
+  file_path[sizeof(file_path) - 1] = '\0';
+  pieces[sizeof(pieces) - 1] = '\0';
+
+  int res = check_connected(&usuarios, user);
+  if (res == 0) {
+    res = is_content_hash(hash) ? swarm_announce(user, hash, file_path, pieces) : 4;
+  }
+  if (send_ret_value(socket, (uint8_t) res) != 0) {
+    printf("s> error sending return value to %s", user);
+  }
+}
 
-  // Ahora enviamos el número de usuarios que tienen el fichero
-  if (send_ret_value(socket, (uint8_t) users_with_file) != 0) {
-    perror("s> error sending return value to user");
+void handle_search(int socket, char *user, char *datetime) {
+  // Texto a buscar, modo (PREFIX o SUBSTRING), desplazamiento y máximo de resultados. La
+  // respuesta es como la de LIST_CONTENT_PAGE, pero con usuario, ruta y descripción por fichero.
+  // Cada servidor del directorio solo busca entre los ficheros de sus usuarios.
+  char query[MAX_FILE_PATH_SIZE] = {0};
+  char mode[16] = {0};
+  uint32_t offset = 0;
+  uint32_t limit = 0;
+  if (read_line(socket, query, sizeof(query)) < 0 || read_line(socket, mode, sizeof(mode)) <= 0 ||
+      read_page(socket, &offset, &limit) != 0) {
+    perror("s> error reading search");
     close(socket);
-    free(conn_users);
     return;
   }
+  query[sizeof(query) - 1] = '\0';
+  mode[sizeof(mode) - 1] = '\0';
+
+  search_result_t *results = NULL;
+  uint32_t num_results = 0;
+  uint32_t total = 0;
+  const char *req = requester(user);
+  int res = req ? check_connected(&usuarios, req) : 0;
+  if (res == 0) {
+    bool prefix = strcmp(mode, "PREFIX") == 0;
+    res = prefix || strcmp(mode, "SUBSTRING") == 0
+                  ? search_query(query, prefix, offset, limit, &results, &num_results, &total)
+                  : 3;
+  }
 
-  // Ahora, por cada usuario, enviamos su ip, su puerto y el ruta del fichero.
-  // enviar la ruta es necesario porque un mismo fichero puede estar en dos rutas distintas.
-  for (u_int32_t i = 0; i < num_users; i++) {
-    file_t *files = NULL;
-    uint32_t num_files = 0;
-    int res_get_user_files = get_user_files(&usuarios, user, conn_users[i].name, &files, &num_files);
-    if (res_get_user_files == 0 && num_files > 0) {
-      for (u_int32_t j = 0; j < num_files; j++) {
-        if (is_same_file(files[j].path, file_path)) {
-          size_t len = strnlen(conn_users[i].ip, sizeof(conn_users[i].ip)) + 1;
-          if (send_message(socket, conn_users[i].ip, len) != 0) {
-            free(conn_users);
-            close(socket);
-            return;
-          }
-          char buffer[32] = {0};
-          snprintf(buffer, sizeof(buffer), "%u", conn_users[i].port);
-          len = strlen(buffer) + 1;
-          if (send_message(socket, buffer, len) != 0) {
-            free(conn_users);
-            close(socket);
-            return;
-          }
-          len = strnlen(files[j].path, sizeof(files[j].path)) + 1;
-          if (send_message(socket, files[j].path, len) != 0) {
-            free(conn_users);
-            close(socket);
-            return;
-          }
-        }
-      }
+  msg_buffer_t msg;
+  msg_buffer_init(&msg);
+  uint8_t ret = (uint8_t) res;
+  int err = msg_buffer_put(&msg, &ret, sizeof(ret));
+  if (res == 0) {
+    err |= msg_buffer_put_uint(&msg, total);
+    err |= msg_buffer_put_uint(&msg, num_results);
+    for (uint32_t i = 0; i < num_results && err == 0; i++) {
+      err |= msg_buffer_put_str(&msg, results[i].user, sizeof(results[i].user));
+      err |= msg_buffer_put_str(&msg, results[i].path, sizeof(results[i].path));
+      err |= msg_buffer_put_str(&msg, results[i].description, sizeof(results[i].description));
     }
-    free(files);
   }
+  if (err != 0 || msg_buffer_send(socket, &msg) != 0) {
+    printf("s> error sending search results to %s\n", user);
+  }
+  msg_buffer_free(&msg);
+  free(results);
+  if (log_operation(user, "SEARCH", datetime, query) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
 
-  close(socket);
-  free(conn_users);
-  if (log_operation(user, "GET_MULTIFILE", datetime, file_path) != 0) {
+/*
+ * Suscripción que ha aceptado SUBSCRIBE en este hilo. Los eventos se envían desde handle_request,
+ * después de anotar la latencia de la petición, para que el tiempo que dura la suscripción no
+ * cuente como latencia de SUBSCRIBE.
+ */
+static _Thread_local subscriber_t *pending_stream = NULL;
+
+void handle_subscribe(int socket, char *user, char *datetime) {
+  // Patrón de usuario y patrón de ruta (vacíos equivalen a "*"). Tras el código de retorno, la
+  // conexión queda abierta y por ella se envían los cambios (ver events.h) hasta que el cliente
+  // la cierra. Cada servidor del directorio solo notifica los cambios de sus usuarios.
+  char user_pattern[MAX_USER_MSG_SIZE] = {0};
+  char path_pattern[MAX_FILE_PATH_SIZE] = {0};
+  if (read_line(socket, user_pattern, sizeof(user_pattern)) < 0 ||
+      read_line(socket, path_pattern, sizeof(path_pattern)) < 0) {
+    perror("s> error reading subscription");
+    close(socket);
+    return;
+  }
+  user_pattern[sizeof(user_pattern) - 1] = '\0';
+  path_pattern[sizeof(path_pattern) - 1] = '\0';
+
+  const char *req = requester(user);
+  int res = req ? check_connected(&usuarios, req) : 0;
+  subscriber_t *sub = NULL;
+  if (res == 0) {
+    sub = events_subscribe(user_pattern, path_pattern);
+    res = sub ? 0 : 3;
+  }
+  if (log_operation(user, "SUBSCRIBE", datetime, NULL) != 0) {
     printf("s> error logging operation\n");
   }
+  if (send_ret_value(socket, (uint8_t) res) != 0) {
+    printf("s> error sending return value to %s", user);
+  }
+  pending_stream = sub;
 }
 
-void *handle_request(void *arg) {
-  int client_sock;
+/*
+ * Función auxiliar que anota la latencia de una petición en las métricas de su operación
+ */
+static void record_latency(op_stats_t *op, uint64_t us) {
+  unsigned int bucket = 0;
+  while (bucket < LATENCY_BUCKETS - 1 && (us >> bucket) != 0) {
+    bucket++;
+  }
+  atomic_fetch_add(&op->count, 1);
+  atomic_fetch_add(&op->total_us, us);
+  atomic_fetch_add(&op->hist[bucket], 1);
+  unsigned long long max = atomic_load(&op->max_us);
+  while (us > max && !atomic_compare_exchange_weak(&op->max_us, &max, us)) {
+  }
+}
 
-  pthread_mutex_lock(&req_lock);
-  client_sock = *(int *) arg;
-  free(arg);
-  req_ready = true;
-  pthread_cond_signal(&req_cond);
-  pthread_mutex_unlock(&req_lock);
+static uint64_t elapsed_us(const struct timespec *start) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  int64_t us = (int64_t) (now.tv_sec - start->tv_sec) * 1000000 + (now.tv_nsec - start->tv_nsec) / 1000;
+  return us > 0 ? (uint64_t) us : 0;
+}
 
-  // printf("[INFO (sock %d)] Cliente conectado por socket con descriptor: %d\n", client_sock, client_sock);
+/*
+ * Añaden una métrica a la respuesta de STATS y la cuentan en 'entries', que se envía antes de
+ * las métricas.
+ */
+static int put_stat(msg_buffer_t *msg, unsigned long *entries, const char *name, unsigned long value) {
+  (*entries)++;
+  return msg_buffer_put_str(msg, name, MAX_OP_MSG_SIZE) | msg_buffer_put_uint(msg, value);
+}
+
+static int put_stat_str(msg_buffer_t *msg, unsigned long *entries, const char *name, const char *value,
+                        size_t max_len) {
+  (*entries)++;
+  return msg_buffer_put_str(msg, name, MAX_OP_MSG_SIZE) | msg_buffer_put_str(msg, value, max_len);
+}
+
+void handle_stats(int socket, char *user, char *datetime) {
+  // La respuesta es el código de retorno, el número de métricas y, por cada una, su nombre y
+  // su valor. De las operaciones solo se envían las que se han usado; su histograma se envía
+  // como una lista de cubos separados por comas, sin los ceros finales.
+  msg_buffer_t msg;
+  msg_buffer_init(&msg);
+  msg_buffer_t body;
+  msg_buffer_init(&body);
+  unsigned long entries = 0;
+  int err = 0;
+
+  err |= put_stat(&body, &entries, "uptime_s", (unsigned long) (elapsed_us(&stats.started) / 1000000));
+  err |= put_stat(&body, &entries, "connections_active", atomic_load(&stats.connections_active));
+  err |= put_stat(&body, &entries, "connections_peak", atomic_load(&stats.connections_peak));
+  err |= put_stat(&body, &entries, "connections_total", atomic_load(&stats.connections_total));
+  err |= put_stat(&body, &entries, "users_connected", atomic_load(&usuarios.connected));
+  err |= put_stat(&body, &entries, "lock_waits", atomic_load(&usuarios.lock_waits));
+  err |= put_stat(&body, &entries, "lock_wait_us", atomic_load(&usuarios.lock_wait_ns) / 1000);
+  err |= put_stat(&body, &entries, "logger_inflight", atomic_load(&stats.logger_inflight));
+  err |= put_stat(&body, &entries, "logger_calls", atomic_load(&stats.logger_calls));
+  err |= put_stat(&body, &entries, "logger_errors", atomic_load(&stats.logger_errors));
+  uint64_t leases_tracked = 0, leases_expired = 0;
+  leases_stats(&leases_tracked, &leases_expired);
+  err |= put_stat(&body, &entries, "leases_tracked", leases_tracked);
+  err |= put_stat(&body, &entries, "leases_expired", leases_expired);
+  uint64_t seeders_scored = 0, seeder_reports = 0;
+  scores_stats(&seeders_scored, &seeder_reports);
+  err |= put_stat(&body, &entries, "seeders_scored", seeders_scored);
+  err |= put_stat(&body, &entries, "seeder_reports", seeder_reports);
+  uint64_t swarm_files = 0, swarm_holders_count = 0;
+  swarm_stats(&swarm_files, &swarm_holders_count);
+  err |= put_stat(&body, &entries, "swarm_files", swarm_files);
+  err |= put_stat(&body, &entries, "swarm_holders", swarm_holders_count);
+  uint64_t search_files = 0, search_grams = 0;
+  search_stats(&search_files, &search_grams);
+  err |= put_stat(&body, &entries, "search_files", search_files);
+  err |= put_stat(&body, &entries, "search_grams", search_grams);
+  uint64_t subscribers = 0, events_delivered = 0, events_lost = 0;
+  events_stats(&subscribers, &events_delivered, &events_lost);
+  err |= put_stat(&body, &entries, "subscribers", subscribers);
+  err |= put_stat(&body, &entries, "events_delivered", events_delivered);
+  err |= put_stat(&body, &entries, "events_lost", events_lost);
+
+  char name[MAX_OP_MSG_SIZE + 16];
+  for (size_t i = 0; i <= NUM_OPERATIONS; i++) {
+    op_stats_t *op = &op_stats[i];
+    unsigned long long count = atomic_load(&op->count);
+    if (count == 0) {
+      continue;
+    }
+    const char *op_name = i < NUM_OPERATIONS ? operations[i].name : "UNKNOWN";
+    snprintf(name, sizeof(name), "op.%s.count", op_name);
+    err |= put_stat(&body, &entries, name, count);
+    snprintf(name, sizeof(name), "op.%s.total_us", op_name);
+    err |= put_stat(&body, &entries, name, atomic_load(&op->total_us));
+    snprintf(name, sizeof(name), "op.%s.max_us", op_name);
+    err |= put_stat(&body, &entries, name, atomic_load(&op->max_us));
+
+    char hist[LATENCY_BUCKETS * 21] = {0};
+    size_t len = 0;
+    unsigned int last = 0;
+    for (unsigned int b = 0; b < LATENCY_BUCKETS; b++) {
+      if (atomic_load(&op->hist[b]) != 0) {
+        last = b;
+      }
+    }
+    for (unsigned int b = 0; b <= last; b++) {
+      len += (size_t) snprintf(hist + len, sizeof(hist) - len, b ? ",%llu" : "%llu", atomic_load(&op->hist[b]));
+    }
+    snprintf(name, sizeof(name), "op.%s.hist", op_name);
+    err |= put_stat_str(&body, &entries, name, hist, sizeof(hist));
+  }
+
+  uint8_t ret = err ? 1 : 0;
+  err |= msg_buffer_put(&msg, &ret, sizeof(ret));
+  if (ret == 0) {
+    err |= msg_buffer_put_uint(&msg, entries);
+    err |= msg_buffer_put(&msg, body.data, body.len);
+  }
+  if (msg_buffer_send(socket, &msg) != 0) {
+    printf("s> error sending stats to %s\n", user);
+  }
+  msg_buffer_free(&body);
+  msg_buffer_free(&msg);
+  if (log_operation(user, "STATS", datetime, NULL) != 0) {
+    printf("s> error logging operation\n");
+  }
+}
+
+void handle_heartbeat(int socket, char *user, char *datetime) {
+  // Renueva el lease del usuario. Si devuelve 2, el lease ya había caducado y el cliente tiene
+  // que volver a conectarse. No se registra en el logger: se envía cada pocos segundos.
+  (void) datetime;
+  int res = leases_renew(user);
+  if (send_ret_value(socket, (uint8_t) res) != 0) {
+    printf("s> error sending return value to %s", user);
+  }
+}
 
+/*
+ * Lee la cabecera de la petición (operación, fecha y usuario) y la despacha. Retorna la
+ * suscripción que queda abierta si la petición era un SUBSCRIBE aceptado, o NULL.
+ */
+static subscriber_t *process_request(int client_sock) {
   // Primero, leemos la operación
   char operation[MAX_OP_MSG_SIZE];
   memset(operation, 0, MAX_OP_MSG_SIZE);
@@ -488,7 +1290,6 @@ void *handle_request(void *arg) {
   const ssize_t bytes_read = read_line(client_sock, operation, MAX_OP_MSG_SIZE);
   if (bytes_read <= 0) {
     perror("s> error reading operation");
-    close(client_sock);
     return NULL;
   }
 
@@ -499,7 +1300,6 @@ void *handle_request(void *arg) {
   const ssize_t bytes_read_datetime = read_line(client_sock, datetime, MAX_DATETIME_SIZE);
   if (bytes_read_datetime <= 0) {
     perror("s> error reading datetime");
-    close(client_sock);
     return NULL;
   }
 
@@ -507,58 +1307,153 @@ void *handle_request(void *arg) {
   char user[MAX_USER_MSG_SIZE];
   memset(user, 0, MAX_USER_MSG_SIZE);
 
+  // STATS no necesita un usuario conectado: en ese caso el cliente envía un usuario vacío
   const ssize_t bytes_read_user = read_line(client_sock, user, MAX_USER_MSG_SIZE);
-  if (bytes_read_user <= 0) {
+  if (bytes_read_user < 0 || (bytes_read_user == 0 && strcmp(operation, "STATS") != 0)) {
     perror("s> error reading user");
-    close(client_sock);
     return NULL;
   }
 
   printf("s> OPERATION %s FROM %s AT %s\n", operation, user, datetime);
 
   // Aquí se realizan las operaciones
-  if (strcmp(operation, "REGISTER") == 0) {
-    handle_register(client_sock, user, datetime);
-  } else if (strcmp(operation, "UNREGISTER") == 0) {
-    handle_unregister(client_sock, user, datetime);
-  } else if (strcmp(operation, "CONNECT") == 0) {
-    handle_connect(client_sock, user, datetime);
-  } else if (strcmp(operation, "DISCONNECT") == 0) {
-    handle_disconnect(client_sock, user, datetime);
-  } else if (strcmp(operation, "PUBLISH") == 0) {
-    handle_publish(client_sock, user, datetime);
-  } else if (strcmp(operation, "DELETE") == 0) {
-    handle_delete(client_sock, user, datetime);
-  } else if (strcmp(operation, "LIST_USERS") == 0) {
-    handle_list_users(client_sock, user, datetime);
-  } else if (strcmp(operation, "LIST_CONTENT") == 0) {
-    handle_list_files(client_sock, user, datetime);
-  } else if (strcmp(operation, "GET_MULTIFILE") == 0) {
-    handle_getmultifile(client_sock, user, datetime);
+  struct timespec start;
+  clock_gettime(CLOCK_MONOTONIC, &start);
+
+  size_t op = 0;
+  while (op < NUM_OPERATIONS && strcmp(operation, operations[op].name) != 0) {
+    op++;
+  }
+  if (op < NUM_OPERATIONS) {
+    operations[op].handler(client_sock, user, datetime);
   } else {
     printf("s> unknown operation: %s\n", operation);
     log_operation(user, "UNKNOWN", datetime, NULL);
   }
 
-  close(client_sock);
+  record_latency(&op_stats[op], elapsed_us(&start));
+
+  subscriber_t *sub = pending_stream;
+  pending_stream = NULL;
+  return sub;
+}
+
+void *handle_request(void *arg) {
+  int client_sock;
+
+  pthread_mutex_lock(&req_lock);
+  client_sock = *(int *) arg;
+  free(arg);
+  req_ready = true;
+  pthread_cond_signal(&req_cond);
+  pthread_mutex_unlock(&req_lock);
+
+  // printf("[INFO (sock %d)] Cliente conectado por socket con descriptor: %d\n", client_sock, client_sock);
+
+  // Cada conexión se atiende en su propio hilo, así que las conexiones activas son también
+  // los hilos de atención activos
+  atomic_fetch_add(&stats.connections_total, 1);
+  unsigned int active = atomic_fetch_add(&stats.connections_active, 1) + 1;
+  unsigned int peak = atomic_load(&stats.connections_peak);
+  while (active > peak && !atomic_compare_exchange_weak(&stats.connections_peak, &peak, active)) {
+  }
+
+  subscriber_t *sub = process_request(client_sock);
   fflush(stdout);
+  atomic_fetch_sub(&stats.connections_active, 1);
+
+  // Un suscriptor mantiene la conexión abierta mientras dura la suscripción, pero ya no cuenta
+  // como conexión activa: se ve en la métrica 'subscribers'
+  if (sub) {
+    events_stream(sub, client_sock);
+  }
+  close(client_sock);
 
   return NULL;
 }
 
 int main(int argc, char *argv[]) {
-  if (argc != 3 || strcmp(argv[1], "-p") != 0) {
-    fprintf(stderr, "Uso: %s -p <puerto>\n", argv[0]);
+  int port_arg = -1;
+  int opt_char;
+  while ((opt_char = getopt(argc, argv, "p:n:")) != -1) {
+    switch (opt_char) {
+      case 'p':
+        port_arg = atoi(optarg);
+        break;
+      case 'n':
+        // Índice de este servidor y número de servidores del directorio particionado
+        if (sscanf(optarg, "%u/%u", &shard_index, &shard_count) != 2 || shard_count == 0 ||
+            shard_index >= shard_count) {
+          fprintf(stderr, "Partición no válida: %s (se espera índice/total, p.ej. 0/2)\n", optarg);
+          exit(EXIT_FAILURE);
+        }
+        break;
+      default:
+        port_arg = -1;
+        optind = argc;
+        break;
+    }
+  }
+  if (port_arg < 0 || optind != argc) {
+    fprintf(stderr, "Uso: %s -p <puerto> [-n <índice>/<total>]\n", argv[0]);
     exit(EXIT_FAILURE);
   }
-  __uint16_t port = (__uint16_t) atoi(argv[2]);
   // No es necesario comprobar si el puerto es mayor que 65535 porque el tipo de dato
   // __uint16_t no puede almacenar un número mayor que 65535.
+  __uint16_t port = (__uint16_t) port_arg;
   if (port < 1024) {
     perror("El puerto debe estar entre 1024 y 65535");
     exit(EXIT_FAILURE);
   }
 
+  // Bloqueamos las señales de salida antes de crear ningún hilo (todos heredan la máscara) para que
+  // solo las atienda el hilo de apagado
+  static sigset_t exit_signals;
+  sigemptyset(&exit_signals);
+  sigaddset(&exit_signals, SIGINT);
+  sigaddset(&exit_signals, SIGTERM); // Para pararlo en CLion
+  pthread_sigmask(SIG_BLOCK, &exit_signals, NULL);
+
+  clock_gettime(CLOCK_MONOTONIC, &stats.started);
+  init_users(&usuarios);
+
+  // Si se indica un directorio de datos, el estado se recupera de él y se persiste en él
+  char *data_dir = getenv("SERVER_DATA_DIR");
+  if (data_dir && *data_dir) {
+    char *snapshot_every = getenv("SERVER_SNAPSHOT_EVERY");
+    char *wal_fsync = getenv("SERVER_WAL_FSYNC");
+    uint64_t every = snapshot_every ? strtoull(snapshot_every, NULL, 10) : 100000;
+    bool sync = wal_fsync && strcmp(wal_fsync, "1") == 0;
+    if (persist_open(&usuarios, data_dir, every, sync) != 0) {
+      fprintf(stderr, "[ERROR] al recuperar el estado de %s\n", data_dir);
+      exit(EXIT_FAILURE);
+    }
+  }
+
+  char *top_k = getenv("SERVER_SEEDERS_TOP_K");
+  seeders_top_k = top_k ? (unsigned int) strtoul(top_k, NULL, 10) : 0;
+
+  // Los usuarios conectados que dejan de enviar HEARTBEAT se desconectan al caducar su lease
+  char *lease_env = getenv("SERVER_LEASE_SECS");
+  unsigned long lease_secs = lease_env ? strtoul(lease_env, NULL, 10) : 30;
+  if (swarm_init(&usuarios) != 0) {
+    fprintf(stderr, "[ERROR] al registrar el enjambre de descargas\n");
+    exit(EXIT_FAILURE);
+  }
+  // El índice de búsqueda parte de los ficheros recuperados
+  if (search_init(&usuarios) != 0) {
+    fprintf(stderr, "[ERROR] al construir el índice de búsqueda\n");
+    exit(EXIT_FAILURE);
+  }
+  if (events_start(&usuarios) != 0) {
+    fprintf(stderr, "[ERROR] al arrancar las notificaciones de cambios\n");
+    exit(EXIT_FAILURE);
+  }
+  if (leases_start(&usuarios, (unsigned int) lease_secs) != 0) {
+    fprintf(stderr, "[ERROR] al arrancar la caducidad de las conexiones\n");
+    exit(EXIT_FAILURE);
+  }
+
   struct sockaddr_in server_addr;
 
   if ((server_sock = socket(AF_INET, SOCK_STREAM, 0)) == -1) {
@@ -566,8 +1461,13 @@ int main(int argc, char *argv[]) {
     exit(EXIT_FAILURE);
   }
 
-  signal(SIGINT, handle_poweroff);
-  signal(SIGTERM, handle_poweroff); // Para pararlo en CLion
+  pthread_t poweroff_thread;
+  if (pthread_create(&poweroff_thread, NULL, handle_poweroff, &exit_signals) != 0) {
+    perror("[ERROR] al crear el hilo de apagado");
+    close(server_sock);
+    exit(EXIT_FAILURE);
+  }
+  pthread_detach(poweroff_thread);
 
   server_addr.sin_family = AF_INET;
   server_addr.sin_port = htons(port);
@@ -597,6 +1497,9 @@ int main(int argc, char *argv[]) {
   }
 
   printf("s> init server %s:%u\n", inet_ntoa(server_addr.sin_addr), ntohs(server_addr.sin_port));
+  if (shard_count > 1) {
+    printf("s> directory shard %u/%u\n", shard_index, shard_count);
+  }
 
   while (1) {
     struct sockaddr_in client_addr;
@@ -0,0 +1,191 @@
+#include "swarm.h"
+#include <pthread.h>
+#include <stdbool.h>
+#include <stdlib.h>
+#include <string.h>
+
+#define SWARM_BUCKETS 1024
+/* Límite de anuncios guardados; por encima, los nuevos se rechazan */
+#define SWARM_MAX_HOLDERS 65536
+
+typedef struct holder_node_s {
+  swarm_holder_t holder;
+  struct holder_node_s *next;
+} holder_node_t;
+
+typedef struct swarm_file_s {
+  char hash[CONTENT_HASH_LEN + 1];
+  holder_node_t *holders;
+  struct swarm_file_s *next;
+} swarm_file_t;
+
+static struct {
+  pthread_mutex_t lock;
+  swarm_file_t *buckets[SWARM_BUCKETS];
+  uint64_t files;
+  uint64_t holders;
+} swarm = {
+        .lock = PTHREAD_MUTEX_INITIALIZER,
+};
+
+static bool is_piece_map(const char *pieces) {
+  size_t len = strnlen(pieces, SWARM_MAX_PIECES_HEX + 1);
+  if (len > SWARM_MAX_PIECES_HEX) {
+    return false;
+  }
+  for (size_t i = 0; i < len; i++) {
+    if (!((pieces[i] >= '0' && pieces[i] <= '9') || (pieces[i] >= 'a' && pieces[i] <= 'f'))) {
+      return false;
+    }
+  }
+  return true;
+}
+
+/*
+ * Devuelve el enlace al fichero con contenido 'hash', o el enlace vacío del final de su cadena
+ * si no hay anuncios de ese contenido. Se llama con swarm.lock tomado.
+ */
+static swarm_file_t **lookup(const char *hash) {
+  swarm_file_t **link = &swarm.buckets[user_hash(hash) % SWARM_BUCKETS];
+  while (*link && strcmp((*link)->hash, hash) != 0) {
+    link = &(*link)->next;
+  }
+  return link;
+}
+
+/*
+ * Quita el anuncio de 'user' de un fichero y, si era el último, el propio fichero. Se llama
+ * con swarm.lock tomado.
+ */
+static void forget(swarm_file_t **file_link, const char *user) {
+  swarm_file_t *file = *file_link;
+  for (holder_node_t **link = &file->holders; *link; link = &(*link)->next) {
+    if (strcmp((*link)->holder.user, user) == 0) {
+      holder_node_t *node = *link;
+      *link = node->next;
+      free(node);
+      swarm.holders--;
+      break;
+    }
+  }
+  if (!file->holders) {
+    *file_link = file->next;
+    free(file);
+    swarm.files--;
+  }
+}
+
+int swarm_announce(const char *user, const char *hash, const char *path, const char *pieces) {
+  if (!user || !hash || !path || !pieces || strlen(hash) != CONTENT_HASH_LEN || !is_piece_map(pieces)) {
+    return 4;
+  }
+
+  pthread_mutex_lock(&swarm.lock);
+  swarm_file_t **file_link = lookup(hash);
+  if (pieces[0] == '\0') {
+    if (*file_link) {
+      forget(file_link, user);
+    }
+    pthread_mutex_unlock(&swarm.lock);
+    return 0;
+  }
+
+  if (!*file_link) {
+    swarm_file_t *file = (swarm_file_t *) calloc(1, sizeof(swarm_file_t));
+    if (!file) {
+      pthread_mutex_unlock(&swarm.lock);
+      return 4;
+    }
+    memcpy(file->hash, hash, CONTENT_HASH_LEN);
+    *file_link = file;
+    swarm.files++;
+  }
+  swarm_file_t *file = *file_link;
+
+  holder_node_t *node = file->holders;
+  while (node && strcmp(node->holder.user, user) != 0) {
+    node = node->next;
+  }
+  if (!node) {
+    node = swarm.holders < SWARM_MAX_HOLDERS ? (holder_node_t *) calloc(1, sizeof(holder_node_t)) : NULL;
+    if (!node) {
+      if (!file->holders) {
+        *file_link = file->next;
+        free(file);
+        swarm.files--;
+      }
+      pthread_mutex_unlock(&swarm.lock);
+      return 4;
+    }
+    strncpy(node->holder.user, user, sizeof(node->holder.user) - 1);
+    node->next = file->holders;
+    file->holders = node;
+    swarm.holders++;
+  }
+  strncpy(node->holder.path, path, sizeof(node->holder.path) - 1);
+  strncpy(node->holder.pieces, pieces, sizeof(node->holder.pieces) - 1);
+  pthread_mutex_unlock(&swarm.lock);
+  return 0;
+}
+
+int swarm_holders(const char *hash, const char *exclude, swarm_holder_t **holders, uint32_t *n) {
+  *holders = NULL;
+  *n = 0;
+  pthread_mutex_lock(&swarm.lock);
+  swarm_file_t *file = *lookup(hash);
+  uint32_t count = 0;
+  for (holder_node_t *node = file ? file->holders : NULL; node; node = node->next) {
+    count++;
+  }
+  if (count == 0) {
+    pthread_mutex_unlock(&swarm.lock);
+    return 0;
+  }
+  *holders = (swarm_holder_t *) malloc(count * sizeof(swarm_holder_t));
+  if (!*holders) {
+    pthread_mutex_unlock(&swarm.lock);
+    return 4;
+  }
+  for (holder_node_t *node = file->holders; node; node = node->next) {
+    if (!exclude || strcmp(node->holder.user, exclude) != 0) {
+      (*holders)[(*n)++] = node->holder;
+    }
+  }
+  pthread_mutex_unlock(&swarm.lock);
+  return 0;
+}
+
+void swarm_stats(uint64_t *files, uint64_t *holders) {
+  pthread_mutex_lock(&swarm.lock);
+  *files = swarm.files;
+  *holders = swarm.holders;
+  pthread_mutex_unlock(&swarm.lock);
+}
+
+/*
+ * Observador del almacén: cuando un usuario se desconecta o se da de baja, su ServerThread ya
+ * no sirve nada, así que se olvidan todos sus anuncios
+ */
+static void swarm_hook(void *ctx, claves_op_t op, const user_t *user, const file_t *file) {
+  (void) ctx;
+  (void) file;
+  if (op != CLAVES_DISCONNECT && op != CLAVES_UNREGISTER) {
+    return;
+  }
+  pthread_mutex_lock(&swarm.lock);
+  if (swarm.holders > 0) {
+    for (unsigned int b = 0; b < SWARM_BUCKETS; b++) {
+      swarm_file_t **link = &swarm.buckets[b];
+      while (*link) {
+        swarm_file_t *current = *link;
+        forget(link, user->name);
+        if (*link == current) {
+          link = &current->next;
+        }
+      }
+    }
+  }
+  pthread_mutex_unlock(&swarm.lock);
+}
+
+int swarm_init(users_t *db) { return add_hook(db, swarm_hook, NULL); }
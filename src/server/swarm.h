@@ -0,0 +1,63 @@
+#ifndef SWARM_H
+#define SWARM_H
+
+#include <stdint.h>
+
+#include "claves.h"
+
+/*
+ * Enjambre (swarm) de descargas en curso. Mientras descarga un fichero publicado con hash, un
+ * cliente anuncia (ANNOUNCE) qué piezas tiene ya comprobadas, y su ServerThread las sirve a los
+ * demás. GET_MULTIFILE2 devuelve estos poseedores parciales junto a los seeders, con su mapa de
+ * piezas, de modo que durante una avalancha de descargas la carga se reparte entre los que ya
+ * tienen parte del fichero y no recae solo en los seeders originales.
+ *
+ * El mapa de piezas es una cadena hexadecimal: el dígito k cubre las piezas 4k a 4k+3 y la
+ * pieza 4k es su bit más significativo. Los anuncios se guardan por hash del contenido y se
+ * olvidan cuando el usuario se desconecta (por DISCONNECT o porque caduca su lease).
+ */
+
+/** Longitud máxima del mapa de piezas (8192 piezas) */
+#define SWARM_MAX_PIECES_HEX 2048
+
+/**
+ * @struct swarm_holder_s
+ * @brief Copia de un anuncio: usuario, ruta del fichero en su máquina y mapa de piezas.
+ */
+typedef struct swarm_holder_s {
+  char user[256]; /**< Usuario que anuncia las piezas */
+  char path[256]; /**< Ruta del fichero (incompleto) en la máquina del usuario */
+  char pieces[SWARM_MAX_PIECES_HEX + 1]; /**< Mapa de piezas comprobadas */
+} swarm_holder_t;
+
+/**
+ * @brief Registra el observador que olvida los anuncios de los usuarios que se desconectan.
+ *
+ * @return int: los mismos valores que add_hook.
+ */
+int swarm_init(users_t *db);
+
+/**
+ * @brief Anota las piezas que tiene 'user' del contenido 'hash'. Un mapa vacío retira el
+ * anuncio (por ejemplo, porque la descarga ha fallado).
+ *
+ * @return int:
+ *   - 0 si se ha anotado.
+ *   - 4 si el mapa no es válido o no hay memoria.
+ */
+int swarm_announce(const char *user, const char *hash, const char *path, const char *pieces);
+
+/**
+ * @brief Devuelve una copia de los anuncios del contenido 'hash', salvo los de 'exclude'.
+ * LIBERAR 'holders' ES RESPONSABILIDAD DEL CALLER.
+ *
+ * @return int: 0 si todo va bien, 4 si no hay memoria.
+ */
+int swarm_holders(const char *hash, const char *exclude, swarm_holder_t **holders, uint32_t *n);
+
+/**
+ * @brief Devuelve el número de ficheros con anuncios y el número de anuncios.
+ */
+void swarm_stats(uint64_t *files, uint64_t *holders);
+
+#endif // SWARM_H
@@ -13,6 +13,9 @@ NC='\033[0m'
 
 mkdir -p test_files/output/logs
 rm -f test_files/output/logs/*.log
+# Índice de las carpetas compartidas con SHARE, fuera del ~/.ssdd del usuario
+export SSDD_HOME="$(pwd)/test_files/output/ssdd"
+rm -rf "$SSDD_HOME"
 
 start_server() {
   export LOG_RPC_IP=$RPC_SERVICE_IP
@@ -34,12 +37,13 @@ run_test() {
   local test_name=$1
   local input_file=$2
   local expected_file=$3
+  local client_args=${4:-"-s $SERVER_IP -p $SERVER_PORT"}
   local output_file="test_files/output/${test_name}.output"
 
   echo -e -n "${YELLOW}Running test '$test_name'...${NC} "
 
   # Ejecutar el cliente, redirigiendo entrada desde $input_file y guardando salida
-  python3 client/client.py -s $SERVER_IP -p $SERVER_PORT < "$input_file" > "$output_file" 2>/dev/null
+  python3 client/client.py $client_args < "$input_file" > "$output_file" 2>/dev/null
 
   normalize_output() {
     sed -E 's/[0-9]{4,5}/PORT/g' "$1" | \
@@ -122,6 +126,9 @@ restart_server
 run_test "list_content_3" "test_files/input/list_content_3.txt" "test_files/expected/list_content_3_expected.txt"
 restart_server
 run_test "list_content_4" "test_files/input/list_content_4.txt" "test_files/expected/list_content_4_expected.txt"
+# LIST_CONTENT paginado: 3 ficheros pedidos en páginas de 2
+restart_server
+run_test "list_content_5" "test_files/input/list_content_5.txt" "test_files/expected/list_content_5_expected.txt"
 
 restart_server
 run_test "disconnect_1" "test_files/input/disconnect_1.txt" "test_files/expected/disconnect_1_expected.txt"
@@ -130,6 +137,37 @@ run_test "disconnect_2" "test_files/input/disconnect_2.txt" "test_files/expected
 restart_server
 run_test "disconnect_3" "test_files/input/disconnect_3.txt" "test_files/expected/disconnect_3_expected.txt"
 
+restart_server
+run_test "set_1" "test_files/input/set_1.txt" "test_files/expected/set_1_expected.txt"
+restart_server
+run_test "share_1" "test_files/input/share_1.txt" "test_files/expected/share_1_expected.txt"
+
+# SHARE solo reenvía lo que ha cambiado: tras editar uno de los dos ficheros compartidos, volver a
+# compartir la carpeta lo borra y lo publica de nuevo, y deja el otro como estaba
+SHARE_MOD_DIR="$(pwd)/test_files/output/share_mod"
+rm -rf "$SHARE_MOD_DIR"
+mkdir -p "$SHARE_MOD_DIR"
+echo "uno" > "$SHARE_MOD_DIR/uno.txt"
+echo "dos" > "$SHARE_MOD_DIR/dos.txt"
+printf "register share_mod\nconnect share_mod\nshare $SHARE_MOD_DIR\nquit\n" > test_files/input/share_mod_a.txt
+printf "connect share_mod\nshare $SHARE_MOD_DIR\nlist_content share_mod\nquit\n" > test_files/input/share_mod_b.txt
+restart_server
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT < test_files/input/share_mod_a.txt \
+    > test_files/output/share_mod_a.output 2>/dev/null
+echo "uno, editado" > "$SHARE_MOD_DIR/uno.txt"
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT < test_files/input/share_mod_b.txt \
+    > test_files/output/share_mod_b.output 2>/dev/null
+
+if grep -q "SHARE OK, 2 PUBLISHED, 0 MODIFIED, 0 DELETED, 0 UNCHANGED" test_files/output/share_mod_a.output &&
+    grep -q "SHARE OK, 0 PUBLISHED, 1 MODIFIED, 0 DELETED, 1 UNCHANGED" test_files/output/share_mod_b.output &&
+    [[ $(grep -c "FILE[0-9]" test_files/output/share_mod_b.output) -eq 2 ]]; then
+    echo -e "${GREEN}SHARE MODIFIED OK.${NC}"
+else
+    echo -e "${RED}SHARE MODIFIED Fail.${NC}"
+fi
+
+rm -f test_files/input/share_mod_a.txt test_files/input/share_mod_b.txt
+
 echo
 echo -e "${BLUE}GET FILE & GET MULTIFILE DOWNLOAD TESTS. PREPARING SCENARIOS...${NC}"
 echo
@@ -170,6 +208,7 @@ EOF
 cat > test_files/input/scenario_c.txt <<EOF
 register user_c
 connect user_c
+set cache_mb 0
 get_file user_a $FILE_PATH ./temp_download.txt
 get_multifile temp.txt ./temp_multidownload.txt
 EOF
@@ -261,7 +300,533 @@ fi
 rm -f test_files/input/scenario_a.txt
 rm -f test_files/input/scenario_b.txt
 rm -f test_files/input/scenario_c.txt
-rm -f temp.txt temp_download.txt temp_multidownload.txt
+rm -f temp_download.txt temp_multidownload.txt
+
+# Un seeder muere sin desconectarse (sigue en el directorio hasta que caduque su lease): el
+# fragmento que le toca se tiene que pedir al otro seeder
+printf "register user_d\nconnect user_d\npublish $FILE_PATH seeder que muere\n" > test_files/input/scenario_d.txt
+printf "register user_e\nconnect user_e\npublish $FILE_PATH seeder vivo\n" > test_files/input/scenario_e.txt
+printf "register user_f\nconnect user_f\nset cache_mb 0\nget_multifile temp.txt ./temp_multidownload.txt\n" \
+    > test_files/input/scenario_f.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_d.txt \
+    > test_files/output/scenario_d.output 2>/dev/null &
+CLIENT_D_PID=$!
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_e.txt \
+    > test_files/output/scenario_e.output 2>/dev/null &
+CLIENT_E_PID=$!
+sleep 2
+kill -9 $CLIENT_D_PID 2>/dev/null
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_f.txt \
+    > test_files/output/scenario_f.output 2>/dev/null &
+CLIENT_F_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 20); do
+    cmp -s temp.txt temp_multidownload.txt && break
+    sleep 0.5
+done
+
+kill $CLIENT_E_PID $CLIENT_F_PID 2>/dev/null
+
+if diff -q temp.txt temp_multidownload.txt >/dev/null; then
+    echo -e "${GREEN}GET MULTIFILE FALLBACK OK.${NC}"
+else
+    echo -e "${RED}GET MULTIFILE FALLBACK Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_d.txt
+rm -f test_files/input/scenario_e.txt
+rm -f test_files/input/scenario_f.txt
+rm -f temp_multidownload.txt
+
+# Dos seeders publican ficheros distintos con el mismo nombre: la descarga por nombre no puede
+# mezclarlos y la descarga por hash tiene que traer exactamente ese contenido
+OTHER_PATH="$(pwd)/test_files/output/other/temp.txt"
+mkdir -p "$(dirname "$OTHER_PATH")"
+seq 1 2000 > "$OTHER_PATH"
+FILE_HASH=$(cd client && python3 -c "import manifest; print(manifest.build_manifest('$FILE_PATH')['hash'])")
+printf "register user_g\nconnect user_g\npublish $FILE_PATH mismo nombre\n" > test_files/input/scenario_g.txt
+printf "register user_h\nconnect user_h\npublish $OTHER_PATH mismo nombre, otro contenido\n" \
+    > test_files/input/scenario_h.txt
+printf "register user_i\nconnect user_i\nset cache_mb 0\nget_multifile temp.txt ./temp_byname.txt\nget_multifile sha256:$FILE_HASH ./temp_byhash.txt\n" \
+    > test_files/input/scenario_i.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_g.txt \
+    > test_files/output/scenario_g.output 2>/dev/null &
+CLIENT_G_PID=$!
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_h.txt \
+    > test_files/output/scenario_h.output 2>/dev/null &
+CLIENT_H_PID=$!
+sleep 2
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_i.txt \
+    > test_files/output/scenario_i.output 2>/dev/null &
+CLIENT_I_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 20); do
+    cmp -s temp.txt temp_byhash.txt && break
+    sleep 0.5
+done
+
+kill $CLIENT_G_PID $CLIENT_H_PID $CLIENT_I_PID 2>/dev/null
+
+if cmp -s temp.txt temp_byname.txt || cmp -s "$OTHER_PATH" temp_byname.txt; then
+    echo -e "${GREEN}GET MULTIFILE SAME NAME OK.${NC}"
+else
+    echo -e "${RED}GET MULTIFILE SAME NAME Fail.${NC}"
+fi
+if diff -q temp.txt temp_byhash.txt >/dev/null; then
+    echo -e "${GREEN}GET MULTIFILE BY HASH OK.${NC}"
+else
+    echo -e "${RED}GET MULTIFILE BY HASH Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_g.txt
+rm -f test_files/input/scenario_h.txt
+rm -f test_files/input/scenario_i.txt
+rm -f temp_byname.txt temp_byhash.txt
+
+# Enjambre: user_k descarga el fichero de user_j y lo sigue ofreciendo; user_j muere sin
+# desconectarse y user_l tiene que descargarlo de user_k, que nunca lo ha publicado
+printf "register user_j\nconnect user_j\npublish $FILE_PATH seeder original\n" > test_files/input/scenario_j.txt
+printf "register user_k\nconnect user_k\nset cache_mb 0\nget_multifile sha256:$FILE_HASH ./temp_swarm_k.txt\n" \
+    > test_files/input/scenario_k.txt
+printf "register user_l\nconnect user_l\nset cache_mb 0\nget_multifile sha256:$FILE_HASH ./temp_swarm_l.txt\n" \
+    > test_files/input/scenario_l.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_j.txt \
+    > test_files/output/scenario_j.output 2>/dev/null &
+CLIENT_J_PID=$!
+sleep 2
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_k.txt \
+    > test_files/output/scenario_k.output 2>/dev/null &
+CLIENT_K_PID=$!
+for _ in $(seq 20); do
+    grep -q "GET_MULTIFILE OK" test_files/output/scenario_k.output && break
+    sleep 0.5
+done
+kill -9 $CLIENT_J_PID 2>/dev/null
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_l.txt \
+    > test_files/output/scenario_l.output 2>/dev/null &
+CLIENT_L_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 20); do
+    grep -q "GET_MULTIFILE" test_files/output/scenario_l.output && break
+    sleep 0.5
+done
+
+kill $CLIENT_K_PID $CLIENT_L_PID 2>/dev/null
+
+if diff -q temp.txt temp_swarm_l.txt >/dev/null; then
+    echo -e "${GREEN}GET MULTIFILE SWARM OK.${NC}"
+else
+    echo -e "${RED}GET MULTIFILE SWARM Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_j.txt
+rm -f test_files/input/scenario_k.txt
+rm -f test_files/input/scenario_l.txt
+rm -f temp_swarm_k.txt temp_swarm_l.txt
+
+# Enjambre con una descarga fallida: el fichero de user_y cambia después de publicarlo (con el
+# mismo tamaño y mtime, así que sigue sirviendo el manifiesto anterior) y su última pieza no
+# coincide. user_z anuncia las piezas buenas mientras descarga y, al fallar, retira el anuncio,
+# así que el directorio ya no lo ofrece como poseedor parcial
+BROKEN_PATH="$(pwd)/test_files/output/swarm_fail/broken.bin"
+mkdir -p "$(dirname "$BROKEN_PATH")"
+head -c 1048576 /dev/urandom > "$BROKEN_PATH"
+BROKEN_HASH=$(cd client && python3 -c "import manifest; print(manifest.build_manifest('$BROKEN_PATH')['hash'])")
+printf "register user_y\nconnect user_y\npublish $BROKEN_PATH contenido roto\n" > test_files/input/scenario_y.txt
+printf "register user_z\nconnect user_z\nset cache_mb 0\nget_multifile sha256:$BROKEN_HASH ./temp_broken.bin\nstats\n" \
+    > test_files/input/scenario_z.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_y.txt \
+    > test_files/output/scenario_y.output 2>/dev/null &
+CLIENT_Y_PID=$!
+sleep 2
+cp -p "$BROKEN_PATH" "$BROKEN_PATH.ref"
+dd if=/dev/zero of="$BROKEN_PATH" bs=16 count=1 seek=65500 conv=notrunc 2>/dev/null
+touch -r "$BROKEN_PATH.ref" "$BROKEN_PATH"
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_z.txt \
+    > test_files/output/scenario_z.output 2>/dev/null &
+CLIENT_Z_PID=$!
+
+echo -e "${YELLOW}Waiting for download to fail...${NC}"
+for _ in $(seq 20); do
+    grep -q "STATS" test_files/output/scenario_z.output && break
+    sleep 0.5
+done
+
+kill $CLIENT_Y_PID $CLIENT_Z_PID 2>/dev/null
+
+if grep -q "GET_MULTIFILE FAIL" test_files/output/scenario_z.output &&
+    grep -q "swarm 0 files (0 holders)" test_files/output/scenario_z.output; then
+    echo -e "${GREEN}GET MULTIFILE SWARM WITHDRAW OK.${NC}"
+else
+    echo -e "${RED}GET MULTIFILE SWARM WITHDRAW Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_y.txt
+rm -f test_files/input/scenario_z.txt
+rm -f temp_broken.bin
+
+# Caché: user_n descarga el fichero de user_m con get_file y lo vuelve a pedir con otro nombre;
+# muerto user_m, user_o (otro usuario del mismo cliente) lo pide por hash. Las dos últimas
+# descargas se sirven de la caché
+printf "register user_m\nconnect user_m\npublish $FILE_PATH seeder de la cache\n" > test_files/input/scenario_m.txt
+printf "register user_n\nconnect user_n\nget_file user_m $FILE_PATH ./temp_cache_1.txt\nget_multifile temp.txt ./temp_cache_2.txt\n" \
+    > test_files/input/scenario_n.txt
+printf "register user_o\nconnect user_o\nget_multifile sha256:$FILE_HASH ./temp_cache_3.txt\ncache\n" \
+    > test_files/input/scenario_o.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_m.txt \
+    > test_files/output/scenario_m.output 2>/dev/null &
+CLIENT_M_PID=$!
+sleep 2
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_n.txt \
+    > test_files/output/scenario_n.output 2>/dev/null &
+CLIENT_N_PID=$!
+for _ in $(seq 20); do
+    grep -q "GET_MULTIFILE" test_files/output/scenario_n.output && break
+    sleep 0.5
+done
+kill -9 $CLIENT_M_PID 2>/dev/null
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_o.txt \
+    > test_files/output/scenario_o.output 2>/dev/null &
+CLIENT_O_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 20); do
+    grep -q "CACHE OK" test_files/output/scenario_o.output && break
+    sleep 0.5
+done
+
+kill $CLIENT_N_PID $CLIENT_O_PID 2>/dev/null
+
+if cmp -s temp.txt temp_cache_2.txt && cmp -s temp.txt temp_cache_3.txt &&
+    grep -q "hits 2  misses 1" test_files/output/scenario_o.output; then
+    echo -e "${GREEN}GET MULTIFILE CACHE OK.${NC}"
+else
+    echo -e "${RED}GET MULTIFILE CACHE Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_m.txt
+rm -f test_files/input/scenario_n.txt
+rm -f test_files/input/scenario_o.txt
+rm -f temp.txt temp_cache_1.txt temp_cache_2.txt temp_cache_3.txt
+
+# Compresión: user_q descarga un log de user_p con get_file comprimido con zlib y con
+# get_multifile (por piezas) comprimido con lzma
+LOG_PATH="$(pwd)/test_files/output/compress/server.log"
+mkdir -p "$(dirname "$LOG_PATH")"
+seq -f "%g INFO PUBLISH /home/user/file.txt" 1 40000 > "$LOG_PATH"
+printf "register user_p\nconnect user_p\npublish $LOG_PATH log comprimible\n" > test_files/input/scenario_p.txt
+printf "register user_q\nconnect user_q\nset cache_mb 0\nset compression zlib\nget_file user_p $LOG_PATH ./temp_zlib.log\nset compression lzma\nget_multifile server.log ./temp_lzma.log\n" \
+    > test_files/input/scenario_q.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_p.txt \
+    > test_files/output/scenario_p.output 2>/dev/null &
+CLIENT_P_PID=$!
+sleep 2
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_q.txt \
+    > test_files/output/scenario_q.output 2>/dev/null &
+CLIENT_Q_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 20); do
+    grep -q "GET_MULTIFILE" test_files/output/scenario_q.output && break
+    sleep 0.5
+done
+
+kill $CLIENT_P_PID $CLIENT_Q_PID 2>/dev/null
+
+if cmp -s "$LOG_PATH" temp_zlib.log && cmp -s "$LOG_PATH" temp_lzma.log; then
+    echo -e "${GREEN}GET FILE COMPRESSED OK.${NC}"
+else
+    echo -e "${RED}GET FILE COMPRESSED Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_p.txt
+rm -f test_files/input/scenario_q.txt
+rm -f temp_zlib.log temp_lzma.log
+
+# Límite de subida: user_r sirve como mucho 256 KiB/s, así que user_s tarda al menos 4 segundos
+# en descargar 1 MiB
+LIMITED_PATH="$(pwd)/test_files/output/limited/big.bin"
+mkdir -p "$(dirname "$LIMITED_PATH")"
+head -c 1048576 /dev/urandom > "$LIMITED_PATH"
+printf "register user_r\nconnect user_r\nset upload_limit 256\npublish $LIMITED_PATH limitado\n" \
+    > test_files/input/scenario_r.txt
+# La descarga de user_s se instrumenta: METRICS muestra lo recibido de user_r y los eventos
+# quedan en un fichero de líneas JSON
+rm -f test_files/output/metrics_s.jsonl
+printf "register user_s\nconnect user_s\nset cache_mb 0\nset metrics_file test_files/output/metrics_s.jsonl\n\
+get_file user_r $LIMITED_PATH ./temp_limited.bin\nmetrics\n" > test_files/input/scenario_s.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_r.txt \
+    > test_files/output/scenario_r.output 2>/dev/null &
+CLIENT_R_PID=$!
+sleep 2
+START_NS=$(date +%s%N)
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_s.txt \
+    > test_files/output/scenario_s.output 2>/dev/null &
+CLIENT_S_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 40); do
+    grep -q "METRICS" test_files/output/scenario_s.output && break
+    sleep 0.25
+done
+ELAPSED_MS=$(( ($(date +%s%N) - START_NS) / 1000000 ))
+
+kill $CLIENT_R_PID $CLIENT_S_PID 2>/dev/null
+
+if cmp -s "$LIMITED_PATH" temp_limited.bin && (( ELAPSED_MS >= 3500 )); then
+    echo -e "${GREEN}GET FILE UPLOAD LIMIT OK.${NC}"
+else
+    echo -e "${RED}GET FILE UPLOAD LIMIT Fail (${ELAPSED_MS} ms).${NC}"
+fi
+
+if grep -q "transfers 1 (0 failed)  bytes 1048576" test_files/output/scenario_s.output &&
+    [[ $(grep -c "^\s*[0-9.]*:[0-9]* *1 *0 *1048576 " test_files/output/scenario_s.output) -eq 1 ]] &&
+    grep -q '"event": "connect"' test_files/output/metrics_s.jsonl &&
+    grep -q '"event": "finish", "op": "GET_FILE", .*"ok": true, "bytes": 1048576' test_files/output/metrics_s.jsonl; then
+    echo -e "${GREEN}TRANSFER METRICS OK.${NC}"
+else
+    echo -e "${RED}TRANSFER METRICS Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_r.txt
+rm -f test_files/input/scenario_s.txt
+rm -f temp_limited.bin
+
+# Lote: user_u descarga con un patrón todos los ficheros que user_t ha compartido (conservando
+# las subcarpetas) y, de todos los usuarios, los que acaban en dos.txt. SHARE publica también el
+# hash del contenido, así que después (sin caché) puede pedir dos.txt por su hash
+SHARED_HASH=$(cd client && python3 -c "import manifest; print(manifest.build_manifest('../test_files/input/share_dir/sub/dos.txt')['hash'])")
+printf "register user_t\nconnect user_t\nshare test_files/input/share_dir\n" > test_files/input/scenario_t.txt
+printf "register user_u\nconnect user_u\nget_batch user_t ./temp_batch *.txt\nget_batch * ./temp_batch_all *dos.txt\n\
+set cache_mb 0\nget_multifile sha256:$SHARED_HASH ./temp_shared_hash.txt\n" > test_files/input/scenario_u.txt
+
+restart_server
+
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_t.txt \
+    > test_files/output/scenario_t.output 2>/dev/null &
+CLIENT_T_PID=$!
+sleep 2
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_u.txt \
+    > test_files/output/scenario_u.output 2>/dev/null &
+CLIENT_U_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 20); do
+    grep -q "GET_MULTIFILE" test_files/output/scenario_u.output && break
+    sleep 0.5
+done
+
+kill $CLIENT_T_PID $CLIENT_U_PID 2>/dev/null
+
+if diff -r test_files/input/share_dir temp_batch >/dev/null &&
+    cmp -s test_files/input/share_dir/sub/dos.txt temp_batch_all/user_t/dos.txt &&
+    [[ $(grep -c "GET_BATCH OK" test_files/output/scenario_u.output) -eq 2 ]]; then
+    echo -e "${GREEN}GET BATCH OK.${NC}"
+else
+    echo -e "${RED}GET BATCH Fail.${NC}"
+fi
+
+if grep -q "GET_MULTIFILE OK" test_files/output/scenario_u.output &&
+    cmp -s test_files/input/share_dir/sub/dos.txt temp_shared_hash.txt; then
+    echo -e "${GREEN}GET MULTIFILE SHARED BY HASH OK.${NC}"
+else
+    echo -e "${RED}GET MULTIFILE SHARED BY HASH Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_t.txt
+rm -f test_files/input/scenario_u.txt
+rm -rf temp_batch temp_batch_all temp_shared_hash.txt
+
+# Búsqueda: por subcadena de la ruta o la descripción (sin distinguir mayúsculas), por prefijo del
+# nombre y con límite; un fichero borrado deja de aparecer
+printf "register user_v\nconnect user_v\npublish autores.txt texto descriptivo\npublish app.sh script de arranque\n\
+publish README.md documentacion\nsearch TXT\nsearch arranque\nsearch read*\nsearch . 2\ndelete app.sh\nsearch arranque\n\
+quit\n" > test_files/input/scenario_v.txt
+
+restart_server
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT < test_files/input/scenario_v.txt \
+    > test_files/output/scenario_v.output 2>/dev/null
+
+if [[ $(grep -c "SEARCH OK" test_files/output/scenario_v.output) -eq 5 ]] &&
+    [[ $(grep -c "RESULT[0-9]" test_files/output/scenario_v.output) -eq 5 ]] &&
+    grep -q "RESULT0: user_v .*/autores.txt \"texto descriptivo\"" test_files/output/scenario_v.output &&
+    grep -q "RESULT0: user_v .*/README.md \"documentacion\"" test_files/output/scenario_v.output &&
+    grep -q "(2 of 3 results)" test_files/output/scenario_v.output &&
+    [[ $(grep -c "app.sh" test_files/output/scenario_v.output) -eq 2 ]]; then
+    echo -e "${GREEN}SEARCH OK.${NC}"
+else
+    echo -e "${RED}SEARCH Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_v.txt
+
+# Suscripción: user_w recibe los cambios de los ficheros .txt y las conexiones de user_x, pero no
+# el PUBLISH de app.sh, que no cumple el patrón de ruta
+printf "register user_w\nconnect user_w\nsubscribe * *.txt\n" > test_files/input/scenario_w.txt
+printf "register user_x\nconnect user_x\npublish autores.txt texto descriptivo\npublish app.sh script\n\
+delete autores.txt\ndisconnect user_x\nquit\n" > test_files/input/scenario_x.txt
+
+restart_server
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT --input-file test_files/input/scenario_w.txt \
+    > test_files/output/scenario_w.output 2>/dev/null &
+CLIENT_W_PID=$!
+sleep 2
+python3 client/client.py -s $SERVER_IP -p $SERVER_PORT < test_files/input/scenario_x.txt \
+    > test_files/output/scenario_x.output 2>/dev/null
+sleep 1
+kill $CLIENT_W_PID 2>/dev/null
+wait $CLIENT_W_PID 2>/dev/null
+
+if grep -q "SUBSCRIBE OK" test_files/output/scenario_w.output &&
+    grep -q "EVENT CONNECT user_x " test_files/output/scenario_w.output &&
+    grep -q "EVENT PUBLISH user_x .*/autores.txt \"texto descriptivo\"" test_files/output/scenario_w.output &&
+    grep -q "EVENT DELETE user_x .*/autores.txt" test_files/output/scenario_w.output &&
+    grep -q "EVENT DISCONNECT user_x" test_files/output/scenario_w.output &&
+    ! grep -q "app.sh" test_files/output/scenario_w.output; then
+    echo -e "${GREEN}SUBSCRIBE OK.${NC}"
+else
+    echo -e "${RED}SUBSCRIBE Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_w.txt
+rm -f test_files/input/scenario_x.txt
+
+echo
+echo -e "${BLUE}SHARDED DIRECTORY TESTS. STARTING 2 DIRECTORY SERVERS...${NC}"
+echo
+
+# Dos servidores del directorio particionado. Con 2 servidores, carla pertenece al 0 y ana y
+# beto al 1, así que las pruebas cruzan siempre de un servidor a otro.
+SHARD_PORTS=(4445 4446)
+SHARDS="$SERVER_IP:${SHARD_PORTS[0]},$SERVER_IP:${SHARD_PORTS[1]}"
+SHARD_PIDS=()
+for i in 0 1; do
+  ./server/cmake-build-release/server -p "${SHARD_PORTS[$i]}" -n "$i/2" \
+      > "test_files/output/logs/server_shard_$i.log" 2>&1 &
+  SHARD_PIDS+=($!)
+done
+sleep 1
+
+run_test "shards_1" "test_files/input/shards_1.txt" "test_files/expected/shards_1_expected.txt" "--shards $SHARDS"
+
+# GET_MULTIFILE con un seeder en cada servidor: el cliente tiene que preguntar a los dos
+echo "One half of the seeders lives on each directory server." > $FILE_PATH
+printf "register carla\nconnect carla\npublish $FILE_PATH fichero en el servidor 0\n" \
+    > test_files/input/scenario_shard_a.txt
+printf "register ana\nconnect ana\npublish $FILE_PATH fichero en el servidor 1\n" \
+    > test_files/input/scenario_shard_b.txt
+printf "register beto\nconnect beto\nlist_users\nsearch temp\nget_multifile temp.txt ./temp_multidownload.txt\n" \
+    > test_files/input/scenario_shard_c.txt
+
+python3 client/client.py --shards $SHARDS --input-file test_files/input/scenario_shard_a.txt \
+    > test_files/output/scenario_shard_a.output 2>/dev/null &
+CLIENT_A_PID=$!
+python3 client/client.py --shards $SHARDS --input-file test_files/input/scenario_shard_b.txt \
+    > test_files/output/scenario_shard_b.output 2>/dev/null &
+CLIENT_B_PID=$!
+sleep 2
+python3 client/client.py --shards $SHARDS --input-file test_files/input/scenario_shard_c.txt \
+    > test_files/output/scenario_shard_c.output 2>/dev/null &
+CLIENT_C_PID=$!
+
+echo -e "${YELLOW}Waiting for download to finish...${NC}"
+for _ in $(seq 20); do
+    cmp -s temp.txt temp_multidownload.txt && break
+    sleep 0.5
+done
+
+kill $CLIENT_A_PID $CLIENT_B_PID $CLIENT_C_PID 2>/dev/null
+
+if [[ $(grep -c "USER[0-9]" test_files/output/scenario_shard_c.output) -eq 3 ]]; then
+    echo -e "${GREEN}SHARDED LIST_USERS OK.${NC}"
+else
+    echo -e "${RED}SHARDED LIST_USERS Fail.${NC}"
+fi
+
+if [[ $(grep -c "RESULT[0-9]" test_files/output/scenario_shard_c.output) -eq 2 ]]; then
+    echo -e "${GREEN}SHARDED SEARCH OK.${NC}"
+else
+    echo -e "${RED}SHARDED SEARCH Fail.${NC}"
+fi
+
+if diff -q temp.txt temp_multidownload.txt >/dev/null; then
+    echo -e "${GREEN}SHARDED GET MULTIFILE OK.${NC}"
+else
+    echo -e "${RED}SHARDED GET MULTIFILE Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_shard_a.txt
+rm -f test_files/input/scenario_shard_b.txt
+rm -f test_files/input/scenario_shard_c.txt
+rm -f temp.txt temp_multidownload.txt
+kill "${SHARD_PIDS[@]}" 2>/dev/null
+
+echo
+echo -e "${BLUE}LEASE TESTS. STARTING A SERVER WITH 2 SECOND LEASES...${NC}"
+echo
+
+# fantasma deja de enviar HEARTBEAT (como un cliente que ha muerto sin DISCONNECT): al caducar
+# su lease tiene que desaparecer de LIST_USERS. vivo sigue renovándolo y no se desconecta.
+LEASE_PORT=4447
+SERVER_LEASE_SECS=2 ./server/cmake-build-release/server -p $LEASE_PORT > test_files/output/logs/server_lease.log 2>&1 &
+LEASE_SERVER_PID=$!
+sleep 1
+
+printf "register fantasma\nconnect fantasma\n" > test_files/input/scenario_lease_a.txt
+printf "register vivo\nconnect vivo\n" > test_files/input/scenario_lease_b.txt
+printf "register observador\nconnect observador\nlist_users\n" > test_files/input/scenario_lease_c.txt
+
+python3 client/client.py -s $SERVER_IP -p $LEASE_PORT --heartbeat 0 \
+    --input-file test_files/input/scenario_lease_a.txt > test_files/output/scenario_lease_a.output 2>/dev/null &
+CLIENT_A_PID=$!
+python3 client/client.py -s $SERVER_IP -p $LEASE_PORT --heartbeat 0.5 \
+    --input-file test_files/input/scenario_lease_b.txt > test_files/output/scenario_lease_b.output 2>/dev/null &
+CLIENT_B_PID=$!
+echo -e "${YELLOW}Waiting for the lease to expire...${NC}"
+sleep 5
+python3 client/client.py -s $SERVER_IP -p $LEASE_PORT --heartbeat 0.5 \
+    --input-file test_files/input/scenario_lease_c.txt > test_files/output/scenario_lease_c.output 2>/dev/null &
+CLIENT_C_PID=$!
+sleep 2
+
+kill $CLIENT_A_PID $CLIENT_B_PID $CLIENT_C_PID 2>/dev/null
+
+if [[ $(grep -c "USER[0-9]" test_files/output/scenario_lease_c.output) -eq 2 ]] &&
+    grep -q "vivo" test_files/output/scenario_lease_c.output &&
+    ! grep -q "fantasma" test_files/output/scenario_lease_c.output; then
+    echo -e "${GREEN}LEASE EXPIRY OK.${NC}"
+else
+    echo -e "${RED}LEASE EXPIRY Fail.${NC}"
+fi
+
+rm -f test_files/input/scenario_lease_a.txt
+rm -f test_files/input/scenario_lease_b.txt
+rm -f test_files/input/scenario_lease_c.txt
+kill $LEASE_SERVER_PID 2>/dev/null
 
 kill $SERVER_PID 2>/dev/null
 kill $LOGGER_PID 2>/dev/null
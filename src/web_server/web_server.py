@@ -1,6 +1,7 @@
 from datetime import datetime
 from pysimplesoap.server import SoapDispatcher
-from wsgiref.simple_server import make_server
+from socketserver import ThreadingMixIn
+from wsgiref.simple_server import WSGIServer, make_server
 
 dispatcher = SoapDispatcher(
     name="FechaHoraService",
@@ -62,7 +63,13 @@ def application(environ, start_response):
     ])
     return [wsdl_xml]
 
+# Un hilo por petición: un cliente que abre la conexión y no llega a enviar la petición (por
+# ejemplo, porque una señal lo interrumpe) no bloquea a los demás
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
 if __name__ == '__main__':
     print("Servidor SOAP escuchando en http://127.0.0.1:8000/")
     print("WSDL disponible en http://127.0.0.1:8000/?wsdl")
-    make_server('127.0.0.1', 8000, application).serve_forever()
+    make_server('127.0.0.1', 8000, application, server_class=ThreadingWSGIServer).serve_forever()